@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark del Generador de Informes Retinográficos
+Retidiag - 2026
+
+Genera hojas INPUT sintéticas (todos los diagnósticos, todas las comunas de
+LOGOS_ESTABLECIMIENTO y todos los firmantes) y mide por separado la lectura,
+la normalización, la generación de PDFs y el resumen Excel. Los resultados
+se guardan en JSON para comparar ejecuciones.
+
+Con --verificar-memoria comprueba en cambio que el modo --bloques del
+generador tenga el mismo pico de memoria con hojas de distinto largo, y
+con --verificar-repeticion que cada motor genere el mismo PDF al repetir un
+informe de dos páginas en el mismo proceso.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+
+import generar_informes as gi
+
+# Columnas de la hoja INPUT, en el orden de Plantilla_Informes_Retidiag.xlsx
+COLUMNAS_PLANTILLA = [
+    'COMUNA', 'FECHA', 'ESTABLECIMIENTO', 'NOMBRE CARPETA', 'NOMBRE PACIENTE', 'RUT', 'EDAD',
+    'EVALUACION TMO', 'OBSERVACIONES', 'RESULTADO FINAL', 'DIAGNOSTICO OFT', 'DETALLE OD',
+    'DETALLE OI', 'Derivacion', 'OFTALMOLOGO', 'Repetir fecha', 'repetir Institución',
+]
+
+TAMANOS = [100, 1000, 10000, 100000]
+# Verificación de memoria del modo --bloques: hojas, tamaño de bloque y
+# cuánto puede crecer el pico de RSS de la hoja más corta a la más larga
+TAMANOS_MEMORIA = [1000, 8000]
+BLOQUE_MEMORIA = 200
+TOLERANCIA_MEMORIA_MB = 15
+ETAPAS = ['lectura', 'normalizacion', 'pdfs', 'resumen']
+
+# Variantes de RESULTADO FINAL como vienen en las planillas reales
+RESULTADOS = {
+    'NORMAL': ['NORMAL', 'Normal', 'normal '],
+    'DG NORMAL': ['DG NORMAL', 'DGNORMAL', 'Dg Normal'],
+    'CATARATA': ['CATARATA', 'Catarata', 'SOSPECHA CATARATA'],
+    'RD': ['RD', 'Retinopatía', 'RETINOPATIA DIABETICA'],
+    'OTROS': ['OTROS', 'Otros', 'GLAUCOMA'],
+}
+NOMBRES = ['MARÍA', 'JOSÉ', 'ANA', 'LUIS', 'CARMEN', 'JUAN', 'ROSA', 'PEDRO', 'ELENA', 'JORGE']
+APELLIDOS = ['GONZÁLEZ', 'MUÑOZ', 'ROJAS', 'DÍAZ', 'PÉREZ', 'SOTO', 'CONTRERAS', 'SILVA',
+             'MARTÍNEZ', 'SEPÚLVEDA', 'MORALES', 'RODRÍGUEZ']
+HALLAZGOS = ['Sin observaciones', 'Microaneurismas aislados', 'Hemorragias en llama',
+             'Exudados duros perimaculares', 'Opacidad de medios', 'Excavación papilar aumentada']
+DERIVACIONES_EJEMPLO = ['Control en 1 año', 'Derivar a oftalmología', 'Derivar urgente a UAPO']
+
+
+def digito_verificador(numero):
+    """Dígito verificador de un RUT chileno."""
+    suma, factor = 0, 2
+    for digito in reversed(str(numero)):
+        suma += int(digito) * factor
+        factor = 2 if factor == 7 else factor + 1
+    resto = 11 - suma % 11
+    return {11: '0', 10: 'K'}.get(resto, str(resto))
+
+
+def fila_sintetica(i, rng):
+    """Arma una fila de la hoja INPUT (dict por columna).
+
+    Los diagnósticos, comunas y firmantes se recorren en ciclo para que
+    cualquier muestra de más de unas decenas de filas los incluya a todos;
+    el resto de los campos es aleatorio con la semilla dada.
+    """
+    comunas = list(gi.LOGOS_ESTABLECIMIENTO)
+    diagnostico = list(RESULTADOS)[i % len(RESULTADOS)]
+    comuna = comunas[i % len(comunas)]
+    # DG NORMAL, RD y OTROS firman con oftalmólogo; NORMAL y CATARATA con TMO
+    if diagnostico in ('DG NORMAL', 'RD', 'OTROS'):
+        firmante = list(gi.FIRMAS_OFTALMOLOGO)[i % len(gi.FIRMAS_OFTALMOLOGO)]
+    else:
+        firmante = list(gi.FIRMAS_TMO)[i % len(gi.FIRMAS_TMO)]
+    rut = 5000000 + i * 37 % 20000000
+    dv = digito_verificador(rut)
+    return {
+        'COMUNA': comuna,
+        'FECHA': datetime(2026, 1, 12) + timedelta(days=i // 7 % 5),
+        'ESTABLECIMIENTO': f"CESFAM {comuna.title()} {1 + i % 2}",
+        'NOMBRE PACIENTE': f"{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)} {i}",
+        # Un tercio de los RUT viene como número, sin guión (como los deja Excel)
+        'RUT': f"{rut}-{dv}" if i % 3 or dv == 'K' else int(f"{rut}{dv}"),
+        'EDAD': rng.randint(18, 95) if i % 50 else None,
+        'OBSERVACIONES': " ".join(rng.choice(HALLAZGOS) for _ in range(rng.randint(0, 12))) or None,
+        'RESULTADO FINAL': rng.choice(RESULTADOS[diagnostico]),
+        'DETALLE OD': rng.choice(HALLAZGOS + [None]),
+        'DETALLE OI': rng.choice(HALLAZGOS + [None]),
+        'Derivacion': rng.choice(DERIVACIONES_EJEMPLO + [None, None]),
+        'OFTALMOLOGO': firmante,
+    }
+
+
+def generar_excel_sintetico(ruta, filas, semilla=0):
+    """Escribe un Excel con una hoja INPUT de `filas` pacientes sintéticos."""
+    rng = random.Random(semilla)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('INPUT')
+    ws.append(COLUMNAS_PLANTILLA)
+    for i in range(filas):
+        fila = fila_sintetica(i, rng)
+        ws.append([fila.get(col) for col in COLUMNAS_PLANTILLA])
+    wb.save(ruta)
+    return ruta
+
+
+def _rss_pico_mb(hijos=False):
+    """Pico de memoria residente del proceso (o de sus hijos terminados) en MB."""
+    import resource
+    uso = resource.getrusage(resource.RUSAGE_CHILDREN if hijos else resource.RUSAGE_SELF)
+    # ru_maxrss viene en bytes en macOS y en KB en Linux
+    return uso.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def _bytes_carpeta(carpeta, extension):
+    """Suma el tamaño de los archivos con `extension` bajo `carpeta`."""
+    total = 0
+    for raiz, _, archivos in os.walk(carpeta):
+        total += sum(os.path.getsize(os.path.join(raiz, a)) for a in archivos if a.endswith(extension))
+    return total
+
+
+def medir(excel_path, salida, workers=1, motor='platypus', limite_pdfs=None, compacto=False):
+    """Mide las cuatro etapas sobre un Excel y retorna un dict con los resultados.
+
+    Con `limite_pdfs` solo se generan los PDFs de las primeras filas (la
+    tasa de la etapa se calcula sobre los PDFs generados). Con `compacto`
+    se mide la salida compacta.
+    """
+    gi.usar_salida_compacta(compacto)
+    resultado = {'etapas': {}}
+
+    def etapa(nombre, filas, inicio):
+        segundos = time.perf_counter() - inicio
+        resultado['etapas'][nombre] = {
+            'segundos': round(segundos, 4),
+            'filas': filas,
+            'filas_por_segundo': round(filas / segundos, 1) if segundos > 0 else None,
+            'rss_pico_mb': round(_rss_pico_mb(), 1),
+        }
+
+    # Las dependencias se importan recién al usarlas: cargarlas antes para
+    # que el tiempo de importar pandas no quede dentro de la lectura
+    gi.cargar_dependencias()
+    with redirect_stdout(io.StringIO()):
+        inicio = time.perf_counter()
+        df = gi._leer_pacientes_excel(excel_path, cache=False)
+        etapa('lectura', len(df), inicio)
+
+        inicio = time.perf_counter()
+        pacientes = gi.normalizar_pacientes(df)
+        etapa('normalizacion', len(pacientes), inicio)
+
+        grupos = gi.agrupar_pacientes(df, salida)
+        inicio = time.perf_counter()
+        tareas = []
+        rutas = gi.RutasInformes()
+        for output_dir, (_, posiciones) in grupos.items():
+            for idx in posiciones:
+                tareas.append(gi._tarea_paciente(idx, pacientes[idx], output_dir))
+        if limite_pdfs is not None:
+            tareas = tareas[:limite_pdfs]
+        for _, pdf_path, nombre, _ in tareas:
+            rutas.agregar(pdf_path, nombre)
+        resultados = gi.escribir_en_segundo_plano(
+            gi.ejecutar_tareas(tareas, workers, motor, gi._generar_pdf_memoria_tarea))
+        errores = sum(1 for r in resultados if r[3] is not None)
+        etapa('pdfs', len(tareas), inicio)
+        resultado['etapas']['pdfs']['errores'] = errores
+        resultado['etapas']['pdfs']['rss_pico_workers_mb'] = round(_rss_pico_mb(hijos=True), 1)
+
+        inicio = time.perf_counter()
+        for output_dir, ((_, establecimiento, fecha_examen), posiciones) in grupos.items():
+            os.makedirs(output_dir, exist_ok=True)
+            gi.generar_resumen_pacientes([pacientes[i] for i in posiciones], establecimiento,
+                                         fecha_examen, output_dir)
+        etapa('resumen', len(pacientes), inicio)
+
+    resultado['grupos'] = len(grupos)
+    resultado['bytes_pdfs'] = _bytes_carpeta(salida, '.pdf')
+    resultado['bytes_resumen'] = _bytes_carpeta(salida, '.xlsx')
+    resultado['rss_pico_mb'] = round(_rss_pico_mb(), 1)
+    return resultado
+
+
+def _medir_en_proceso(cola, *args):
+    cola.put(medir(*args))
+
+
+def medir_aislado(*args):
+    """Ejecuta medir() en un proceso nuevo, para que el pico de RSS sea solo de esa medición."""
+    contexto = multiprocessing.get_context('spawn')
+    cola = contexto.Queue()
+    proceso = contexto.Process(target=_medir_en_proceso, args=(cola,) + args)
+    proceso.start()
+    resultado = cola.get()
+    proceso.join()
+    return resultado
+
+
+def pico_memoria_bloques(excel_path, salida, bloques, workers=1, motor='platypus'):
+    """Ejecuta generar_informes.py --bloques en un proceso aparte y retorna su pico de RSS en MB.
+
+    El pico (de wait4) incluye el de los procesos del pool.
+    """
+    proceso = subprocess.Popen([sys.executable, os.path.join(gi.BASE_DIR, 'generar_informes.py'), excel_path,
+                                salida, '--bloques', str(bloques), '--workers', str(workers),
+                                '--motor', motor], stdout=subprocess.DEVNULL)
+    _, estado, uso = os.wait4(proceso.pid, 0)
+    proceso.returncode = os.waitstatus_to_exitcode(estado)
+    if proceso.returncode:
+        raise RuntimeError(f"generar_informes.py terminó con código {proceso.returncode}")
+    return uso.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def verificar_memoria(tamanos, datos, semilla=0, bloques=BLOQUE_MEMORIA, workers=1, motor='platypus',
+                      tolerancia_mb=TOLERANCIA_MEMORIA_MB):
+    """Comprueba que el pico de memoria del modo --bloques no crezca con el largo de la hoja.
+
+    Genera (o reutiliza) un Excel sintético por tamaño, procesa cada uno
+    completo y compara el pico de RSS de la hoja más larga con el de la
+    más corta. Retorna True si no creció más de `tolerancia_mb`.
+    """
+    picos = []
+    for filas in sorted(tamanos):
+        excel_path = os.path.join(datos, f"input_{filas}_{semilla}.xlsx")
+        if not os.path.exists(excel_path):
+            print(f"Generando Excel sintético de {filas} filas...")
+            generar_excel_sintetico(excel_path, filas, semilla)
+        salida = tempfile.mkdtemp(prefix=f"memoria_{filas}_")
+        try:
+            print(f"Procesando {filas} filas de a {bloques}...")
+            inicio = time.perf_counter()
+            picos.append(pico_memoria_bloques(excel_path, salida, bloques, workers, motor))
+        finally:
+            shutil.rmtree(salida, ignore_errors=True)
+        print(f"  RSS pico {picos[-1]:.1f} MB ({time.perf_counter() - inicio:.1f} s)")
+
+    crecimiento = picos[-1] - picos[0]
+    ok = crecimiento <= tolerancia_mb
+    print(f"\n{'✓' if ok else '✗'} El pico de memoria creció {crecimiento:+.1f} MB de {min(tamanos)} a "
+          f"{max(tamanos)} filas (tolerancia {tolerancia_mb} MB)")
+    return ok
+
+
+def verificar_repeticion(motores=None):
+    """Comprueba que generar dos veces el mismo informe en un proceso dé el mismo PDF.
+
+    Los motores guardan por proceso el texto fijo ya armado, y el daemon y
+    el servicio HTTP reutilizan sus workers. Para cada motor y diagnóstico
+    genera el mismo paciente dos veces seguidas, con observaciones cada vez
+    más largas para que el informe pase a una segunda página, y compara los
+    bytes. Retorna True si todos coinciden y ninguno falló.
+    """
+    from reportlab import rl_config
+    rl_config.invariant = 1  # sin fecha ni identificadores al azar en el PDF
+    gi.cargar_dependencias()
+    estilos = gi.crear_estilos()
+    ok = True
+    for motor in sorted(motores or gi.MOTORES):
+        generar = gi.MOTORES[motor]
+        informes = dos_paginas = 0
+        fallos = []
+        for i in range(len(RESULTADOS)):
+            for hallazgos in range(5, 45, 2):
+                fila = fila_sintetica(i, random.Random(hallazgos))
+                fila['OBSERVACIONES'] = " ".join(HALLAZGOS[j % len(HALLAZGOS)] for j in range(hallazgos))
+                paciente = gi.Paciente.desde_dict(fila)
+                dos_paginas += not gi.informe_cabe_en_pagina(paciente, estilos)
+                pdfs = []
+                for _ in range(2):
+                    buffer = io.BytesIO()
+                    try:
+                        generar(paciente, buffer, estilos)
+                        pdfs.append(buffer.getvalue())
+                    except Exception as e:
+                        pdfs.append(f"error: {str(e).splitlines()[0]}")
+                informes += 1
+                if isinstance(pdfs[0], str) or isinstance(pdfs[1], str):
+                    fallos.append(f"{paciente.resultado}, {len(paciente.observaciones)} caracteres: "
+                                  f"{next(p for p in pdfs if isinstance(p, str))[:120]}")
+                elif pdfs[0] != pdfs[1]:
+                    fallos.append(f"{paciente.resultado}, {len(paciente.observaciones)} caracteres: "
+                                  "la segunda vez el PDF salió distinto")
+        ok = ok and not fallos
+        print(f"{'✓' if not fallos else '✗'} {motor}: {informes} informes generados dos veces "
+              f"({dos_paginas} de más de una página), {len(fallos)} distintos o con error")
+        for fallo in fallos[:10]:
+            print(f"    {fallo}")
+    return ok
+
+
+def _version_codigo():
+    """Commit actual del repositorio (o None si no es un repositorio git)."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=gi.BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(anterior, actual):
+    """Imprime, por tamaño y etapa, cuántas veces más rápida es la ejecución actual."""
+    previos = {m['filas']: m for m in anterior['mediciones']}
+    print(f"\nComparación con {anterior.get('commit') or '?'} ({anterior.get('fecha', '')}):")
+    for medicion in actual['mediciones']:
+        previa = previos.get(medicion['filas'])
+        if previa is None:
+            continue
+        partes = []
+        for nombre in ETAPAS:
+            antes = previa['etapas'].get(nombre, {}).get('filas_por_segundo')
+            ahora = medicion['etapas'].get(nombre, {}).get('filas_por_segundo')
+            if antes and ahora:
+                partes.append(f"{nombre} x{ahora / antes:.2f}")
+        print(f"  {medicion['filas']:>7} filas: " + ", ".join(partes))
+
+
+def main():
+    """Función principal."""
+    parser = argparse.ArgumentParser(
+        description="Mide el rendimiento del generador de informes con datos sintéticos.",
+    )
+    parser.add_argument("--tamanos", default=",".join(map(str, TAMANOS)),
+                        help="cantidades de filas separadas por coma (por defecto 100,1000,10000,100000)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="procesos para generar los PDFs (por defecto 1)")
+    parser.add_argument("--motor", choices=sorted(gi.MOTORES), default="platypus",
+                        help="motor de renderizado (por defecto platypus)")
+    parser.add_argument("--compacto", action="store_true", help="medir la salida compacta")
+    parser.add_argument("--limite-pdfs", type=int, default=None,
+                        help="generar como máximo esta cantidad de PDFs por tamaño")
+    parser.add_argument("--datos", default=os.path.join(tempfile.gettempdir(), "benchmark_retidiag"),
+                        help="carpeta donde se guardan (y reutilizan) los Excel sintéticos")
+    parser.add_argument("--semilla", type=int, default=0, help="semilla de los datos sintéticos")
+    parser.add_argument("--salida", default=None,
+                        help="archivo JSON de resultados (por defecto benchmark_<fecha>.json)")
+    parser.add_argument("--comparar", metavar="JSON", help="resultados anteriores con los que comparar")
+    parser.add_argument("--verificar-memoria", nargs="?", metavar="TAMANOS",
+                        const=",".join(map(str, TAMANOS_MEMORIA)),
+                        help="en lugar de medir, comprobar que el pico de memoria del modo --bloques no "
+                             "crece con el largo de la hoja (por defecto con "
+                             f"{','.join(map(str, TAMANOS_MEMORIA))} filas)")
+    parser.add_argument("--bloques", type=int, default=BLOQUE_MEMORIA,
+                        help=f"tamaño de bloque para --verificar-memoria (por defecto {BLOQUE_MEMORIA})")
+    parser.add_argument("--tolerancia-mb", type=float, default=TOLERANCIA_MEMORIA_MB,
+                        help="cuánto puede crecer el pico de memoria en --verificar-memoria "
+                             f"(por defecto {TOLERANCIA_MEMORIA_MB} MB)")
+    parser.add_argument("--verificar-repeticion", action="store_true",
+                        help="en lugar de medir, comprobar que cada motor genere el mismo PDF al repetir "
+                             "un informe (también de dos páginas) en el mismo proceso")
+    args = parser.parse_args()
+
+    if args.verificar_repeticion:
+        if not verificar_repeticion():
+            sys.exit(1)
+        return
+
+    os.makedirs(args.datos, exist_ok=True)
+    if args.verificar_memoria:
+        tamanos = [int(t) for t in args.verificar_memoria.split(",") if t.strip()]
+        if not verificar_memoria(tamanos, args.datos, args.semilla, args.bloques, args.workers, args.motor,
+                                 args.tolerancia_mb):
+            sys.exit(1)
+        return
+
+    tamanos = [int(t) for t in args.tamanos.split(",") if t.strip()]
+    fecha = datetime.now()
+    resultados = {
+        'fecha': fecha.isoformat(timespec='seconds'),
+        'commit': _version_codigo(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+        'motor': args.motor,
+        'workers': args.workers,
+        'limite_pdfs': args.limite_pdfs,
+        'compacto': args.compacto,
+        'semilla': args.semilla,
+        'mediciones': [],
+    }
+
+    for filas in tamanos:
+        excel_path = os.path.join(args.datos, f"input_{filas}_{args.semilla}.xlsx")
+        if not os.path.exists(excel_path):
+            print(f"Generando Excel sintético de {filas} filas...")
+            generar_excel_sintetico(excel_path, filas, args.semilla)
+
+        salida = tempfile.mkdtemp(prefix=f"benchmark_{filas}_")
+        try:
+            print(f"Midiendo {filas} filas...")
+            medicion = medir_aislado(excel_path, salida, args.workers, args.motor, args.limite_pdfs,
+                                     args.compacto)
+        finally:
+            shutil.rmtree(salida, ignore_errors=True)
+        medicion['filas'] = filas
+        medicion['bytes_excel'] = os.path.getsize(excel_path)
+        resultados['mediciones'].append(medicion)
+
+        etapas = medicion['etapas']
+        print("  " + ", ".join(f"{nombre} {etapas[nombre]['segundos']:.2f} s "
+                               f"({etapas[nombre]['filas_por_segundo'] or 0:.0f} filas/s)"
+                               for nombre in ETAPAS))
+        print(f"  RSS pico {medicion['rss_pico_mb']:.0f} MB, PDFs {medicion['bytes_pdfs'] / 2**20:.1f} MB, "
+              f"resumen {medicion['bytes_resumen'] / 2**20:.1f} MB")
+
+    salida_json = args.salida or f"benchmark_{fecha.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(salida_json, 'w', encoding='utf-8') as f:
+        json.dump(resultados, f, ensure_ascii=False, indent=1)
+    print(f"\n✓ Resultados guardados: {salida_json}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(json.load(f), resultados)
+
+
+if __name__ == "__main__":
+    main()
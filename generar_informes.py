@@ -8,30 +8,136 @@ Este programa lee un archivo Excel con datos de pacientes y genera
 informes PDF individuales según el diagnóstico.
 """
 
+import io
+import copy
+import codecs
+import json
+import hashlib
+import importlib
 import os
+import re
 import sys
+import glob
+import time
 import shutil
+import signal
+import socket
+import argparse
+import socketserver
+import sqlite3
+import tempfile
+import unicodedata
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, redirect_stdout
 from datetime import datetime
-import pandas as pd
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.drawing.image import Image as XLImage
-from reportlab.lib import colors
+from functools import partial
+from itertools import islice
 from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import cm, mm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, Table, TableStyle
+from reportlab.lib.units import cm, mm, inch
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
 
+
+class _Diferido:
+    """
+    Marcador de un módulo (o de un nombre dentro de él) que se importa recién
+    al usarlo por primera vez. pandas, openpyxl y el resto de reportlab tardan
+    cerca de un segundo en importarse, que `--help`, el cliente del daemon o
+    `--dividir` no necesitan. Al cargarse se reemplaza a sí mismo en los
+    globales del módulo, así que solo el primer uso pasa por aquí.
+    """
+
+    def __init__(self, alias, modulo, nombre=None):
+        self._alias = alias
+        self._modulo = modulo
+        self._nombre = nombre
+
+    def _cargar(self):
+        objeto = importlib.import_module(self._modulo)
+        if self._nombre:
+            objeto = getattr(objeto, self._nombre)
+        globals()[self._alias] = objeto
+        if self._modulo.startswith('reportlab'):
+            _configurar_reportlab()
+        return objeto
+
+    def __getattr__(self, atributo):
+        return getattr(self._cargar(), atributo)
+
+    def __call__(self, *args, **kwargs):
+        return self._cargar()(*args, **kwargs)
+
+    def __mro_entries__(self, bases):
+        # Heredar de una clase diferida la importa (ver FlowablesFijos)
+        return (self._cargar(),)
+
+
+_DEPENDENCIAS = {
+    'np': ('numpy', None),
+    'pd': ('pandas', None),
+    'Workbook': ('openpyxl', 'Workbook'),
+    'load_workbook': ('openpyxl', 'load_workbook'),
+    'WriteOnlyCell': ('openpyxl.cell', 'WriteOnlyCell'),
+    'Font': ('openpyxl.styles', 'Font'),
+    'Alignment': ('openpyxl.styles', 'Alignment'),
+    'Border': ('openpyxl.styles', 'Border'),
+    'Side': ('openpyxl.styles', 'Side'),
+    'PatternFill': ('openpyxl.styles', 'PatternFill'),
+    'NamedStyle': ('openpyxl.styles', 'NamedStyle'),
+    'XLImage': ('openpyxl.drawing.image', 'Image'),
+    'colors': ('reportlab.lib.colors', None),
+    'getSampleStyleSheet': ('reportlab.lib.styles', 'getSampleStyleSheet'),
+    'ParagraphStyle': ('reportlab.lib.styles', 'ParagraphStyle'),
+    'fp_str': ('reportlab.lib.rl_accel', 'fp_str'),
+    'ImageReader': ('reportlab.lib.utils', 'ImageReader'),
+    'simpleSplit': ('reportlab.lib.utils', 'simpleSplit'),
+    'stringWidth': ('reportlab.pdfbase.pdfmetrics', 'stringWidth'),
+    'canvas': ('reportlab.pdfgen.canvas', None),
+    'SimpleDocTemplate': ('reportlab.platypus', 'SimpleDocTemplate'),
+    'Paragraph': ('reportlab.platypus', 'Paragraph'),
+    'Spacer': ('reportlab.platypus', 'Spacer'),
+    'Image': ('reportlab.platypus', 'Image'),
+    'Table': ('reportlab.platypus', 'Table'),
+    'TableStyle': ('reportlab.platypus', 'TableStyle'),
+    'PILImage': ('PIL.Image', None),
+    'ImageChops': ('PIL.ImageChops', None),
+}
+globals().update({alias: _Diferido(alias, modulo, nombre)
+                  for alias, (modulo, nombre) in _DEPENDENCIAS.items()})
+
+
+def cargar_dependencias():
+    """Importa ya todas las dependencias diferidas (daemon y procesos worker)."""
+    for alias in _DEPENDENCIAS:
+        objeto = globals()[alias]
+        if isinstance(objeto, _Diferido):
+            objeto._cargar()
+
+
 # Configuración de rutas
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOGOS_DIR = os.path.join(BASE_DIR, "imagenes", "logos")
 FIRMAS_DIR = os.path.join(BASE_DIR, "imagenes", "firmas")
 OUTPUT_DIR = "/Users/magda/Documents/informes retidiag"
 PLANTILLA_RESUMEN = os.path.join(BASE_DIR, "plantilla_resumen_pacientes.xls")
+LOGO_RETIDIAG = os.path.join(LOGOS_DIR, "logo_retidiag.jpg")
+
+# Resolución (DPI) a la que se pre-escalan logos y firmas antes de incrustarlos
+DPI_IMAGENES = 300
+
+# Salida compacta (ver usar_salida_compacta): resolución y calidad JPEG de las
+# imágenes; a este tamaño impreso no se distinguen de las normales
+DPI_COMPACTO = 200
+CALIDAD_COMPACTO = 80
+
 
-# Crear directorio de salida si no existe
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+def _configurar_reportlab():
+    """Ajustes globales de reportlab, aplicados al cargar cualquiera de sus módulos."""
+    from reportlab import rl_config
+    # Escribir los streams del PDF en binario: la codificación ASCII85 por defecto
+    # se hace en Python puro y dominaba el tiempo de cada informe
+    rl_config.useA85 = 0
 
 # Mapeo de comunas a logos de establecimientos
 LOGOS_ESTABLECIMIENTO = {
@@ -60,6 +166,12 @@ FIRMAS_TMO = {
     "HÉCTOR VERA": "firma_hector_vera.png",
 }
 
+# Firma de TMO por defecto (cuando no se indica TMO o no está en FIRMAS_TMO)
+FIRMA_TMO_DEFECTO = "firma_tmo_felipe_rojas.jpg"
+
+# Resultados cuyo informe lleva la firma del oftalmólogo (el resto, la del TMO)
+RESULTADOS_FIRMA_OFTALMOLOGO = ('DG NORMAL', 'RD', 'OTROS')
+
 # Textos de diagnóstico según resultado
 TEXTOS_DIAGNOSTICO = {
     "NORMAL": [
@@ -114,6 +226,14 @@ DERIVACIONES = {
     "OTROS": "DERIVAR OFTALMOLOGÍA",
 }
 
+# Columnas de la hoja INPUT que usa el generador
+COLUMNAS_INPUT = [
+    'COMUNA', 'FECHA', 'ESTABLECIMIENTO', 'NOMBRE PACIENTE', 'RUT', 'EDAD',
+    'OBSERVACIONES', 'RESULTADO FINAL', 'DETALLE OD', 'DETALLE OI', 'Derivacion',
+    'OFTALMOLOGO',
+]
+COLUMNAS_REQUERIDAS = ['NOMBRE PACIENTE', 'RUT', 'RESULTADO FINAL']
+
 # Textos para el resumen Excel (columna Diagnóstico)
 TEXTOS_RESUMEN_DIAGNOSTICO = {
     "NORMAL": "Evaluado Normal",
@@ -124,6 +244,96 @@ TEXTOS_RESUMEN_DIAGNOSTICO = {
 }
 
 
+# Instrumentación: tiempo de pared y de CPU acumulado por etapa en este
+# proceso (etapa -> {'llamadas', 'pared', 'cpu'}) y funciones que reciben
+# cada medición (ver registrar_hook_metricas)
+_METRICAS = {}
+_HOOKS_METRICAS = []
+
+
+def registrar_hook_metricas(hook):
+    """Registra hook(etapa, pared, cpu, datos), que se llama al terminar cada etapa medida.
+
+    `pared` y `cpu` están en segundos y `datos` es un dict con información de
+    la etapa (p. ej. filas). Se llama en el proceso donde corre la etapa: con
+    un pool de procesos, las etapas de cada PDF ocurren en los workers (sus
+    totales sí llegan a metricas() del proceso principal).
+    """
+    _HOOKS_METRICAS.append(hook)
+    return hook
+
+
+def quitar_hook_metricas(hook):
+    """Quita un hook registrado con registrar_hook_metricas."""
+    _HOOKS_METRICAS.remove(hook)
+
+
+@contextmanager
+def medir_etapa(etapa, **datos):
+    """Mide el tiempo de pared y de CPU de un bloque y lo acumula en `etapa`."""
+    inicio_pared = time.perf_counter()
+    inicio_cpu = time.process_time()
+    try:
+        yield datos
+    finally:
+        pared = time.perf_counter() - inicio_pared
+        cpu = time.process_time() - inicio_cpu
+        acumulado = _METRICAS.setdefault(etapa, {'llamadas': 0, 'pared': 0.0, 'cpu': 0.0})
+        acumulado['llamadas'] += 1
+        acumulado['pared'] += pared
+        acumulado['cpu'] += cpu
+        for hook in _HOOKS_METRICAS:
+            try:
+                hook(etapa, pared, cpu, datos)
+            except Exception as e:
+                print(f"Aviso: el hook de métricas {hook!r} falló: {e}")
+
+
+def metricas():
+    """Retorna una copia de las métricas acumuladas por etapa."""
+    return {etapa: dict(valores) for etapa, valores in _METRICAS.items()}
+
+
+def reiniciar_metricas():
+    """Borra las métricas acumuladas."""
+    _METRICAS.clear()
+
+
+def _tarea_medida(funcion, tarea):
+    """Ejecuta funcion(tarea) en un worker; retorna (resultado, etapas medidas durante la tarea).
+
+    Las etapas se entregan como diferencia con lo acumulado antes en el
+    worker (que puede traer, heredadas, las del proceso principal).
+    """
+    antes = metricas()
+    resultado = funcion(tarea)
+    etapas = {}
+    for etapa, valores in _METRICAS.items():
+        previos = antes.get(etapa)
+        if previos is None:
+            etapas[etapa] = dict(valores)
+        elif valores['llamadas'] != previos['llamadas']:
+            etapas[etapa] = {clave: valor - previos[clave] for clave, valor in valores.items()}
+    return resultado, etapas
+
+
+def _sumar_metricas(resultados):
+    """Suma a las métricas de este proceso las etapas de cada (resultado, etapas) de _tarea_medida.
+
+    Entrega solo los resultados. Los hooks no se llaman de nuevo: ya se
+    llamaron en el worker.
+    """
+    try:
+        for resultado, etapas in resultados:
+            for etapa, valores in etapas.items():
+                acumulado = _METRICAS.setdefault(etapa, {'llamadas': 0, 'pared': 0.0, 'cpu': 0.0})
+                for clave, valor in valores.items():
+                    acumulado[clave] += valor
+            yield resultado
+    finally:
+        resultados.close()
+
+
 def crear_estilos():
     """Crea y retorna los estilos para el PDF."""
     styles = getSampleStyleSheet()
@@ -214,183 +424,772 @@ def formatear_fecha(fecha):
         return str(fecha)
 
 
+def fecha_iso(valor):
+    """Convierte un texto con fecha ISO (2026-01-16) a datetime, como las fechas que
+    entrega pandas al leer el Excel; cualquier otro valor queda igual (se muestra tal cual)."""
+    if isinstance(valor, str):
+        try:
+            return datetime.fromisoformat(valor.strip())
+        except ValueError:
+            pass
+    return valor
+
+
 def formatear_rut(rut):
     """Asegura que el RUT tenga formato correcto."""
     if pd.isna(rut):
         return ""
+    if isinstance(rut, float) and rut.is_integer():
+        # RUT sin dígito verificador leído como número (12345678.0)
+        return str(int(rut))
     return str(rut).strip()
 
 
+def normalizar_nombre(texto):
+    """Forma canónica de una comuna o firmante para buscarlo en los mapeos de imágenes.
+
+    Sin tildes, en mayúsculas, sin puntos y con DOCTOR/DOCTORA abreviados:
+    'Dra Eltit', 'DRA. ELTIT' y 'Doctora Eltit' quedan igual.
+    """
+    texto = unicodedata.normalize('NFKD', str(texto)).encode('ascii', 'ignore').decode('ascii')
+    texto = re.sub(r'[.\s]+', ' ', texto.upper()).strip()
+    return re.sub(r'\bDOCTOR(A?)\b', r'DR\1', texto)
+
+
+class RegistroImagenes:
+    """Logos y firmas indexados por nombre normalizado.
+
+    Se arma una sola vez por proceso (ver registro_imagenes): verifica que
+    existan los archivos de LOGOS_ESTABLECIMIENTO, FIRMAS_OFTALMOLOGO y
+    FIRMAS_TMO y compila los nombres de cada mapeo de firmas en una sola
+    expresión regular. Cada valor distinto de COMUNA u OFTALMOLOGO se
+    resuelve una vez y queda recordado.
+    """
+
+    def __init__(self):
+        self.faltantes = []  # archivos mapeados que no existen
+        self.logo_retidiag = self._archivo(LOGO_RETIDIAG)
+        self.logos = {normalizar_nombre(comuna): self._archivo(os.path.join(LOGOS_DIR, archivo))
+                      for comuna, archivo in LOGOS_ESTABLECIMIENTO.items()}
+        self.firma_tmo_defecto = self._archivo(os.path.join(FIRMAS_DIR, FIRMA_TMO_DEFECTO))
+        self._oftalmologos = self._compilar_firmas(FIRMAS_OFTALMOLOGO)
+        self._tmos = self._compilar_firmas(FIRMAS_TMO)
+        self._por_comuna = {}
+        self._por_oftalmologo = {}
+        self._por_tmo = {}
+
+    def _archivo(self, ruta):
+        if os.path.exists(ruta):
+            return ruta
+        if ruta not in self.faltantes:
+            self.faltantes.append(ruta)
+        return None
+
+    def _compilar_firmas(self, mapeo):
+        """Retorna (patrón, {nombre normalizado: (prioridad, ruta)}) de un mapeo de firmas.
+
+        Solo entran las firmas cuyo archivo existe; si un nombre calza con
+        varias, gana la que aparece antes en el mapeo.
+        """
+        claves = {}
+        for prioridad, (nombre, archivo) in enumerate(mapeo.items()):
+            ruta = self._archivo(os.path.join(FIRMAS_DIR, archivo))
+            if ruta:
+                claves.setdefault(normalizar_nombre(nombre), (prioridad, ruta))
+        if not claves:
+            return None, claves
+        alternativas = '|'.join(re.escape(clave) for clave in sorted(claves, key=len, reverse=True))
+        return re.compile(rf'\b(?:{alternativas})\b'), claves
+
+    @staticmethod
+    def _buscar_firma(firmas, nombre):
+        patron, claves = firmas
+        if patron is None or not nombre:
+            return None
+        encontradas = [claves[m.group()] for m in patron.finditer(normalizar_nombre(nombre))]
+        return min(encontradas)[1] if encontradas else None
+
+    def logo(self, comuna):
+        """Ruta del logo de la comuna, o None si no tiene."""
+        try:
+            return self._por_comuna[comuna]
+        except KeyError:
+            ruta = self._por_comuna[comuna] = self.logos.get(normalizar_nombre(comuna)) if comuna else None
+            return ruta
+
+    def firma_oftalmologo(self, nombre):
+        """Ruta de la firma del oftalmólogo, o None si no se reconoce el nombre."""
+        try:
+            return self._por_oftalmologo[nombre]
+        except KeyError:
+            ruta = self._por_oftalmologo[nombre] = self._buscar_firma(self._oftalmologos, nombre)
+            return ruta
+
+    def firma_tmo(self, nombre=None):
+        """Ruta de la firma del TMO (la de FIRMA_TMO_DEFECTO si no se indica o no se reconoce)."""
+        try:
+            return self._por_tmo[nombre]
+        except KeyError:
+            ruta = self._buscar_firma(self._tmos, nombre) or self.firma_tmo_defecto
+            self._por_tmo[nombre] = ruta
+            return ruta
+
+
+_REGISTRO_IMAGENES = None
+
+
+def registro_imagenes():
+    """Retorna el RegistroImagenes del proceso (se arma la primera vez)."""
+    global _REGISTRO_IMAGENES
+    if _REGISTRO_IMAGENES is None:
+        _REGISTRO_IMAGENES = RegistroImagenes()
+    return _REGISTRO_IMAGENES
+
+
+def avisar_imagenes_faltantes():
+    """Avisa qué imágenes de los mapeos de logos y firmas no existen en imagenes/."""
+    registro = registro_imagenes()
+    if registro.faltantes:
+        print("Aviso: faltan imágenes: " + ", ".join(os.path.relpath(ruta, BASE_DIR)
+                                                    for ruta in registro.faltantes))
+
+
+class AvisosStreaming:
+    """Avisos del modo streaming, a medida que se leen las filas.
+
+    En streaming no hay validación previa del archivo (validar_entrada):
+    cada comuna sin logo, oftalmólogo sin firma y RUT que ya tiene otro
+    informe ese año en el historial se avisa la primera vez que aparece,
+    mientras se generan los informes. Sin estos avisos el informe sale
+    igual, pero sin logo del establecimiento o con la firma en blanco.
+    """
+
+    def __init__(self, historial=None, maximo=20):
+        self.registro = registro_imagenes()
+        self.historial = historial
+        self.maximo = maximo
+        self.comunas = set()
+        self.oftalmologos = set()
+        self.ruts = set()
+        self.informados = 0
+
+    def revisar(self, paciente):
+        """Avisa lo que la fila de `paciente` trae por primera vez."""
+        comuna = paciente.comuna
+        if comuna not in self.comunas:
+            self.comunas.add(comuna)
+            if self.registro.logo(comuna) is None:
+                print(f"Aviso: comuna sin logo de establecimiento: {self._valor(comuna)} "
+                      f"(desde {paciente.nombre})")
+        oftalmologo = paciente.oftalmologo
+        if paciente.resultado in RESULTADOS_FIRMA_OFTALMOLOGO and oftalmologo not in self.oftalmologos:
+            self.oftalmologos.add(oftalmologo)
+            if self.registro.firma_oftalmologo(oftalmologo) is None:
+                print(f"Aviso: oftalmólogo sin firma (el informe sale con la firma en blanco): "
+                      f"{self._valor(oftalmologo)} (desde {paciente.nombre})")
+        if self.historial is not None:
+            rut = normalizar_rut(paciente.rut)
+            if rut and rut not in self.ruts:
+                self.ruts.add(rut)
+                informes = self.historial.ya_informados([paciente]).get(rut)
+                if informes:
+                    self.informados += 1
+                    if self.informados <= self.maximo:
+                        print(f"Aviso: {rut} ya tiene otro informe este año en el historial: " +
+                              "; ".join(f"{fecha} {establecimiento} ({resultado})"
+                                        for fecha, establecimiento, resultado in informes))
+
+    @staticmethod
+    def _valor(valor):
+        return f"'{valor}'" if valor else "vacío"
+
+    def resumir(self):
+        """Al terminar, cuántos RUT ya informados no se listaron."""
+        if self.informados > self.maximo:
+            print(f"Aviso: {self.informados} RUT ya tenían otro informe este año en el historial "
+                  f"(se listaron los primeros {self.maximo})")
+
+
 def obtener_logo_establecimiento(comuna):
     """Obtiene la ruta del logo según la comuna."""
     if pd.isna(comuna):
         return None
-    comuna_upper = str(comuna).upper().strip()
-    if comuna_upper in LOGOS_ESTABLECIMIENTO:
-        logo_path = os.path.join(LOGOS_DIR, LOGOS_ESTABLECIMIENTO[comuna_upper])
-        if os.path.exists(logo_path):
-            return logo_path
-    return None
+    return registro_imagenes().logo(comuna)
 
 
 def obtener_firma_oftalmologo(nombre_oftalmologo):
     """Obtiene la ruta de la firma del oftalmólogo."""
     if pd.isna(nombre_oftalmologo):
         return None
-    nombre_upper = str(nombre_oftalmologo).upper().strip()
-    for key, firma in FIRMAS_OFTALMOLOGO.items():
-        if key in nombre_upper:
-            firma_path = os.path.join(FIRMAS_DIR, firma)
-            if os.path.exists(firma_path):
-                return firma_path
-    return None
+    return registro_imagenes().firma_oftalmologo(nombre_oftalmologo)
 
 
 def obtener_firma_tmo(nombre_tmo=None):
     """Obtiene la ruta de la firma del TMO."""
-    # Por defecto usar firma de Felipe Rojas
-    firma_default = os.path.join(FIRMAS_DIR, "firma_tmo_felipe_rojas.jpg")
-
-    if nombre_tmo and not pd.isna(nombre_tmo):
-        nombre_upper = str(nombre_tmo).upper().strip()
-        for key, firma in FIRMAS_TMO.items():
-            if key in nombre_upper:
-                firma_path = os.path.join(FIRMAS_DIR, firma)
-                if os.path.exists(firma_path):
-                    return firma_path
-
-    if os.path.exists(firma_default):
-        return firma_default
-    return None
+    if nombre_tmo is not None and pd.isna(nombre_tmo):
+        nombre_tmo = None
+    return registro_imagenes().firma_tmo(nombre_tmo)
 
 
-def generar_pdf(paciente, output_path, styles):
-    """Genera el PDF para un paciente."""
+# Salida compacta activa en este proceso (los workers la reciben al inicializarse)
+_SALIDA_COMPACTA = False
 
-    doc = SimpleDocTemplate(
-        output_path,
-        pagesize=letter,
-        rightMargin=2*cm,
-        leftMargin=2*cm,
-        topMargin=1.5*cm,
-        bottomMargin=2*cm,
+
+def usar_salida_compacta(activar=True):
+    """Activa o desactiva la salida compacta en este proceso.
+
+    En modo compacto las imágenes se incrustan a DPI_COMPACTO con calidad
+    CALIDAD_COMPACTO y tablas Huffman optimizadas, y las que son grises
+    (firmas en tinta negra) en escala de grises: los PDFs quedan cerca de
+    la mitad de tamaño. Las streams de página ya van comprimidas y los
+    recursos repetidos (imágenes, plantillas) ya se incrustan una vez por
+    archivo.
+    """
+    global _SALIDA_COMPACTA
+    _SALIDA_COMPACTA = bool(activar)
+
+
+# Caché de imágenes decodificadas y pre-escaladas: (ruta, ancho, alto, compacta) -> bytes JPEG
+_CACHE_IMAGENES = {}
+
+
+def _es_gris(img, tolerancia=8):
+    """True si los tres canales de una imagen RGB son (casi) iguales."""
+    r, g, b = img.split()
+    return max(ImageChops.difference(r, g).getextrema()[1],
+               ImageChops.difference(g, b).getextrema()[1]) <= tolerancia
+
+
+def cargar_imagen(ruta, ancho, alto):
+    """Carga una imagen una sola vez, escalada al tamaño en que se dibuja.
+
+    La imagen se reduce a DPI_IMAGENES (DPI_COMPACTO en salida compacta)
+    para el ancho y alto indicados (en puntos), se aplana sobre fondo
+    blanco y se guarda como JPEG, que reportlab incrusta sin volver a
+    decodificar.
+    """
+    compacta = _SALIDA_COMPACTA
+    clave = (ruta, round(ancho, 2), round(alto, 2), compacta)
+    datos = _CACHE_IMAGENES.get(clave)
+    if datos is None:
+        dpi = DPI_COMPACTO if compacta else DPI_IMAGENES
+        with medir_etapa('pdf.imagenes'), PILImage.open(ruta) as img:
+            img = img.convert('RGBA')
+            fondo = PILImage.new('RGB', img.size, (255, 255, 255))
+            fondo.paste(img, mask=img.getchannel('A'))
+            ancho_px = min(fondo.width, round(ancho / inch * dpi))
+            alto_px = min(fondo.height, round(alto / inch * dpi))
+            if (ancho_px, alto_px) != fondo.size:
+                fondo = fondo.resize((ancho_px, alto_px), PILImage.LANCZOS)
+            buffer = io.BytesIO()
+            if compacta:
+                if _es_gris(fondo):
+                    fondo = fondo.convert('L')
+                fondo.save(buffer, format='JPEG', quality=CALIDAD_COMPACTO, optimize=True)
+            else:
+                fondo.save(buffer, format='JPEG', quality=90)
+            datos = buffer.getvalue()
+        _CACHE_IMAGENES[clave] = datos
+    return datos
+
+
+# Caché de ImageReader por (ruta, ancho, alto, compacta): reportlab decodifica
+# cada ImageReader una sola vez, aunque se use en muchos documentos
+_CACHE_LECTORES = {}
+
+
+def lector_imagen(ruta, ancho, alto):
+    """Retorna el ImageReader (en caché) de una imagen pre-escalada."""
+    clave = (ruta, round(ancho, 2), round(alto, 2), _SALIDA_COMPACTA)
+    lector = _CACHE_LECTORES.get(clave)
+    if lector is None:
+        lector = _CACHE_LECTORES[clave] = ImageReader(io.BytesIO(cargar_imagen(ruta, ancho, alto)))
+    return lector
+
+
+def normalizar_resultado(resultado):
+    """Normaliza el RESULTADO FINAL a una de las claves de TEXTOS_DIAGNOSTICO."""
+    resultado = str(resultado).upper().strip() if not pd.isna(resultado) else 'NORMAL'
+
+    if resultado in ['DG NORMAL', 'DGNORMAL']:
+        resultado = 'DG NORMAL'
+    elif 'NORMAL' in resultado and resultado != 'DG NORMAL':
+        resultado = 'NORMAL'
+    elif 'CATARATA' in resultado:
+        resultado = 'CATARATA'
+    elif resultado in ['RD', 'RETINOPATIA', 'RETINOPATÍA']:
+        resultado = 'RD'
+    elif resultado not in TEXTOS_DIAGNOSTICO:
+        resultado = 'OTROS'
+    return resultado
+
+
+def formatear_edad(edad):
+    """Convierte la edad a texto entero ('' si falta o no es numérica)."""
+    if pd.isna(edad):
+        return ""
+    try:
+        return str(int(float(edad)))
+    except (TypeError, ValueError):
+        return ""
+
+
+def _texto(valor):
+    """Texto limpio de una celda ('' si está vacía)."""
+    return str(valor).strip() if not pd.isna(valor) else ''
+
+
+class Paciente:
+    """Datos ya normalizados de un paciente, listos para el informe y el resumen."""
+
+    __slots__ = (
+        'nombre', 'rut', 'edad', 'fecha', 'institucion', 'comuna', 'resultado',
+        'observaciones', 'detalle_od', 'detalle_oi', 'derivacion', 'oftalmologo',
+        'resultado_final',
     )
 
-    elements = []
+    def __init__(self, nombre='', rut='', edad='', fecha='', institucion='', comuna='',
+                 resultado='NORMAL', observaciones='', detalle_od='', detalle_oi='',
+                 derivacion='', oftalmologo='', resultado_final=''):
+        self.nombre = nombre
+        self.rut = rut
+        self.edad = edad
+        self.fecha = fecha
+        self.institucion = institucion
+        self.comuna = comuna
+        self.resultado = resultado
+        self.observaciones = observaciones
+        self.detalle_od = detalle_od
+        self.detalle_oi = detalle_oi
+        self.derivacion = derivacion
+        self.oftalmologo = oftalmologo
+        # RESULTADO FINAL tal como viene en la hoja ('GLAUCOMA'); `resultado`
+        # es su categoría (carpeta y plantilla del informe)
+        self.resultado_final = resultado_final
+
+    @classmethod
+    def desde_dict(cls, fila):
+        """Normaliza una fila suelta (dict con las columnas de INPUT)."""
+        return cls(
+            nombre=_texto(fila.get('NOMBRE PACIENTE')),
+            rut=formatear_rut(fila.get('RUT')),
+            edad=formatear_edad(fila.get('EDAD')),
+            fecha=formatear_fecha(fila.get('FECHA')),
+            institucion=_texto(fila.get('ESTABLECIMIENTO')),
+            comuna=_texto(fila.get('COMUNA')),
+            resultado=normalizar_resultado(fila.get('RESULTADO FINAL')),
+            observaciones=_texto(fila.get('OBSERVACIONES')),
+            detalle_od=_texto(fila.get('DETALLE OD')),
+            detalle_oi=_texto(fila.get('DETALLE OI')),
+            derivacion=_texto(fila.get('Derivacion')),
+            oftalmologo=_texto(fila.get('OFTALMOLOGO')),
+            resultado_final=_texto(fila.get('RESULTADO FINAL')),
+        )
 
-    # === OBTENER DATOS DEL PACIENTE PRIMERO (para logo establecimiento) ===
-    nombre = str(paciente.get('NOMBRE PACIENTE', '')).strip() if not pd.isna(paciente.get('NOMBRE PACIENTE')) else ''
-    rut = formatear_rut(paciente.get('RUT', ''))
-    edad = str(int(paciente.get('EDAD', 0))) if not pd.isna(paciente.get('EDAD')) else ''
-    fecha = formatear_fecha(paciente.get('FECHA', ''))
-    institucion = str(paciente.get('ESTABLECIMIENTO', '')).strip() if not pd.isna(paciente.get('ESTABLECIMIENTO')) else ''
-    comuna = str(paciente.get('COMUNA', '')).strip() if not pd.isna(paciente.get('COMUNA')) else ''
 
-    # Logo del establecimiento
-    logo_establecimiento = obtener_logo_establecimiento(comuna)
+def registro_paciente(paciente):
+    """Retorna el Paciente normalizado (acepta también un dict con las columnas de INPUT)."""
+    return paciente if isinstance(paciente, Paciente) else Paciente.desde_dict(paciente)
+
+
+def normalizar_pacientes(df):
+    """Normaliza todas las columnas de una vez y retorna una lista de Paciente.
+
+    Las columnas de texto libre se limpian con operaciones vectorizadas; las
+    que se repiten mucho (COMUNA, ESTABLECIMIENTO, FECHA, RESULTADO FINAL,
+    OFTALMOLOGO) se pasan a dtype category y se normaliza cada categoría
+    una sola vez.
+    """
+    df = df.reindex(columns=COLUMNAS_INPUT)
+
+    def texto(col):
+        serie = df[col]
+        return serie.astype(object).where(serie.notna(), '').astype(str).str.strip().tolist()
+
+    def categoria(col, normalizar):
+        codigos = df[col].astype('category').cat
+        valores = [normalizar(v) for v in codigos.categories] + [normalizar(None)]
+        # El código -1 (celda vacía) toma el último valor
+        return pd.Categorical(np.asarray(valores, dtype=object)[codigos.codes]).tolist()
+
+    rut = df['RUT']
+    if pd.api.types.is_float_dtype(rut) and (rut.dropna() % 1 == 0).all():
+        rut = np.where(rut.notna(), rut.map('{:.0f}'.format), '').tolist()
+    else:
+        rut = rut.map(formatear_rut).tolist()
+
+    edad = pd.to_numeric(df['EDAD'], errors='coerce')
+    edad = np.where(edad.notna(), edad.fillna(0).astype('int64').astype(str), '').tolist()
 
-    # === ENCABEZADO ===
-    logo_retidiag = os.path.join(LOGOS_DIR, "logo_retidiag.jpg")
+    return [Paciente(*campos) for campos in zip(
+        texto('NOMBRE PACIENTE'),
+        rut,
+        edad,
+        categoria('FECHA', formatear_fecha),
+        categoria('ESTABLECIMIENTO', _texto),
+        categoria('COMUNA', _texto),
+        categoria('RESULTADO FINAL', normalizar_resultado),
+        texto('OBSERVACIONES'),
+        texto('DETALLE OD'),
+        texto('DETALLE OI'),
+        texto('Derivacion'),
+        categoria('OFTALMOLOGO', _texto),
+        categoria('RESULTADO FINAL', _texto),
+    )]
 
-    # Columna izquierda: datos de la empresa
-    empresa_text = """
+
+# Validación de las filas antes de generar (validar_pacientes)
+FORMATOS_FECHA = ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%d.%m.%Y")
+EDAD_MAXIMA = 120
+
+
+def _digito_rut(cuerpo):
+    """Dígito verificador (módulo 11) de la parte numérica de un RUT."""
+    suma = sum(int(digito) * (2 + i % 6) for i, digito in enumerate(reversed(cuerpo)))
+    return '0123456789K0'[11 - suma % 11]
+
+
+def rut_valido(rut):
+    """Si el RUT tiene forma de RUT y, cuando trae guión, si calza el dígito verificador.
+
+    Un RUT sin guión (o leído como número) se acepta si son solo dígitos:
+    no se sabe si el último es el verificador.
+    """
+    if isinstance(rut, (int, float, np.integer, np.floating)):
+        return float(rut).is_integer()
+    texto = re.sub(r'[.\s]', '', str(rut)).upper()
+    cuerpo, guion, digito = texto.rpartition('-')
+    if not guion:
+        return texto.isdigit()
+    return cuerpo.isdigit() and len(digito) == 1 and _digito_rut(cuerpo) == digito
+
+
+def _fecha_valida(fecha):
+    """Si la FECHA es una fecha: celda de fecha o texto en uno de FORMATOS_FECHA."""
+    if not isinstance(fecha, str):
+        return hasattr(fecha, 'strftime')
+    for formato in FORMATOS_FECHA:
+        try:
+            datetime.strptime(fecha.strip(), formato)
+            return True
+        except ValueError:
+            pass
+    return False
+
+
+def validar_pacientes(df):
+    """Revisa todas las filas de una vez y retorna los problemas encontrados.
+
+    Cada revisión es una operación sobre la columna completa; las columnas
+    se pasan a dtype category y cada valor distinto se revisa una sola vez,
+    como en normalizar_pacientes. Retorna una lista de (problema, filas,
+    valores), con las filas numeradas como en el Excel (la 1 es la de los
+    encabezados). Los problemas no impiden generar: el informe sale igual,
+    pero con un dato en blanco, en otra carpeta o con otro diagnóstico.
+    """
+    df = df.reindex(columns=COLUMNAS_INPUT)
+    filas = df.index.to_numpy() + 2
+    registro = registro_imagenes()
+    problemas = []
+
+    def anotar(problema, mascara, col):
+        mascara = np.asarray(mascara, dtype=bool)
+        if mascara.any():
+            problemas.append((problema, filas[mascara].tolist(), df[col][mascara].tolist()))
+
+    def por_valor(col, funcion):
+        codigos = df[col].astype('category').cat
+        valores = [funcion(v) for v in codigos.categories] + [funcion(None)]
+        # El código -1 (celda vacía) toma el último valor
+        return np.asarray(valores, dtype=object)[codigos.codes]
+
+    def vacia(col):
+        return por_valor(col, lambda valor: not _texto(valor))
+
+    anotar("Falta el RUT", vacia('RUT'), 'RUT')
+    anotar("RUT inválido o con dígito verificador que no calza",
+           por_valor('RUT', lambda rut: bool(_texto(rut)) and not rut_valido(rut)), 'RUT')
+
+    edad = pd.to_numeric(df['EDAD'], errors='coerce')
+    anotar("EDAD no numérica (el informe sale sin edad)", edad.isna() & ~vacia('EDAD').astype(bool), 'EDAD')
+    anotar(f"EDAD fuera de rango (0 a {EDAD_MAXIMA})", (edad < 0) | (edad > EDAD_MAXIMA), 'EDAD')
+
+    anotar("Falta la FECHA (la carpeta queda con la fecha de hoy)", vacia('FECHA'), 'FECHA')
+    anotar("FECHA que no se reconoce como fecha",
+           por_valor('FECHA', lambda fecha: bool(_texto(fecha)) and not _fecha_valida(fecha)), 'FECHA')
+    anotar("Falta el ESTABLECIMIENTO", vacia('ESTABLECIMIENTO'), 'ESTABLECIMIENTO')
+    anotar("COMUNA sin logo de establecimiento",
+           por_valor('COMUNA', lambda comuna: registro.logo(_texto(comuna)) is None), 'COMUNA')
+
+    resultado = por_valor('RESULTADO FINAL', normalizar_resultado)
+    anotar("Falta el RESULTADO FINAL (queda como NORMAL)", df['RESULTADO FINAL'].isna(), 'RESULTADO FINAL')
+    anotar("RESULTADO FINAL no reconocido (queda como OTROS)",
+           (resultado == 'OTROS') & por_valor('RESULTADO FINAL', lambda valor: _texto(valor).upper() != 'OTROS')
+           & df['RESULTADO FINAL'].notna().to_numpy(), 'RESULTADO FINAL')
+    sin_firma = por_valor('OFTALMOLOGO', lambda nombre: registro.firma_oftalmologo(_texto(nombre)) is None)
+    anotar("OFTALMOLOGO sin firma (el informe sale con la firma en blanco)",
+           sin_firma & np.isin(resultado, RESULTADOS_FIRMA_OFTALMOLOGO), 'OFTALMOLOGO')
+    return problemas
+
+
+def _texto_filas(filas):
+    """'fila 3' o 'filas 3, 5-9, 12' (las filas seguidas van como rango)."""
+    tramos = []
+    for fila in sorted(set(filas)):
+        if tramos and fila == tramos[-1][1] + 1:
+            tramos[-1][1] = fila
+        else:
+            tramos.append([fila, fila])
+    texto = ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in tramos)
+    return f"{'fila' if len(filas) == 1 else 'filas'} {texto}"
+
+
+def imprimir_validacion(problemas, nombre, avisar_sin_problemas=True):
+    """Imprime los problemas de validar_pacientes, cada uno con sus filas agrupadas por valor."""
+    if not problemas:
+        if avisar_sin_problemas:
+            print(f"✓ Validación de {nombre}: sin problemas")
+        return
+    total = sum(len(filas) for _, filas, _ in problemas)
+    n_filas = len({fila for _, filas, _ in problemas for fila in filas})
+    print(f"Validación de {nombre}: {total} {'problema' if total == 1 else 'problemas'} en "
+          f"{n_filas} {'fila' if n_filas == 1 else 'filas'}:")
+    for problema, filas, valores in problemas:
+        por_valor = {}
+        for fila, valor in zip(filas, valores):
+            por_valor.setdefault(_texto(valor), []).append(fila)
+        if list(por_valor) == ['']:
+            detalle = _texto_filas(filas)
+        else:
+            detalle = "; ".join(f"'{valor}' en {_texto_filas(filas_valor)}" if valor else
+                                f"vacío en {_texto_filas(filas_valor)}"
+                                for valor, filas_valor in por_valor.items())
+        print(f"  - {problema} ({len(filas)}): {detalle}")
+
+
+def validar_entrada(df, nombre, avisar_sin_problemas=True):
+    """Valida las filas leídas de un archivo e imprime los problemas; retorna cuántas filas los tienen."""
+    with medir_etapa('validacion', filas=len(df)) as datos:
+        problemas = validar_pacientes(df)
+        datos['problemas'] = sum(len(filas) for _, filas, _ in problemas)
+    imprimir_validacion(problemas, nombre, avisar_sin_problemas)
+    return len({fila for _, filas, _ in problemas for fila in filas})
+
+
+# Texto de la empresa en el encabezado del informe (generar_pdf)
+EMPRESA_TEXTO = """
     <font size="8" color="#333333">www.retidiag.com<br/>
     Hernando de Aguirre 128 Of. 904<br/>
     Fono: 24816886/7<br/>
     Providencia, Santiago</font>
     """
 
-    # Logo Retidiag
-    if os.path.exists(logo_retidiag):
-        logo_retidiag_img = Image(logo_retidiag, width=4*cm, height=1.2*cm)
-    else:
-        logo_retidiag_img = Paragraph("RETIDIAG", styles['Titulo'])
 
-    # Logo del establecimiento en el encabezado
-    if logo_establecimiento:
-        logo_est_img = Image(logo_establecimiento, width=2.5*cm, height=1.8*cm)
-        # Tabla con 3 columnas: empresa, logo retidiag, logo establecimiento
-        encabezado_table = Table(
-            [[Paragraph(empresa_text, styles['Empresa']), logo_retidiag_img, logo_est_img]],
-            colWidths=[9*cm, 5*cm, 3*cm]
-        )
-        encabezado_table.setStyle(TableStyle([
+class _QuiebreFijo:
+    """Para párrafos de texto fijo: recuerda el quiebre de líneas de cada ancho.
+
+    Las copias (copy.copy) de un mismo párrafo comparten el diccionario
+    `_quiebres`, así el texto se parte en líneas una sola vez por proceso.
+    El quiebre solo depende del ancho (Paragraph.wrap no mira el alto). Al
+    partir el párrafo entre páginas la copia rehace su propio quiebre, porque
+    split modifica las líneas; las mitades no usan la caché.
+    """
+
+    _quiebres = None
+
+    def wrap(self, availWidth, availHeight):
+        if self._quiebres is None:
+            return super().wrap(availWidth, availHeight)
+        quiebre = self._quiebres.get(availWidth)
+        if quiebre is None:
+            super().wrap(availWidth, availHeight)
+            quiebre = self._quiebres[availWidth] = (self.width, self._wrapWidths, self.blPara, self.height)
+        self.width, self._wrapWidths, self.blPara, self.height = quiebre
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        self._quiebres = None
+        self.wrap(availWidth, availHeight)
+        return super().split(availWidth, availHeight)
+
+
+class FlowablesFijos:
+    """Texto fijo de generar_pdf, preparado una vez por proceso.
+
+    Los párrafos fijos (empresa, título, introducción, textos y sugerencias
+    de cada diagnóstico, etiquetas de la tabla del paciente, cargos de la
+    firma y cierre) se parsean una sola vez; cada informe usa una copia que
+    también comparte el quiebre de líneas. Los TableStyle se crean una vez,
+    pero las tablas (encabezado, línea separadora y bloque de firma) y sus
+    imágenes se arman de nuevo en cada informe: platypus guarda en ellas
+    estado del documento (por ejemplo, si quedaron para la página
+    siguiente) y no se pueden compartir entre informes. Las imágenes sí
+    comparten el ImageReader, que se decodifica una vez por proceso.
+    """
+
+    def __init__(self, styles):
+        class ParrafoFijo(_QuiebreFijo, Paragraph):
+            pass
+
+        class ImagenFija(Image):
+            """Image que dibuja un ImageReader de lector_imagen, ya decodificado."""
+
+            def __init__(self, lector, ancho, alto):
+                self._img = lector
+                super().__init__(lector.fp, width=ancho, height=alto)
+
+        self.styles = styles
+        self.clase_parrafo = ParrafoFijo
+        self.clase_imagen = ImagenFija
+        self.parrafos = {}
+        self.estilo_datos = TableStyle([
+            ('ALIGN', (0, 0), (0, -1), 'RIGHT'),
+            ('ALIGN', (2, 0), (2, -1), 'RIGHT'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+            ('TOPPADDING', (0, 0), (-1, -1), 3),
+        ])
+        self.estilo_separador = TableStyle([('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#2c5282'))])
+        # Encabezado con 3 columnas (empresa, logo retidiag, logo establecimiento) o con 2
+        self.estilo_encabezado_logo = TableStyle([
             ('ALIGN', (0, 0), (0, 0), 'LEFT'),
             ('ALIGN', (1, 0), (1, 0), 'CENTER'),
             ('ALIGN', (2, 0), (2, 0), 'RIGHT'),
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ]))
-    else:
-        # Tabla con 2 columnas: empresa, logo retidiag
-        encabezado_table = Table(
-            [[Paragraph(empresa_text, styles['Empresa']), logo_retidiag_img]],
-            colWidths=[12*cm, 5*cm]
-        )
-        encabezado_table.setStyle(TableStyle([
+        ])
+        self.estilo_encabezado = TableStyle([
             ('ALIGN', (0, 0), (0, 0), 'LEFT'),
             ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
             ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ]))
+        ])
+        self.estilo_firma = TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ])
+        self.estilo_contenedor_firma = TableStyle([
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ])
+
+    def parrafo(self, texto, estilo):
+        """Copia del párrafo `texto` con el estilo `estilo` (nombre en styles)."""
+        prototipo = self.parrafos.get((texto, estilo))
+        if prototipo is None:
+            prototipo = self.parrafos[texto, estilo] = self.clase_parrafo(texto, self.styles[estilo])
+            prototipo._quiebres = {}
+        return copy.copy(prototipo)
+
+    def imagen(self, ruta, ancho, alto):
+        """Flowable nuevo de la imagen `ruta`; el ImageReader (y sus datos) es el de la caché."""
+        return self.clase_imagen(lector_imagen(ruta, ancho, alto), ancho, alto)
+
+    def separador(self):
+        """Línea separadora bajo los datos del paciente."""
+        return Table([['']], colWidths=[17*cm], rowHeights=[0.5*mm], style=self.estilo_separador)
+
+    def encabezado(self, logo_establecimiento):
+        """Tabla del encabezado: datos de la empresa, logo Retidiag y logo del establecimiento."""
+        logo_retidiag = registro_imagenes().logo_retidiag
+        if logo_retidiag:
+            logo_retidiag_img = self.imagen(logo_retidiag, 4*cm, 1.2*cm)
+        else:
+            logo_retidiag_img = self.parrafo("RETIDIAG", 'Titulo')
+
+        empresa = self.parrafo(EMPRESA_TEXTO, 'Empresa')
+        if logo_establecimiento:
+            logo_est_img = self.imagen(logo_establecimiento, 2.5*cm, 1.8*cm)
+            return Table([[empresa, logo_retidiag_img, logo_est_img]], colWidths=[9*cm, 5*cm, 3*cm],
+                         style=self.estilo_encabezado_logo)
+        return Table([[empresa, logo_retidiag_img]], colWidths=[12*cm, 5*cm], style=self.estilo_encabezado)
 
-    elements.append(encabezado_table)
+    def firma(self, cargo, firma):
+        """Bloque de firma centrado: imagen de `firma` (o espacio en blanco) y el cargo debajo."""
+        firma_img = self.imagen(firma, 4*cm, 2.5*cm) if firma else Spacer(1, 2.5*cm)
+        firma_table = Table([[firma_img], [self.parrafo(cargo, 'Valor')]], colWidths=[4*cm],
+                            style=self.estilo_firma)
+        # Centrar la tabla de firma en el documento
+        return Table([[firma_table]], colWidths=[17*cm], style=self.estilo_contenedor_firma)
+
+
+_FLOWABLES_FIJOS = None
+
+
+def flowables_fijos(styles):
+    """FlowablesFijos del proceso para `styles` (se arman de nuevo si cambian los estilos)."""
+    global _FLOWABLES_FIJOS
+    if _FLOWABLES_FIJOS is None or _FLOWABLES_FIJOS.styles is not styles:
+        _FLOWABLES_FIJOS = FlowablesFijos(styles)
+    return _FLOWABLES_FIJOS
+
+
+def generar_pdf(paciente, output_path, styles):
+    """Genera el PDF para un paciente.
+
+    El texto fijo sale de flowables_fijos(styles): solo los datos del
+    paciente se parsean y maquetan en cada informe.
+    """
+
+    doc = SimpleDocTemplate(
+        output_path,
+        pagesize=letter,
+        rightMargin=2*cm,
+        leftMargin=2*cm,
+        topMargin=1.5*cm,
+        bottomMargin=2*cm,
+    )
+    fijos = flowables_fijos(styles)
+
+    elements = []
+
+    # === OBTENER DATOS DEL PACIENTE PRIMERO (para logo establecimiento) ===
+    datos = registro_paciente(paciente)
+    nombre = datos.nombre
+    rut = datos.rut
+    edad = datos.edad
+    fecha = datos.fecha
+    institucion = datos.institucion
+    comuna = datos.comuna
+
+    # === ENCABEZADO (con el logo del establecimiento) ===
+    elements.append(fijos.encabezado(obtener_logo_establecimiento(comuna)))
     elements.append(Spacer(1, 8*mm))
 
     # === TÍTULO ===
-    elements.append(Paragraph("INFORME RETINOGRÁFICO", styles['Titulo']))
+    elements.append(fijos.parrafo("INFORME RETINOGRÁFICO", 'Titulo'))
 
     # === DATOS DEL PACIENTE ===
     # Tabla de datos del paciente
     datos_paciente = [
-        [Paragraph("<b>Nombre:</b>", styles['Etiqueta']),
+        [fijos.parrafo("<b>Nombre:</b>", 'Etiqueta'),
          Paragraph(nombre, styles['Valor']),
-         Paragraph("<b>Fecha Exámen:</b>", styles['Etiqueta']),
+         fijos.parrafo("<b>Fecha Exámen:</b>", 'Etiqueta'),
          Paragraph(fecha, styles['Valor'])],
-        [Paragraph("<b>RUT:</b>", styles['Etiqueta']),
+        [fijos.parrafo("<b>RUT:</b>", 'Etiqueta'),
          Paragraph(rut, styles['Valor']),
-         Paragraph("<b>Edad:</b>", styles['Etiqueta']),
+         fijos.parrafo("<b>Edad:</b>", 'Etiqueta'),
          Paragraph(f"{edad} años" if edad else "", styles['Valor'])],
-        [Paragraph("<b>Institución:</b>", styles['Etiqueta']),
+        [fijos.parrafo("<b>Institución:</b>", 'Etiqueta'),
          Paragraph(institucion, styles['Valor']),
          "", ""],
     ]
 
     datos_table = Table(datos_paciente, colWidths=[2.5*cm, 7*cm, 3*cm, 4*cm])
-    datos_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (0, -1), 'RIGHT'),
-        ('ALIGN', (2, 0), (2, -1), 'RIGHT'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
-        ('TOPPADDING', (0, 0), (-1, -1), 3),
-    ]))
+    datos_table.setStyle(fijos.estilo_datos)
 
     elements.append(datos_table)
 
     elements.append(Spacer(1, 8*mm))
 
     # === LÍNEA SEPARADORA ===
-    elements.append(Table([['']], colWidths=[17*cm], rowHeights=[0.5*mm],
-                         style=[('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#2c5282'))]))
+    elements.append(fijos.separador())
     elements.append(Spacer(1, 5*mm))
 
     # === DIAGNÓSTICO ===
-    resultado = str(paciente.get('RESULTADO FINAL', 'NORMAL')).upper().strip() if not pd.isna(paciente.get('RESULTADO FINAL')) else 'NORMAL'
-
-    # Normalizar resultado
-    if resultado in ['DG NORMAL', 'DGNORMAL']:
-        resultado = 'DG NORMAL'
-    elif 'NORMAL' in resultado and resultado != 'DG NORMAL':
-        resultado = 'NORMAL'
-    elif 'CATARATA' in resultado:
-        resultado = 'CATARATA'
-    elif resultado in ['RD', 'RETINOPATIA', 'RETINOPATÍA']:
-        resultado = 'RD'
-    elif resultado not in TEXTOS_DIAGNOSTICO:
-        resultado = 'OTROS'
+    resultado = datos.resultado
 
     # Texto introductorio
-    elements.append(Paragraph(
+    elements.append(fijos.parrafo(
         "Por medio de la evaluación realizada con cámara no midriática es posible informar que:",
-        styles['Cuerpo']
+        'Cuerpo'
     ))
     elements.append(Spacer(1, 3*mm))
 
@@ -398,21 +1197,17 @@ def generar_pdf(paciente, output_path, styles):
     textos = TEXTOS_DIAGNOSTICO.get(resultado, TEXTOS_DIAGNOSTICO['OTROS'])
     for texto in textos:
         if texto:
-            elements.append(Paragraph(texto, styles['Diagnostico']))
+            elements.append(fijos.parrafo(texto, 'Diagnostico'))
 
     # Observaciones adicionales
-    observaciones = paciente.get('OBSERVACIONES', '')
-    if not pd.isna(observaciones) and str(observaciones).strip():
+    observaciones = datos.observaciones
+    if observaciones:
         elements.append(Spacer(1, 3*mm))
         elements.append(Paragraph(f"<b>Observaciones:</b> {observaciones}", styles['Diagnostico']))
 
     # Detalles OD/OI para todos los diagnósticos (siempre mostrar)
-    detalle_od = paciente.get('DETALLE OD', '')
-    detalle_oi = paciente.get('DETALLE OI', '')
-
-    # Mostrar siempre los detalles de cada ojo
-    detalle_od_texto = str(detalle_od).strip() if not pd.isna(detalle_od) and str(detalle_od).strip() else "Sin observaciones"
-    detalle_oi_texto = str(detalle_oi).strip() if not pd.isna(detalle_oi) and str(detalle_oi).strip() else "Sin observaciones"
+    detalle_od_texto = datos.detalle_od or "Sin observaciones"
+    detalle_oi_texto = datos.detalle_oi or "Sin observaciones"
 
     elements.append(Spacer(1, 2*mm))
     elements.append(Paragraph(f"- Ojo Derecho (OD): {detalle_od_texto}", styles['Diagnostico']))
@@ -421,407 +1216,3050 @@ def generar_pdf(paciente, output_path, styles):
     elements.append(Spacer(1, 5*mm))
 
     # === SUGERENCIAS ===
-    elements.append(Paragraph("<b>SUGERENCIAS</b>", styles['Subtitulo']))
+    elements.append(fijos.parrafo("<b>SUGERENCIAS</b>", 'Subtitulo'))
 
     sugerencias = SUGERENCIAS.get(resultado, SUGERENCIAS['OTROS'])
     for sugerencia in sugerencias:
-        elements.append(Paragraph(sugerencia, styles['Diagnostico']))
+        elements.append(fijos.parrafo(sugerencia, 'Diagnostico'))
 
     # Derivación
-    derivacion = paciente.get('Derivacion', '')
-    if not pd.isna(derivacion) and str(derivacion).strip():
+    derivacion = datos.derivacion
+    if derivacion:
         elements.append(Spacer(1, 2*mm))
         elements.append(Paragraph(f"<b>Derivación:</b> {derivacion}", styles['Diagnostico']))
 
     elements.append(Spacer(1, 5*mm))
 
     # === CIERRE ===
-    elements.append(Paragraph("Es todo cuanto se puede informar.", styles['Cuerpo']))
+    elements.append(fijos.parrafo("Es todo cuanto se puede informar.", 'Cuerpo'))
 
     elements.append(Spacer(1, 10*mm))
 
     # === FIRMAS ===
-    firma_tmo = obtener_firma_tmo()
-    oftalmologo = paciente.get('OFTALMOLOGO', '')
-    firma_oftalmologo = obtener_firma_oftalmologo(oftalmologo)
-
     # Determinar tipo de firma según resultado
     # DG NORMAL, RD, OTROS: solo firma de oftalmólogo
     # NORMAL, CATARATA: solo firma de TMO
-    solo_oftalmologo = resultado in ['DG NORMAL', 'RD', 'OTROS']
-
-    if solo_oftalmologo:
-        # Solo firma de Oftalmólogo
-        if firma_oftalmologo:
-            firma_img = Image(firma_oftalmologo, width=4*cm, height=2.5*cm)
-        else:
-            firma_img = Spacer(1, 2.5*cm)
-
-        firma_table = Table(
-            [[firma_img],
-             [Paragraph("Médico Oftalmólogo", styles['Valor'])]],
-            colWidths=[4*cm]
-        )
+    if resultado in RESULTADOS_FIRMA_OFTALMOLOGO:
+        elements.append(fijos.firma("Médico Oftalmólogo", obtener_firma_oftalmologo(datos.oftalmologo)))
     else:
-        # Solo firma de TMO (NORMAL, CATARATA)
-        if firma_tmo:
-            firma_img = Image(firma_tmo, width=4*cm, height=2.5*cm)
-        else:
-            firma_img = Spacer(1, 2.5*cm)
-
-        firma_table = Table(
-            [[firma_img],
-             [Paragraph("Tecnólogo Médico", styles['Valor'])]],
-            colWidths=[4*cm]
-        )
-
-    firma_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-    ]))
-
-    # Centrar la tabla de firma en el documento
-    firma_container = Table(
-        [[firma_table]],
-        colWidths=[17*cm]
-    )
-    firma_container.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-    ]))
-
-    elements.append(firma_container)
+        elements.append(fijos.firma("Tecnólogo Médico", obtener_firma_tmo()))
 
     # Construir el PDF
     doc.build(elements)
     return True
 
 
-def limpiar_nombre_archivo(nombre):
-    """Limpia el nombre para usarlo como nombre de archivo."""
-    if pd.isna(nombre):
-        return "sin_nombre"
-    # Reemplazar caracteres no válidos
-    nombre = str(nombre).strip()
-    caracteres_invalidos = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-    for char in caracteres_invalidos:
-        nombre = nombre.replace(char, '_')
-    return nombre
-
+# Geometría del informe para el motor canvas (equivalente a la de generar_pdf:
+# márgenes del SimpleDocTemplate más el padding de 6 pt del Frame)
+ANCHO_PAGINA, ALTO_PAGINA = letter
+X_CONTENIDO = 2*cm + 6
+ANCHO_CONTENIDO = ANCHO_PAGINA - 4*cm - 12
+Y_SUPERIOR = ALTO_PAGINA - 1.5*cm - 6
+Y_INFERIOR = 2*cm + 6
+PADDING_CELDA = 6, 3  # padding horizontal y vertical por defecto de las celdas de Table
 
-def procesar_excel(excel_path, carpeta_salida=None):
-    """Procesa el archivo Excel y genera los PDFs."""
+EMPRESA_LINEAS = [
+    "www.retidiag.com",
+    "Hernando de Aguirre 128 Of. 904",
+    "Fono: 24816886/7",
+    "Providencia, Santiago",
+]
+TEXTO_INTRODUCCION = "Por medio de la evaluación realizada con cámara no midriática es posible informar que:"
+TEXTO_CIERRE = "Es todo cuanto se puede informar."
 
-    print(f"\n{'='*60}")
-    print("GENERADOR DE INFORMES RETINOGRÁFICOS - RETIDIAG")
-    print(f"{'='*60}\n")
 
-    if not os.path.exists(excel_path):
-        print(f"ERROR: No se encontró el archivo: {excel_path}")
-        return False
+class _FlujoCanvas:
+    """Cursor vertical que reproduce el espaciado de los Frame de platypus.
 
-    print(f"Leyendo archivo: {excel_path}")
+    Con paginar=False no se agregan páginas: el cursor puede quedar bajo
+    Y_INFERIOR y quien lo usa decide qué hacer (ver generar_pdf_plantilla).
+    Con dibujar=False los párrafos solo se miden (ver informe_cabe_en_pagina).
+    """
 
-    # Leer el Excel
-    try:
-        df = pd.read_excel(excel_path, sheet_name='INPUT', engine='openpyxl')
-        # Limpiar espacios en nombres de columnas
-        df.columns = df.columns.str.strip()
-    except Exception as e:
-        print(f"ERROR al leer el archivo: {e}")
-        return False
+    def __init__(self, c, y=Y_SUPERIOR, paginar=True, dibujar=True):
+        self.c = c
+        self.y = y
+        self.espacio_previo = 0
+        self.al_inicio = True
+        self.paginar = paginar
+        self.dibujar = dibujar
+
+    def espacio(self, alto):
+        """Equivalente a un Spacer."""
+        if not self.al_inicio:
+            self.y -= alto
+        self.espacio_previo = 0
+
+    def nueva_pagina(self):
+        """Cierra la página actual y vuelve el cursor al inicio del área de contenido."""
+        self.c.showPage()
+        self.y = Y_SUPERIOR
+        self.espacio_previo = 0
+        self.al_inicio = True
+
+    def bloque(self, alto, antes=0, despues=0):
+        """Reserva un bloque de `alto` puntos y retorna la coordenada y de su borde superior."""
+        antes = 0 if self.al_inicio else max(antes - self.espacio_previo, 0)
+        if self.paginar and self.y - antes - alto < Y_INFERIOR and not self.al_inicio:
+            self.nueva_pagina()
+            antes = 0
+        tope = self.y - antes
+        self.y = tope - alto - despues
+        self.espacio_previo = despues
+        self.al_inicio = False
+        return tope
+
+    def parrafo(self, parrafo):
+        """Dibuja un Paragraph, partiéndolo entre páginas si no cabe."""
+        estilo = parrafo.style
+        while self.paginar:
+            _, alto = parrafo.wrap(ANCHO_CONTENIDO, ALTO_PAGINA)
+            antes = 0 if self.al_inicio else max(estilo.spaceBefore - self.espacio_previo, 0)
+            disponible = self.y - antes - Y_INFERIOR
+            if alto <= disponible or self.al_inicio and alto <= Y_SUPERIOR - Y_INFERIOR:
+                break
+            partes = parrafo.split(ANCHO_CONTENIDO, disponible) if disponible > 0 else []
+            if len(partes) != 2:
+                self.nueva_pagina()
+                continue
+            primera, parrafo = partes
+            _, alto_primera = primera.wrap(ANCHO_CONTENIDO, disponible)
+            primera.drawOn(self.c, X_CONTENIDO, self.y - antes - alto_primera)
+            self.nueva_pagina()
+        _, alto = parrafo.wrap(ANCHO_CONTENIDO, ALTO_PAGINA)
+        tope = self.bloque(alto, estilo.spaceBefore, estilo.spaceAfter)
+        if self.dibujar:
+            parrafo.drawOn(self.c, X_CONTENIDO, tope - alto)
+
+
+def _lineas(texto, fuente, tamano, ancho):
+    """Divide un texto simple en líneas que caben en `ancho`."""
+    return simpleSplit(texto, fuente, tamano, ancho) if texto else []
+
+
+def _dibujar_imagen(c, ruta, x, y, ancho, alto):
+    """Dibuja una imagen de la caché con su esquina inferior izquierda en (x, y)."""
+    c.drawImage(lector_imagen(ruta, ancho, alto), x, y, ancho, alto)
+
+
+def _texto_cuerpo(c, flujo, texto, styles):
+    """Dibuja una línea con el estilo Cuerpo."""
+    estilo = styles['Cuerpo']
+    tope = flujo.bloque(estilo.leading, estilo.spaceBefore, estilo.spaceAfter)
+    c.setFillColor(colors.black)
+    c.setFont('Helvetica', 10)
+    c.drawString(X_CONTENIDO, tope - 10, texto)
+
+
+def _texto_fijo(c, flujo, texto, styles):
+    """Dibuja un texto fijo con el estilo Diagnostico (cortado con simpleSplit)."""
+    estilo = styles['Diagnostico']
+    lineas = _lineas(texto, 'Helvetica', 10, ANCHO_CONTENIDO - estilo.leftIndent)
+    tope = flujo.bloque(estilo.leading * len(lineas), estilo.spaceBefore, estilo.spaceAfter)
+    c.setFillColor(colors.black)
+    c.setFont('Helvetica', 10)
+    for i, linea in enumerate(lineas):
+        c.drawString(X_CONTENIDO + estilo.leftIndent, tope - 10 - estilo.leading*i, linea)
+
+
+def _texto_libre(flujo, texto, styles):
+    """Dibuja un campo de texto libre como Paragraph con el estilo Diagnostico."""
+    flujo.parrafo(Paragraph(texto, styles['Diagnostico']))
+
+
+def _seccion_cabecera(c, flujo, logo_establecimiento):
+    """Encabezado (datos de la empresa y logos) y título del informe."""
+    pad_x, pad_y = PADDING_CELDA
+    logo_retidiag = registro_imagenes().logo_retidiag
+    x_tabla = X_CONTENIDO + (ANCHO_CONTENIDO - 17*cm) / 2
+    alto_empresa = 12 * len(EMPRESA_LINEAS)
 
-    # Verificar columnas necesarias
-    columnas_requeridas = ['NOMBRE PACIENTE', 'RUT', 'RESULTADO FINAL']
-    for col in columnas_requeridas:
-        if col not in df.columns:
-            print(f"ERROR: Falta la columna '{col}' en el archivo Excel")
-            return False
+    if logo_establecimiento:
+        alto_fila = max(alto_empresa, 1.8*cm) + 2*pad_y
+        tope = flujo.bloque(alto_fila)
+        interior = alto_fila - 2*pad_y
+        y_empresa = tope - pad_y - (interior - alto_empresa) / 2
+        x_logo = x_tabla + 9*cm + pad_x + (5*cm - 2*pad_x - 4*cm) / 2
+        y_logo = tope - pad_y - (interior - 1.2*cm) / 2 - 1.2*cm
+        _dibujar_imagen(c, logo_establecimiento, x_tabla + 17*cm - pad_x - 2.5*cm,
+                        tope - pad_y - (interior - 1.8*cm) / 2 - 1.8*cm, 2.5*cm, 1.8*cm)
+    else:
+        alto_fila = max(alto_empresa, 1.2*cm) + 2*pad_y
+        tope = flujo.bloque(alto_fila)
+        y_empresa = tope - pad_y
+        x_logo = x_tabla + 17*cm - pad_x - 4*cm
+        y_logo = tope - pad_y - 1.2*cm
+
+    c.setFillColor(colors.HexColor('#333333'))
+    c.setFont('Helvetica', 8)
+    for i, linea in enumerate(EMPRESA_LINEAS):
+        c.drawString(x_tabla + pad_x, y_empresa - 8 - 12*i, linea)
+
+    if logo_retidiag:
+        _dibujar_imagen(c, logo_retidiag, x_logo, y_logo, 4*cm, 1.2*cm)
+    else:
+        c.setFillColor(colors.HexColor('#2c5282'))
+        c.setFont('Helvetica-Bold', 14)
+        c.drawCentredString(x_logo + 2*cm, y_logo + 1.2*cm - 14, "RETIDIAG")
 
-    # Filtrar filas válidas (que tengan nombre de paciente)
-    df = df[df['NOMBRE PACIENTE'].notna()]
+    flujo.espacio(8*mm)
 
-    print(f"Pacientes encontrados: {len(df)}")
+    # === TÍTULO ===
+    tope = flujo.bloque(12, antes=5*mm, despues=8*mm)
+    c.setFillColor(colors.HexColor('#2c5282'))
+    c.setFont('Helvetica-Bold', 14)
+    c.drawCentredString(X_CONTENIDO + ANCHO_CONTENIDO / 2, tope - 14, "INFORME RETINOGRÁFICO")
+
+
+def _seccion_paciente(c, flujo, datos):
+    """Tabla con los datos del paciente."""
+    pad_x, pad_y = PADDING_CELDA
+    anchos = [2.5*cm, 7*cm, 3*cm, 4*cm]
+    x_columnas = [X_CONTENIDO + (ANCHO_CONTENIDO - sum(anchos)) / 2]
+    for ancho in anchos[:-1]:
+        x_columnas.append(x_columnas[-1] + ancho)
+    edad = f"{datos.edad} años" if datos.edad else ""
+    filas = [
+        ["Nombre:", datos.nombre, "Fecha Exámen:", datos.fecha],
+        ["RUT:", datos.rut, "Edad:", edad],
+        ["Institución:", datos.institucion, "", ""],
+    ]
+    fuentes = ['Helvetica-Bold', 'Helvetica', 'Helvetica-Bold', 'Helvetica']
+    filas = [[_lineas(texto, fuentes[col], 10, anchos[col] - 2*pad_x) for col, texto in enumerate(fila)]
+             for fila in filas]
+    altos = [12 * max(len(celda) for celda in fila) + 2*pad_y for fila in filas]
+
+    tope = flujo.bloque(sum(altos))
+    c.setFillColor(colors.black)
+    for fila, alto_fila in zip(filas, altos):
+        for col, lineas in enumerate(fila):
+            c.setFont(fuentes[col], 10)
+            y = tope - pad_y - (alto_fila - 2*pad_y - 12*len(lineas)) / 2 - 10
+            for linea in lineas:
+                c.drawString(x_columnas[col] + pad_x, y, linea)
+                y -= 12
+        tope -= alto_fila
+
+    flujo.espacio(8*mm)
+
+
+def _seccion_diagnostico(c, flujo, resultado, styles):
+    """Línea separadora, texto introductorio y textos del diagnóstico."""
+    x_tabla = X_CONTENIDO + (ANCHO_CONTENIDO - 17*cm) / 2
+    tope = flujo.bloque(0.5*mm)
+    c.setFillColor(colors.HexColor('#2c5282'))
+    c.rect(x_tabla, tope - 0.5*mm, 17*cm, 0.5*mm, stroke=0, fill=1)
+    flujo.espacio(5*mm)
+
+    _texto_cuerpo(c, flujo, TEXTO_INTRODUCCION, styles)
+    flujo.espacio(3*mm)
+
+    for texto in TEXTOS_DIAGNOSTICO.get(resultado, TEXTOS_DIAGNOSTICO['OTROS']):
+        if texto:
+            _texto_fijo(c, flujo, texto, styles)
 
-    # Obtener comuna, establecimiento y fecha para nombre de carpeta
-    comuna = ""
-    establecimiento = ""
-    fecha_examen = ""
 
-    if len(df) > 0:
-        # Obtener la comuna (usar la primera o la más común)
-        if 'COMUNA' in df.columns:
-            comuna = df['COMUNA'].mode().iloc[0] if not df['COMUNA'].mode().empty else df['COMUNA'].iloc[0]
-            if pd.isna(comuna):
-                comuna = "Sin_Comuna"
-            else:
-                comuna = str(comuna).strip()
+def _seccion_detalles(flujo, datos, styles):
+    """Observaciones y detalles de cada ojo."""
+    if datos.observaciones:
+        flujo.espacio(3*mm)
+        _texto_libre(flujo, f"<b>Observaciones:</b> {datos.observaciones}", styles)
 
-        # Obtener el establecimiento (usar el primero o el más común)
-        if 'ESTABLECIMIENTO' in df.columns:
-            establecimiento = df['ESTABLECIMIENTO'].mode().iloc[0] if not df['ESTABLECIMIENTO'].mode().empty else df['ESTABLECIMIENTO'].iloc[0]
-            if pd.isna(establecimiento):
-                establecimiento = "Sin_Establecimiento"
-            else:
-                establecimiento = str(establecimiento).strip()
-
-        # Obtener la fecha del examen (usar la primera o la más común)
-        if 'FECHA' in df.columns:
-            fecha_valor = df['FECHA'].iloc[0]
-            if not pd.isna(fecha_valor):
-                if isinstance(fecha_valor, str):
-                    fecha_examen = fecha_valor.replace('/', '-').replace(' ', '_')[:10]
-                else:
-                    try:
-                        fecha_examen = fecha_valor.strftime("%Y-%m-%d")
-                    except:
-                        fecha_examen = str(fecha_valor)[:10]
-            else:
-                fecha_examen = datetime.now().strftime("%Y-%m-%d")
+    flujo.espacio(2*mm)
+    _texto_libre(flujo, f"- Ojo Derecho (OD): {datos.detalle_od or 'Sin observaciones'}", styles)
+    _texto_libre(flujo, f"- Ojo Izquierdo (OI): {datos.detalle_oi or 'Sin observaciones'}", styles)
+    flujo.espacio(5*mm)
 
-    # Limpiar nombres para usar como carpetas
-    comuna_limpia = limpiar_nombre_archivo(comuna)
-    establecimiento_limpio = limpiar_nombre_archivo(establecimiento)
 
-    # Crear carpeta con establecimiento y fecha
-    nombre_carpeta_establecimiento = f"{establecimiento_limpio}_{fecha_examen}"
+def _seccion_sugerencias(c, flujo, resultado, styles):
+    """Subtítulo y lista de sugerencias."""
+    estilo = styles['Subtitulo']
+    tope = flujo.bloque(estilo.leading, estilo.spaceBefore, estilo.spaceAfter)
+    c.setFillColor(colors.HexColor('#2c5282'))
+    c.setFont('Helvetica-Bold', 11)
+    c.drawString(X_CONTENIDO, tope - 11, "SUGERENCIAS")
 
-    # Crear estructura: informes retidiag / COMUNA / Establecimiento_Fecha
-    if carpeta_salida:
-        output_dir = os.path.join(carpeta_salida, comuna_limpia, nombre_carpeta_establecimiento)
-    else:
-        output_dir = os.path.join(OUTPUT_DIR, comuna_limpia, nombre_carpeta_establecimiento)
+    for sugerencia in SUGERENCIAS.get(resultado, SUGERENCIAS['OTROS']):
+        _texto_fijo(c, flujo, sugerencia, styles)
 
-    os.makedirs(output_dir, exist_ok=True)
-    print(f"Comuna: {comuna}")
-    print(f"Establecimiento: {establecimiento}")
-    print(f"Fecha examen: {fecha_examen}")
-    print(f"Carpeta de salida: {output_dir}\n")
 
-    # Crear estilos
-    styles = crear_estilos()
+def _seccion_derivacion(flujo, datos, styles):
+    """Derivación indicada en el Excel."""
+    if datos.derivacion:
+        flujo.espacio(2*mm)
+        _texto_libre(flujo, f"<b>Derivación:</b> {datos.derivacion}", styles)
+    flujo.espacio(5*mm)
 
-    # Contadores
-    exitosos = 0
-    errores = 0
 
-    # Procesar cada paciente
-    for idx, paciente in df.iterrows():
-        nombre = paciente.get('NOMBRE PACIENTE', f'paciente_{idx}')
-        nombre_archivo = limpiar_nombre_archivo(nombre)
-        resultado = str(paciente.get('RESULTADO FINAL', 'NORMAL')).strip() if not pd.isna(paciente.get('RESULTADO FINAL')) else 'NORMAL'
+def _firma_informe(resultado, datos):
+    """Retorna (ruta de la firma, cargo) según el resultado.
+
+    DG NORMAL, RD y OTROS llevan firma de oftalmólogo; NORMAL y CATARATA, de TMO.
+    """
+    if resultado in RESULTADOS_FIRMA_OFTALMOLOGO:
+        return obtener_firma_oftalmologo(datos.oftalmologo), "Médico Oftalmólogo"
+    return obtener_firma_tmo(), "Tecnólogo Médico"
+
+
+def _seccion_cierre(c, flujo, firma, cargo, styles):
+    """Texto de cierre y bloque de firma."""
+    pad_x, pad_y = PADDING_CELDA
+    _texto_cuerpo(c, flujo, TEXTO_CIERRE, styles)
+    flujo.espacio(10*mm)
+
+    # Tabla de firma (4 cm) centrada dentro de un contenedor de 17 cm
+    x_tabla = X_CONTENIDO + (ANCHO_CONTENIDO - 17*cm) / 2
+    alto_firma = 2.5*cm + 2*pad_y
+    tope = flujo.bloque(alto_firma + 12 + 2*pad_y + 2*pad_y)
+    x_firma = x_tabla + pad_x + (17*cm - 2*pad_x - 4*cm) / 2
+    if firma:
+        _dibujar_imagen(c, firma, x_firma + pad_x + (4*cm - 2*pad_x - 4*cm) / 2,
+                        tope - 2*pad_y - 2.5*cm, 4*cm, 2.5*cm)
+    c.setFillColor(colors.black)
+    c.setFont('Helvetica', 10)
+    c.drawString(x_firma + pad_x, tope - pad_y - alto_firma - pad_y - 10, cargo)
+
+
+def generar_pdf_canvas(paciente, output_path, styles):
+    """Genera el PDF para un paciente dibujando directamente sobre un canvas.
+
+    Produce el mismo informe que generar_pdf con coordenadas precalculadas;
+    solo los campos de texto libre (observaciones, detalles OD/OI y
+    derivación) pasan por Paragraph.
+    """
+    c = canvas.Canvas(output_path, pagesize=letter)
+    _dibujar_informe_canvas(c, registro_paciente(paciente), styles)
+    c.showPage()
+    c.save()
+    return True
+
+
+def _dibujar_informe_canvas(c, datos, styles):
+    """Dibuja un informe completo sobre `c` (agregando páginas si hace falta)."""
+    resultado = datos.resultado
+    flujo = _FlujoCanvas(c)
+
+    _seccion_cabecera(c, flujo, obtener_logo_establecimiento(datos.comuna))
+    _seccion_paciente(c, flujo, datos)
+    _seccion_diagnostico(c, flujo, resultado, styles)
+    _seccion_detalles(flujo, datos, styles)
+    _seccion_sugerencias(c, flujo, resultado, styles)
+    _seccion_derivacion(flujo, datos, styles)
+    firma, cargo = _firma_informe(resultado, datos)
+    _seccion_cierre(c, flujo, firma, cargo, styles)
+
+
+def _registrar_fuentes(c):
+    """Registra las fuentes del informe en un orden fijo.
+
+    Así los nombres internos (/F1, /F2) coinciden en todos los documentos y
+    el código precompilado de las plantillas se puede insertar tal cual.
+    """
+    c.setFont('Helvetica-Bold', 10)
+    c.setFont('Helvetica', 10)
+
+
+class _GrabadorCanvas:
+    """Imita la parte de Canvas que usan las secciones del informe.
+
+    En vez de dibujar, acumula el contenido como código PDF literal (texto y
+    rectángulos) más la lista de imágenes, para compilar una plantilla.
+    """
+
+    def __init__(self, lienzo):
+        self._lienzo = lienzo
+        self._fuente = ('Helvetica', 10)
+        self._color = colors.black
+        self.codigo = []
+        self.imagenes = []
+
+    def setFont(self, fuente, tamano):
+        self._fuente = (fuente, tamano)
+
+    def setFillColor(self, color):
+        self._color = color
+
+    def drawString(self, x, y, texto):
+        t = self._lienzo.beginText(x, y)
+        t.setFont(*self._fuente)
+        t.setFillColor(self._color)
+        t.textOut(texto)
+        self.codigo.append(t.getCode())
+
+    def drawCentredString(self, x, y, texto):
+        self.drawString(x - stringWidth(texto, *self._fuente) / 2, y, texto)
+
+    def rect(self, x, y, ancho, alto, stroke=0, fill=1):
+        r, g, b = self._color.rgb()
+        self.codigo.append(f"q {fp_str(r, g, b)} rg {fp_str(x, y, ancho, alto)} re f Q")
+
+    def drawImage(self, imagen, x, y, ancho, alto):
+        self.imagenes.append((imagen, x, y, ancho, alto))
+
+
+class PlantillaInforme:
+    """Parte fija de un informe para un diagnóstico, comuna y firmante.
+
+    Cada sección fija (cabecera, diagnóstico, sugerencias y cierre con firma)
+    se compila una sola vez a código PDF; en cada documento se define como
+    form XObject y se estampa en la posición que dejan los campos variables.
+    """
+
+    _contador = 0
+
+    def __init__(self, resultado, logo_establecimiento, firma, cargo, styles):
+        PlantillaInforme._contador += 1
+        self.nombre = f"Plantilla{PlantillaInforme._contador}"
+
+        lienzo = canvas.Canvas(io.BytesIO(), pagesize=letter)
+        _registrar_fuentes(lienzo)
+        self.segmentos = {
+            'cabecera': self._compilar(
+                lienzo, lambda c, f: _seccion_cabecera(c, f, logo_establecimiento), al_inicio=True),
+            'diagnostico': self._compilar(
+                lienzo, lambda c, f: _seccion_diagnostico(c, f, resultado, styles)),
+            'sugerencias': self._compilar(
+                lienzo, lambda c, f: _seccion_sugerencias(c, f, resultado, styles)),
+            'cierre': self._compilar(
+                lienzo, lambda c, f: _seccion_cierre(c, f, firma, cargo, styles)),
+        }
+
+    @staticmethod
+    def _compilar(lienzo, dibujar, al_inicio=False):
+        """Compila una sección y retorna (código, imágenes, alto, espacio posterior)."""
+        # Todas las secciones se compilan como si empezaran en Y_SUPERIOR, para
+        # que queden dentro del BBox del form; al estampar se trasladan
+        grabador = _GrabadorCanvas(lienzo)
+        flujo = _FlujoCanvas(grabador, paginar=False)
+        flujo.al_inicio = al_inicio
+        dibujar(grabador, flujo)
+        return "\n".join(grabador.codigo), grabador.imagenes, Y_SUPERIOR - flujo.y, flujo.espacio_previo
+
+    def definir(self, c):
+        """Define los form XObjects de la plantilla en el documento de `c`."""
+        if c.hasForm(f"{self.nombre}_cabecera"):
+            return
+        for segmento, (codigo, imagenes, _, _) in self.segmentos.items():
+            c.beginForm(f"{self.nombre}_{segmento}")
+            c.addLiteral(codigo)
+            for imagen, x, y, ancho, alto in imagenes:
+                c.drawImage(imagen, x, y, ancho, alto)
+            c.endForm()
+
+    def estampar(self, c, flujo, segmento):
+        """Dibuja un segmento en la posición actual del flujo y avanza el cursor."""
+        _, _, alto, espacio_previo = self.segmentos[segmento]
+        c.saveState()
+        c.translate(0, flujo.y - Y_SUPERIOR)
+        c.doForm(f"{self.nombre}_{segmento}")
+        c.restoreState()
+        flujo.y -= alto
+        flujo.espacio_previo = espacio_previo
+        flujo.al_inicio = False
+
+
+# Plantillas compiladas: (resultado, logo, firma, cargo, compacta) -> PlantillaInforme
+_CACHE_PLANTILLAS = {}
+
+
+def obtener_plantilla(resultado, logo_establecimiento, firma, cargo, styles):
+    """Retorna la plantilla (en caché) para un diagnóstico, logo y firmante."""
+    clave = (resultado, logo_establecimiento, firma, cargo, _SALIDA_COMPACTA)
+    plantilla = _CACHE_PLANTILLAS.get(clave)
+    if plantilla is None:
+        with medir_etapa('pdf.plantillas'):
+            plantilla = _CACHE_PLANTILLAS[clave] = PlantillaInforme(
+                resultado, logo_establecimiento, firma, cargo, styles)
+    return plantilla
+
+
+def _dibujar_informe_plantilla(c, datos, styles, dibujar=True):
+    """Dibuja un informe sobre `c` estampando su plantilla y los campos variables.
+
+    Retorna False (sin terminar la página) si el informe no cabe en una
+    sola página; en ese caso hay que usar el motor canvas.
+    """
+    resultado = datos.resultado
+    firma, cargo = _firma_informe(resultado, datos)
+    plantilla = obtener_plantilla(resultado, obtener_logo_establecimiento(datos.comuna),
+                                  firma, cargo, styles)
+    plantilla.definir(c)
+
+    flujo = _FlujoCanvas(c, paginar=False, dibujar=dibujar)
+    plantilla.estampar(c, flujo, 'cabecera')
+    _seccion_paciente(c, flujo, datos)
+    plantilla.estampar(c, flujo, 'diagnostico')
+    _seccion_detalles(flujo, datos, styles)
+    plantilla.estampar(c, flujo, 'sugerencias')
+    _seccion_derivacion(flujo, datos, styles)
+    plantilla.estampar(c, flujo, 'cierre')
+    return flujo.y + flujo.espacio_previo >= Y_INFERIOR
+
+
+class _LienzoNulo:
+    """Canvas que descarta todo lo que se le dibuja (para medir un informe)."""
+
+    def __getattr__(self, nombre):
+        return _descartar
+
+
+def _descartar(*args, **kwargs):
+    return None
+
+
+def informe_cabe_en_pagina(datos, styles):
+    """Indica si el informe de `datos` cabe en una página con su plantilla, sin dibujarlo."""
+    return _dibujar_informe_plantilla(_LienzoNulo(), datos, styles, dibujar=False)
+
+
+def generar_pdf_plantilla(paciente, output_path, styles):
+    """Genera el PDF para un paciente a partir de una plantilla precompilada.
+
+    Solo se dibujan los datos del paciente y los campos de texto libre; el
+    resto del informe se estampa desde la plantilla de su diagnóstico,
+    comuna y firmante. Los informes que no caben en una página se generan
+    con generar_pdf_canvas.
+    """
+    datos = registro_paciente(paciente)
+    c = canvas.Canvas(output_path, pagesize=letter)
+    _registrar_fuentes(c)
+    if not _dibujar_informe_plantilla(c, datos, styles):
+        return generar_pdf_canvas(paciente, output_path, styles)
+    c.showPage()
+    c.save()
+    return True
+
+
+def limpiar_nombre_archivo(nombre):
+    """Limpia el nombre para usarlo como nombre de archivo."""
+    if pd.isna(nombre):
+        return "sin_nombre"
+    # Reemplazar caracteres no válidos
+    nombre = str(nombre).strip()
+    caracteres_invalidos = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
+    for char in caracteres_invalidos:
+        nombre = nombre.replace(char, '_')
+    return nombre
+
+
+# Motores de renderizado disponibles
+MOTORES = {
+    'platypus': generar_pdf,
+    'canvas': generar_pdf_canvas,
+    'plantilla': generar_pdf_plantilla,
+}
+
+# Estado del proceso worker (se crea una sola vez por proceso)
+_ESTILOS_WORKER = None
+_MOTOR_WORKER = generar_pdf
+
+
+# Pools que se mantienen vivos entre ejecuciones, por (workers, motor, compacta); solo
+# el daemon los activa (ver servir_daemon), en los demás casos es None
+_POOLS_PERSISTENTES = None
+
+
+def _inicializar_worker(motor='platypus', compacta=None):
+    """Inicializa un proceso del pool creando los estilos una sola vez.
+
+    `compacta` (si no es None) activa o desactiva la salida compacta.
+    """
+    global _ESTILOS_WORKER, _MOTOR_WORKER
+    if compacta is not None:
+        usar_salida_compacta(compacta)
+    if _ESTILOS_WORKER is None:
+        _ESTILOS_WORKER = crear_estilos()
+    _MOTOR_WORKER = MOTORES[motor]
+
+
+@contextmanager
+def escritura_atomica(ruta, modo='wb'):
+    """Abre un archivo temporal junto a `ruta` que la reemplaza solo si el bloque termina bien.
+
+    El temporal lleva el PID (dos procesos pueden escribir la misma ruta) y
+    se renombra con os.replace, que es atómico: aunque el proceso muera a
+    mitad de camino, con el nombre final solo puede haber un archivo
+    completo. Si el bloque falla, el temporal se borra.
+    """
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    try:
+        with open(temporal, modo, encoding=None if 'b' in modo else 'utf-8') as f:
+            yield f
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+def _generar_pdf_tarea(tarea):
+    """Genera el PDF de una tarea y retorna (ruta PDF, nombre, resultado, error).
+
+    El PDF se arma en memoria y se escribe al final, así la maquetación y
+    la escritura a disco se miden por separado (etapas pdf.render y
+    pdf.escritura). La escritura es atómica (escritura_atomica): ni un
+    error ni un proceso interrumpido dejan un PDF a medias.
+    """
+    paciente, pdf_path, nombre, resultado = tarea
+    try:
+        buffer = io.BytesIO()
+        with medir_etapa('pdf.render'):
+            _MOTOR_WORKER(paciente, buffer, _ESTILOS_WORKER)
+        with medir_etapa('pdf.escritura'), escritura_atomica(pdf_path) as f:
+            f.write(buffer.getbuffer())
+        return pdf_path, nombre, resultado, None
+    except Exception as e:
+        return pdf_path, nombre, resultado, str(e)
+
+
+# Orden de los diagnósticos en los PDFs consolidados por establecimiento
+ORDEN_DIAGNOSTICOS = ["NORMAL", "DG NORMAL", "CATARATA", "RD", "OTROS"]
+
+
+def generar_pdf_consolidado(entradas, output_path, styles, motor='plantilla', por_diagnostico=False):
+    """Genera un solo PDF con el informe de cada paciente, cada uno desde una página nueva.
+
+    `entradas` es una lista de (paciente, archivo), donde `archivo` es la
+    ruta del informe individual relativa a la carpeta del PDF (se usa al
+    dividirlo). Agrega un marcador por paciente (agrupados por diagnóstico
+    con por_diagnostico=True) y retorna el índice de páginas: una lista de
+    dicts con nombre, rut, resultado, archivo, desde y hasta (1-based).
+
+    Los logos, firmas y plantillas quedan una sola vez en el archivo. Con
+    motor 'plantilla' los informes que no caben en una página se dibujan
+    con el motor canvas; cualquier otro motor usa el canvas.
+    """
+    c = canvas.Canvas(output_path, pagesize=letter)
+    _registrar_fuentes(c)
+    indice = []
+    diagnostico = None
+    for n, (paciente, archivo) in enumerate(entradas):
+        datos = registro_paciente(paciente)
+        desde = c.getPageNumber()
+
+        # Marcadores
+        clave = f"informe{n}"
+        c.bookmarkPage(clave)
+        if por_diagnostico and datos.resultado != diagnostico:
+            diagnostico = datos.resultado
+            c.bookmarkPage(f"diagnostico{n}")
+            c.addOutlineEntry(TEXTOS_RESUMEN_DIAGNOSTICO.get(diagnostico, diagnostico.title()),
+                              f"diagnostico{n}", level=0)
+        c.addOutlineEntry(f"{datos.nombre} ({datos.rut})" if datos.rut else datos.nombre,
+                          clave, level=1 if por_diagnostico else 0)
+
+        if motor == 'plantilla' and informe_cabe_en_pagina(datos, styles):
+            _dibujar_informe_plantilla(c, datos, styles)
+        else:
+            _dibujar_informe_canvas(c, datos, styles)
+        c.showPage()
+
+        indice.append({'nombre': datos.nombre, 'rut': datos.rut, 'resultado': datos.resultado,
+                       'archivo': archivo, 'desde': desde, 'hasta': c.getPageNumber() - 1})
+
+    c.showOutline()
+    c.save()
+    return indice
+
+
+def _ruta_indice(pdf_path):
+    """Ruta del índice de páginas (JSON) de un PDF consolidado."""
+    return os.path.splitext(pdf_path)[0] + "_indice.json"
+
+
+def _generar_consolidado_tarea(tarea):
+    """Genera un PDF consolidado y su índice; retorna (ruta PDF, descripción, páginas, error)."""
+    entradas, pdf_path, descripcion, motor, por_diagnostico = tarea
+    try:
+        with medir_etapa('pdf.consolidado', informes=len(entradas)), escritura_atomica(pdf_path) as f:
+            indice = generar_pdf_consolidado(entradas, f, _ESTILOS_WORKER, motor, por_diagnostico)
+        with escritura_atomica(_ruta_indice(pdf_path), 'w') as f:
+            json.dump({'pdf': os.path.basename(pdf_path), 'informes': indice}, f,
+                      ensure_ascii=False, indent=1)
+        return pdf_path, descripcion, indice[-1]['hasta'] if indice else 0, None
+    except Exception as e:
+        return pdf_path, descripcion, 0, str(e)
+
+
+def dividir_consolidado(pdf_path):
+    """Separa un PDF consolidado en los informes individuales según su índice.
+
+    Cada informe se guarda en la ruta que tendría en el modo normal
+    (RESULTADO/Nombre.pdf). Requiere pypdf. Retorna la cantidad de archivos.
+    """
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        raise RuntimeError("Para dividir PDFs consolidados instale pypdf: pip3 install pypdf")
+
+    with open(_ruta_indice(pdf_path), encoding='utf-8') as f:
+        indice = json.load(f)
+    lector = PdfReader(pdf_path)
+    carpeta = os.path.dirname(pdf_path)
+    for informe in indice['informes']:
+        escritor = PdfWriter()
+        for pagina in range(informe['desde'] - 1, informe['hasta']):
+            escritor.add_page(lector.pages[pagina])
+        destino = os.path.join(carpeta, informe['archivo'])
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        with escritura_atomica(destino) as f:
+            escritor.write(f)
+    return len(indice['informes'])
+
+
+def _generar_pdf_memoria_tarea(tarea):
+    """Genera el PDF de una tarea en memoria.
+
+    Retorna (ruta, nombre, resultado, error, bytes del PDF o None).
+    """
+    paciente, pdf_path, nombre, resultado = tarea
+    buffer = io.BytesIO()
+    try:
+        with medir_etapa('pdf.render'):
+            _MOTOR_WORKER(paciente, buffer, _ESTILOS_WORKER)
+        return pdf_path, nombre, resultado, None, buffer.getvalue()
+    except Exception as e:
+        return pdf_path, nombre, resultado, str(e), None
+
+
+# PDFs renderizados que pueden esperar en memoria a que se guarden, y
+# cuántos hilos los escriben a la vez (en una carpeta de red cada escritura
+# es sobre todo espera, así que unos pocos hilos la reparten)
+MAXIMO_ESCRITURAS_PENDIENTES = 32
+HILOS_ESCRITURA = 4
+
+
+def _escribir_pdf(resultado):
+    """Escribe un PDF de _generar_pdf_memoria_tarea; retorna (ruta PDF, nombre, resultado, error)."""
+    pdf_path, nombre, diagnostico, error, contenido = resultado
+    if error is None:
+        try:
+            with medir_etapa('pdf.escritura'), escritura_atomica(pdf_path) as f:
+                f.write(contenido)
+        except Exception as e:
+            error = str(e)
+    return pdf_path, nombre, diagnostico, error
+
+
+def escribir_en_segundo_plano(resultados, maximo=MAXIMO_ESCRITURAS_PENDIENTES, hilos=HILOS_ESCRITURA):
+    """Guarda en disco desde hilos aparte los PDFs renderizados en memoria.
+
+    `resultados` son los de ejecutar_tareas con _generar_pdf_memoria_tarea.
+    Mientras los hilos escriben cada PDF (con escritura_atomica) se siguen
+    renderizando los siguientes, así las esperas del disco (largas en una
+    carpeta de red) no frenan la CPU. En memoria esperan a lo sumo
+    `maximo` PDFs, para acotarla si el disco no da abasto. Entrega
+    (ruta PDF, nombre, resultado, error) en el orden de las tareas, cada
+    uno recién cuando su PDF quedó escrito.
+    """
+    en_curso = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='escritor-pdfs') as escritores:
+            for resultado in resultados:
+                en_curso.append(escritores.submit(_escribir_pdf, resultado))
+                while en_curso and (len(en_curso) >= maximo or en_curso[0].done()):
+                    yield en_curso.popleft().result()
+            while en_curso:
+                yield en_curso.popleft().result()
+    finally:
+        if hasattr(resultados, 'close'):
+            resultados.close()
+
+
+def _ejecutar_varias(funcion, tareas):
+    """Procesa en un worker varias tareas seguidas (un envío de _mapa_acotado)."""
+    return [funcion(tarea) for tarea in tareas]
+
+
+def _mapa_acotado(pool, funcion, tareas, chunksize, en_vuelo):
+    """Como pool.map sobre un iterador, pero sin leerlo más allá de lo que el pool alcanza a procesar.
+
+    Executor.map envía todas las tareas antes de entregar el primer
+    resultado, así que leería el iterador completo a memoria. Aquí se
+    envían de a `chunksize` tareas y a lo sumo `en_vuelo` envíos esperan a
+    la vez; los resultados salen en orden.
+    """
+    pendientes = deque()
+    tareas = iter(tareas)
+    try:
+        for envio in iter(lambda: list(islice(tareas, chunksize)), []):
+            pendientes.append(pool.submit(_ejecutar_varias, funcion, envio))
+            if len(pendientes) >= en_vuelo:
+                yield from pendientes.popleft().result()
+        while pendientes:
+            yield from pendientes.popleft().result()
+    finally:
+        for futuro in pendientes:
+            futuro.cancel()
+
+
+def ejecutar_tareas(tareas, workers=1, motor='platypus', funcion=_generar_pdf_tarea):
+    """Genera los PDFs de las tareas y entrega (ruta PDF, nombre, resultado, error) en orden.
+
+    `tareas` puede ser una lista o un iterador (p. ej. el lector streaming);
+    en ese caso los PDFs empiezan a generarse con las primeras filas y del
+    iterador se lee solo lo que el pool alcanza a procesar (_mapa_acotado).
+    `funcion` procesa cada tarea (por defecto un informe por paciente; ver
+    también _generar_pdf_memoria_tarea y _generar_consolidado_tarea). Con
+    un pool, las etapas que cada tarea mide en su worker (pdf.render,
+    pdf.imagenes...) vuelven con su resultado y se suman a las de este
+    proceso (_tarea_medida).
+    """
+    total = len(tareas) if hasattr(tareas, '__len__') else None
+    if workers <= 1 or total is not None and total <= 1:
+        _inicializar_worker(motor)
+        for tarea in tareas:
+            yield funcion(tarea)
+        return
+
+    medida = partial(_tarea_medida, funcion)
+    yield from _sumar_metricas(_ejecutar_en_pool(tareas, total, workers, motor, medida))
+
+
+def _ejecutar_en_pool(tareas, total, workers, motor, funcion):
+    """Parte de ejecutar_tareas con un pool de procesos (el del daemon o uno nuevo)."""
+    if _POOLS_PERSISTENTES is not None:
+        pool = _POOLS_PERSISTENTES.get((workers, motor, _SALIDA_COMPACTA))
+        if pool is None:
+            pool = _POOLS_PERSISTENTES[workers, motor, _SALIDA_COMPACTA] = ProcessPoolExecutor(
+                max_workers=workers, initializer=_inicializar_worker,
+                initargs=(motor, _SALIDA_COMPACTA))
+        if total is None:
+            yield from _mapa_acotado(pool, funcion, tareas, 4, workers * 2)
+        else:
+            yield from pool.map(funcion, tareas, chunksize=max(1, total // (workers * 4)))
+        return
+
+    if total is not None:
+        workers = min(workers, total)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_inicializar_worker,
+                             initargs=(motor, _SALIDA_COMPACTA)) as pool:
+        if total is None:
+            yield from _mapa_acotado(pool, funcion, tareas, 4, workers * 2)
+        else:
+            yield from pool.map(funcion, tareas, chunksize=max(1, total // (workers * 4)))
+
+
+def leer_pacientes_streaming(excel_path):
+    """Lee la hoja INPUT fila a fila con openpyxl en modo solo lectura.
+
+    Solo se extraen las columnas de COLUMNAS_INPUT y se entrega un dict por
+    paciente (filas con NOMBRE PACIENTE) a medida que se leen. Lanza
+    ValueError si falta una columna requerida.
+    """
+    wb = load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        filas = wb['INPUT'].iter_rows(values_only=True)
+        encabezado = [str(c).strip() if c is not None else '' for c in next(filas, ())]
+        for col in COLUMNAS_REQUERIDAS:
+            if col not in encabezado:
+                raise ValueError(f"Falta la columna '{col}' en el archivo Excel")
+
+        indices = [(col, encabezado.index(col)) for col in COLUMNAS_INPUT if col in encabezado]
+        i_nombre = encabezado.index('NOMBRE PACIENTE')
+        for fila in filas:
+            if i_nombre >= len(fila) or fila[i_nombre] is None:
+                continue
+            yield {col: fila[i] if i < len(fila) else None for col, i in indices}
+    finally:
+        wb.close()
+
+
+class ErrorLectura(Exception):
+    """Falla del lector del archivo de entrada en los modos que generan mientras leen (ver _lectura)."""
+
+
+def _lectura(lector):
+    """Entrega lo que entrega `lector` (filas o bloques del archivo); si el lector falla lanza ErrorLectura.
+
+    En streaming y en --bloques la lectura se intercala con la generación,
+    así que solo las fallas del lector se informan como error de lectura:
+    las del resto (normalización, carpetas, historial) se propagan igual
+    que en el modo normal.
+    """
+    lector = iter(lector)
+    while True:
+        try:
+            elemento = next(lector)
+        except StopIteration:
+            return
+        except Exception as e:
+            raise ErrorLectura(str(e)) from e
+        yield elemento
+
+
+def _error_lectura(error, donde=None):
+    """Imprime el error de lectura de los modos streaming y --bloques (`donde`: hasta dónde se leyó)."""
+    print("ERROR al leer el archivo" + (f" ({donde})" if donde else "") + f": {error}")
+
+
+def _fecha_carpeta(fecha_valor):
+    """Fecha del examen para el nombre de carpeta (YYYY-MM-DD)."""
+    if pd.isna(fecha_valor):
+        return datetime.now().strftime("%Y-%m-%d")
+    if isinstance(fecha_valor, str):
+        return fecha_valor.replace('/', '-').replace(' ', '_')[:10]
+    try:
+        return fecha_valor.strftime("%Y-%m-%d")
+    except:
+        return str(fecha_valor)[:10]
+
+
+def _datos_carpeta(comuna, establecimiento, fecha):
+    """Obtiene comuna, establecimiento y fecha de una fila para el nombre de carpeta."""
+    comuna = "Sin_Comuna" if pd.isna(comuna) else str(comuna).strip()
+    establecimiento = "Sin_Establecimiento" if pd.isna(establecimiento) else str(establecimiento).strip()
+    return comuna, establecimiento, _fecha_carpeta(fecha)
+
+
+def _clave_nombre(nombre):
+    """Forma canónica (normalizar_nombre) de una comuna o establecimiento, como queda en la carpeta."""
+    return normalizar_nombre(limpiar_nombre_archivo(nombre))
+
+
+def _clave_carpeta(comuna, establecimiento, fecha_examen):
+    """Clave del grupo de una fila: comuna y establecimiento en su forma canónica (_clave_nombre)."""
+    return _clave_nombre(comuna), _clave_nombre(establecimiento), fecha_examen
+
+
+class CarpetasGrupo:
+    """Carpeta de salida de cada grupo (COMUNA, ESTABLECIMIENTO, FECHA) de una ejecución.
+
+    Las variantes que solo difieren en mayúsculas, tildes, puntos o
+    espacios ('LAS CONDES' y 'Las Condes ') son un solo grupo, con la
+    carpeta y los datos de la primera que aparece: en un disco que no
+    distingue mayúsculas (macOS, Windows) serían la misma carpeta y un
+    grupo pisaría el resumen y el manifiesto del otro. Cada variante que
+    se junta con otra se avisa la primera vez que aparece.
+    """
+
+    def __init__(self, carpeta_salida=None):
+        self.carpeta_salida = carpeta_salida
+        self.grupos = {}  # clave -> (carpeta, datos)
+        self.vistas = set()
+
+    def carpeta(self, comuna, establecimiento, fecha, donde=None):
+        """Retorna (carpeta de salida, (comuna, establecimiento, fecha_examen)) del grupo de una fila.
+
+        `donde` (p. ej. las filas) acompaña el aviso si la fila es una variante de otro grupo.
+        """
+        datos = _datos_carpeta(comuna, establecimiento, fecha)
+        clave = _clave_carpeta(*datos)
+        grupo = self.grupos.get(clave)
+        if grupo is None:
+            grupo = self.grupos[clave] = (_carpeta_salida(self.carpeta_salida, *datos), datos)
+        elif datos not in self.vistas:
+            print(f"Aviso: '{' / '.join(datos)}' va en la carpeta de '{' / '.join(grupo[1])}' "
+                  f"(solo cambian mayúsculas, tildes o espacios)" + (f" ({donde})" if donde else ""))
+        self.vistas.add(datos)
+        return grupo
+
+
+def agrupar_pacientes(df, carpeta_salida=None, carpetas=None):
+    """Agrupa las filas por (COMUNA, ESTABLECIMIENTO, FECHA).
+
+    Retorna {carpeta de salida: ((comuna, establecimiento, fecha_examen), posiciones)}
+    en el orden en que aparece cada grupo en el Excel. Las variantes de un
+    mismo grupo (ver CarpetasGrupo) quedan juntas y toman los datos de la
+    primera. `carpetas` (CarpetasGrupo) permite repartir en las mismas
+    carpetas las filas de varias llamadas, como los bloques de
+    _procesar_por_bloques.
+    """
+    if carpetas is None:
+        carpetas = CarpetasGrupo(carpeta_salida)
+    claves = df.reindex(columns=['COMUNA', 'ESTABLECIMIENTO', 'FECHA'])
+    indices = claves.groupby(list(claves.columns), dropna=False, sort=False).indices
+    filas = df['_fila'].to_numpy() if '_fila' in df else df.index.to_numpy() + 2
+    grupos = {}
+    for clave, posiciones in sorted(indices.items(), key=lambda item: item[1].min()):
+        carpeta, datos = carpetas.carpeta(*clave, donde=_texto_filas(filas[posiciones].tolist()))
+        grupos.setdefault(carpeta, (datos, []))[1].extend(posiciones)
+    orden = sorted(grupos.items(), key=lambda item: min(item[1][1]))
+    return {carpeta: (datos, sorted(map(int, posiciones))) for carpeta, (datos, posiciones) in orden}
+
+
+def _carpeta_salida(carpeta_salida, comuna, establecimiento, fecha_examen):
+    """Arma la ruta informes retidiag / COMUNA / Establecimiento_Fecha."""
+    # Limpiar nombres para usar como carpetas
+    comuna_limpia = limpiar_nombre_archivo(comuna)
+    establecimiento_limpio = limpiar_nombre_archivo(establecimiento)
+
+    # Crear carpeta con establecimiento y fecha
+    nombre_carpeta_establecimiento = f"{establecimiento_limpio}_{fecha_examen}"
+    return os.path.join(carpeta_salida or OUTPUT_DIR, comuna_limpia, nombre_carpeta_establecimiento)
+
+
+def _ruta_informe(idx, paciente, output_dir):
+    """Retorna (nombre, ruta PDF) del informe individual de un Paciente."""
+    nombre = paciente.nombre or f'paciente_{idx}'
+    nombre_archivo = limpiar_nombre_archivo(nombre)
+
+    # Subcarpeta por resultado
+    resultado_dir = os.path.join(output_dir, paciente.resultado.replace(' ', '_'))
+
+    # Nombre del archivo PDF
+    return nombre, os.path.join(resultado_dir, f"{nombre_archivo}.pdf")
+
+
+def _tarea_paciente(idx, paciente, output_dir):
+    """Arma la tarea (paciente, ruta PDF, nombre, resultado) de un Paciente.
+
+    No crea la subcarpeta del resultado: eso lo hace RutasInformes.agregar.
+    """
+    nombre, pdf_path = _ruta_informe(idx, paciente, output_dir)
+    return paciente, pdf_path, nombre, paciente.resultado
+
+
+class RutasInformes:
+    """Carpetas y archivos de los informes de una ejecución.
+
+    Cada subcarpeta de resultado se crea una sola vez por ejecución (y no
+    con un os.makedirs por paciente, que en una carpeta de red es una
+    espera más) y, en la misma pasada, se detectan los pacientes cuyo
+    nombre limpio da el mismo archivo que otro, que se sobrescribirían.
+    Con crear_carpetas=False (p. ej. para un ZIP) solo se detectan los choques.
+    """
+
+    def __init__(self, crear_carpetas=True):
+        self.crear_carpetas = crear_carpetas
+        self.carpetas = set()
+        self.nombres = {}  # ruta PDF -> nombres de los pacientes que van a ese archivo
+
+    def agregar(self, pdf_path, nombre):
+        """Registra el informe de un paciente; retorna False si su archivo ya era de otro."""
+        carpeta = os.path.dirname(pdf_path)
+        if self.crear_carpetas and carpeta not in self.carpetas:
+            os.makedirs(carpeta, exist_ok=True)
+            self.carpetas.add(carpeta)
+        nombres = self.nombres.setdefault(pdf_path, [])
+        nombres.append(nombre)
+        return len(nombres) == 1
+
+    def avisar_colisiones(self, maximo=20):
+        """Avisa qué archivos tocan a más de un paciente (queda el de la última fila)."""
+        colisiones = [(ruta, nombres) for ruta, nombres in self.nombres.items() if len(nombres) > 1]
+        if not colisiones:
+            return
+        print(f"Aviso: {len(colisiones)} archivos de informe corresponden a más de un paciente "
+              f"(queda solo el de la última fila):")
+        for ruta, nombres in colisiones[:maximo]:
+            print(f"  {ruta}: " + ", ".join(nombres))
+        if len(colisiones) > maximo:
+            print(f"  ... y {len(colisiones) - maximo} más")
+
+
+# Manifiesto de la generación incremental (en cada carpeta Establecimiento_Fecha)
+NOMBRE_MANIFIESTO = "manifiesto_informes.json"
+VERSION_MANIFIESTO = 1
+
+# Huellas de logos y firmas ya calculadas en esta ejecución: ruta -> huella
+_HUELLAS_ARCHIVOS = {}
+
+
+def _huella_archivo(ruta):
+    """Identifica una imagen por ruta, tamaño y fecha de modificación."""
+    if not ruta:
+        return ""
+    huella = _HUELLAS_ARCHIVOS.get(ruta)
+    if huella is None:
+        try:
+            info = os.stat(ruta)
+            huella = f"{ruta}:{info.st_size}:{info.st_mtime_ns}"
+        except OSError:
+            huella = f"{ruta}:-"
+        _HUELLAS_ARCHIVOS[ruta] = huella
+    return huella
+
+
+def huella_paciente(paciente, motor):
+    """Hash de los datos normalizados del paciente, las imágenes que usa su informe y el motor.
+
+    La salida compacta cuenta como parte del motor: al activarla o
+    desactivarla se regeneran los informes.
+    """
+    firma, _ = _firma_informe(paciente.resultado, paciente)
+    if _SALIDA_COMPACTA:
+        motor = f"{motor}\0compacta"
+    h = hashlib.sha1(f"{VERSION_MANIFIESTO}\0{motor}".encode('utf-8'))
+    for campo in Paciente.__slots__:
+        h.update(f"\0{getattr(paciente, campo)}".encode('utf-8'))
+    for ruta in (LOGO_RETIDIAG,
+                 obtener_logo_establecimiento(paciente.comuna), firma):
+        h.update(f"\0{_huella_archivo(ruta)}".encode('utf-8'))
+    return h.hexdigest()
+
+
+def huella_resumen_pacientes(pacientes, establecimiento, fecha_examen):
+    """Hash de todo lo que aparece en el resumen Excel."""
+    h = hashlib.sha1(f"{establecimiento}\0{fecha_examen}".encode('utf-8'))
+    h.update(_huella_archivo(LOGO_RETIDIAG).encode('utf-8'))
+    for p in pacientes:
+        h.update("\0".join(['', p.fecha, p.institucion, p.rut, p.nombre, p.edad, p.resultado,
+                            p.detalle_od, p.detalle_oi, p.derivacion]).encode('utf-8'))
+    return h.hexdigest()
+
+
+def leer_manifiesto(output_dir):
+    """Lee el manifiesto de la carpeta ({} si no existe o no es válido)."""
+    try:
+        with open(os.path.join(output_dir, NOMBRE_MANIFIESTO), encoding='utf-8') as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifiesto.get('version') != VERSION_MANIFIESTO:
+        return {}
+    return manifiesto
+
+
+def guardar_manifiesto(output_dir, huellas, fallidos, huella_resumen, libros=(), datos=None):
+    """Guarda el manifiesto; los informes que fallaron no se registran para reintentarlos.
+
+    `huellas` es un dict {ruta relativa: huella} o un iterable de esos pares
+    (p. ej. de FilasProcesadas); los informes se escriben a medida que se
+    recorren, sin armar el manifiesto completo en memoria. También se
+    guardan los libros de donde salieron las filas (`libros`) y la comuna,
+    establecimiento y fecha del grupo (`datos`), para saber de quién es la
+    carpeta si el grupo desaparece del libro (ver eliminar_grupos_huerfanos).
+    """
+    fallidos = {os.path.relpath(ruta, output_dir) for ruta in fallidos}
+    informes = sorted(huellas.items()) if isinstance(huellas, dict) else huellas
+    ruta = os.path.join(output_dir, NOMBRE_MANIFIESTO)
+    with medir_etapa('manifiesto'), escritura_atomica(ruta, 'w') as f:
+        f.write('{\n "informes": {')
+        separador = '\n'
+        for informe, huella in informes:
+            if informe not in fallidos:
+                f.write(f'{separador}  {json.dumps(informe, ensure_ascii=False)}: {json.dumps(huella)}')
+                separador = ',\n'
+        f.write(f'\n }},\n "libros": {json.dumps(_libros_manifiesto(libros), ensure_ascii=False)},'
+                f'\n "grupo": {json.dumps(list(datos) if datos else None, ensure_ascii=False)},'
+                f'\n "resumen": {json.dumps(huella_resumen)},\n "version": {VERSION_MANIFIESTO}\n}}\n')
+
+
+def _libros_manifiesto(libros):
+    """Rutas absolutas (sin enlaces) de los libros, como se guardan en el manifiesto."""
+    return sorted({os.path.realpath(ruta) for ruta in libros})
+
+
+# Diario de la ejecución en curso (en cada carpeta Establecimiento_Fecha)
+NOMBRE_DIARIO = "diario_informes.jsonl"
+
+
+class DiarioInformes:
+    """Diario de los informes ya terminados de una carpeta, para retomar con --resume.
+
+    Mientras se genera un grupo, cada informe que termina (bien o con
+    error) agrega una línea al diario. Al cerrar el grupo, con el resumen
+    y el manifiesto ya guardados, el diario se borra: si queda uno es que
+    la ejecución anterior se interrumpió, y sus informes terminados son los
+    que --resume no vuelve a generar.
+    """
+
+    def __init__(self, output_dir, huellas):
+        self.output_dir = output_dir
+        self.huellas = huellas
+        self.ruta = os.path.join(output_dir, NOMBRE_DIARIO)
+        self.archivo = None
+
+    def leer(self):
+        """{ruta relativa: huella} de los informes generados según el diario.
+
+        Retorna None si no hay diario. Si un informe aparece varias veces
+        vale la última línea; una última línea cortada se ignora.
+        """
+        try:
+            f = open(self.ruta, encoding='utf-8')
+        except OSError:
+            return None
+        terminados = {}
+        with f:
+            for linea in f:
+                try:
+                    entrada = json.loads(linea)
+                except ValueError:
+                    continue
+                terminados[entrada['informe']] = entrada.get('huella')
+        return {ruta: huella for ruta, huella in terminados.items() if huella}
+
+    def anotar(self, pdf_path, error=None, huella=None):
+        """Agrega al diario un informe terminado (con su huella, o con el error si falló).
+
+        Sin `huella` se toma la del informe en las huellas del grupo.
+        """
+        if self.archivo is None:
+            self.archivo = open(self.ruta, 'a', encoding='utf-8')
+        ruta = os.path.relpath(pdf_path, self.output_dir)
+        entrada = ({'informe': ruta, 'error': error} if error else
+                   {'informe': ruta, 'huella': huella or self.huellas[ruta]})
+        self.archivo.write(json.dumps(entrada, ensure_ascii=False) + '\n')
+        self.archivo.flush()
+
+    def cerrar(self):
+        if self.archivo is not None:
+            self.archivo.close()
+            self.archivo = None
+
+    def borrar(self):
+        """Cierra y borra el diario (el grupo terminó o se empieza de nuevo)."""
+        self.cerrar()
+        if os.path.exists(self.ruta):
+            os.remove(self.ruta)
+
+
+def _abrir_diario(output_dir, huellas, reanudar):
+    """DiarioInformes de la carpeta y los informes que se pueden retomar de él.
+
+    Si quedó el diario de una ejecución interrumpida se avisa y se borran
+    los temporales que dejó; con reanudar=False el diario se descarta.
+    Retorna (diario, {ruta relativa: huella} de los informes terminados).
+    """
+    diario = DiarioInformes(output_dir, huellas)
+    terminados = diario.leer()
+    if terminados is None:
+        return diario, {}
+    for temporal in glob.glob(os.path.join(glob.escape(output_dir), '**', '*.tmp'), recursive=True):
+        os.remove(temporal)
+    if reanudar:
+        print(f"Retomando ejecución interrumpida en {output_dir}: {len(terminados)} informes ya terminados")
+        return diario, terminados
+    print(f"Aviso: la ejecución anterior quedó interrumpida en {output_dir} "
+          f"(use --resume para no repetir sus {len(terminados)} informes terminados)")
+    diario.borrar()
+    return diario, {}
+
+
+def _eliminar_informes_obsoletos(output_dir, anterior, huellas):
+    """Borra los PDFs del manifiesto anterior que ya no corresponden a ninguna fila."""
+    eliminados = 0
+    for ruta in set(anterior.get('informes', {})) - set(huellas):
+        try:
+            os.remove(os.path.join(output_dir, ruta))
+            eliminados += 1
+        except FileNotFoundError:
+            pass
+    return eliminados
+
+
+def eliminar_grupos_huerfanos(carpeta_salida, libros, carpetas):
+    """Borra la salida de los grupos que estos libros generaron antes y que ya no tienen filas.
+
+    Se revisan los manifiestos de COMUNA/Establecimiento_Fecha bajo la
+    carpeta de salida. Si todos los libros de un manifiesto están en
+    `libros` y su carpeta no es ninguna de `carpetas` (las de los grupos
+    actuales), el grupo quedó sin filas: se quitó su única fila o se
+    corrigió un dato que la movió a otro grupo. Se borran sus PDFs, su
+    resumen Excel y su manifiesto, y las carpetas que queden vacías.
+    Retorna cuántos PDFs se borraron.
+    """
+    libros = set(_libros_manifiesto(libros))
+    # Se compara por inodo: en un disco que no distingue mayúsculas la
+    # carpeta de un grupo actual puede aparecer con otro nombre
+    actuales = set()
+    for carpeta in carpetas:
+        try:
+            info = os.stat(carpeta)
+            actuales.add((info.st_dev, info.st_ino))
+        except OSError:
+            pass
+    raiz = carpeta_salida or OUTPUT_DIR
+    eliminados = 0
+    for ruta in sorted(glob.glob(os.path.join(glob.escape(raiz), '*', '*', NOMBRE_MANIFIESTO))):
+        output_dir = os.path.dirname(ruta)
+        info = os.stat(output_dir)
+        manifiesto = leer_manifiesto(output_dir)
+        propios = manifiesto.get('libros')
+        if (info.st_dev, info.st_ino) in actuales or not propios or not set(propios) <= libros:
+            continue
+        pdfs = _eliminar_informes_obsoletos(output_dir, manifiesto, ())
+        datos = manifiesto.get('grupo')
+        archivos = [ruta] + ([_ruta_resumen(datos[1], datos[2], output_dir)] if datos else [])
+        for archivo in archivos:
+            try:
+                os.remove(archivo)
+            except FileNotFoundError:
+                pass
+        for carpeta, _, _ in os.walk(output_dir, topdown=False):
+            try:
+                os.rmdir(carpeta)
+            except OSError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(output_dir))
+        except OSError:
+            pass
+        print(f"Grupo sin filas en el Excel: {output_dir} ({pdfs} PDFs eliminados)")
+        eliminados += pdfs
+    return eliminados
+
+
+def _ruta_resumen(establecimiento, fecha_examen, output_dir):
+    """Ruta del archivo Excel resumen de pacientes."""
+    establecimiento_limpio = limpiar_nombre_archivo(establecimiento)
+    return os.path.join(output_dir, f"{establecimiento_limpio}_{fecha_examen}.xlsx")
+
+
+# Historial de informes generados (SQLite), ver HistorialInformes
+ESQUEMA_HISTORIAL = """
+CREATE TABLE IF NOT EXISTS informes (
+    rut TEXT NOT NULL,          -- normalizado con normalizar_rut
+    fecha TEXT NOT NULL,        -- AAAA-MM-DD (o el texto de la celda si no es fecha; sin fecha, la
+                                -- del día en que se generó, como la carpeta)
+    establecimiento TEXT NOT NULL,
+    comuna TEXT,
+    nombre TEXT,
+    resultado TEXT,             -- categoría del informe (NORMAL, CATARATA, OTROS...)
+    archivo TEXT,
+    generado TEXT,
+    resultado_final TEXT,       -- RESULTADO FINAL tal como venía en la hoja
+    clave_establecimiento TEXT  -- establecimiento en la forma canónica del grupo (_clave_nombre)
+);
+CREATE INDEX IF NOT EXISTS informes_establecimiento_fecha ON informes (establecimiento, fecha);
+"""
+
+
+def normalizar_rut(rut):
+    """RUT sin puntos ni espacios y con guión antes del dígito verificador ('12345678-5').
+
+    Acepta también el RUT como número con el dígito al final (123456785).
+    Retorna '' si no hay RUT.
+    """
+    limpio = re.sub(r'[^0-9K]', '', str(rut).upper())
+    return f"{limpio[:-1]}-{limpio[-1]}" if len(limpio) > 1 else ''
+
+
+def _fecha_historial(fecha):
+    """Fecha del informe (dd/mm/aaaa) en formato ISO, para ordenar y filtrar por año.
+
+    Sin fecha es la de hoy, la misma que lleva la carpeta del informe (_fecha_carpeta).
+    """
+    if not fecha:
+        return datetime.now().strftime("%Y-%m-%d")
+    try:
+        return datetime.strptime(fecha, "%d/%m/%Y").date().isoformat()
+    except ValueError:
+        return fecha
+
+
+class HistorialInformes:
+    """Registro de los informes generados en una base SQLite.
+
+    Hay una fila por RUT, fecha y establecimiento: si el mismo informe se
+    vuelve a generar se actualiza su resultado y archivo. El establecimiento
+    se compara en la forma canónica con que se agrupan las filas
+    (_clave_nombre): 'CESFAM A' y 'Cesfam A ' son el mismo. Las consultas por
+    RUT y la detección de RUT ya informados en el año usan los índices.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.conexion = sqlite3.connect(ruta)
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        self.conexion.executescript(ESQUEMA_HISTORIAL)
+        self._migrar()
+
+    def _migrar(self):
+        """Agrega a una base de una versión anterior las columnas que le faltan."""
+        columnas = {fila[1] for fila in self.conexion.execute("PRAGMA table_info(informes)")}
+        with self.conexion:
+            if 'resultado_final' not in columnas:
+                self.conexion.execute("ALTER TABLE informes ADD COLUMN resultado_final TEXT")
+            if 'clave_establecimiento' not in columnas:
+                self.conexion.execute("ALTER TABLE informes ADD COLUMN clave_establecimiento TEXT")
+                establecimientos = self.conexion.execute("SELECT DISTINCT establecimiento FROM informes")
+                self.conexion.executemany(
+                    "UPDATE informes SET clave_establecimiento = ? WHERE establecimiento = ?",
+                    [(_clave_nombre(fila[0]), fila[0]) for fila in establecimientos.fetchall()])
+                # Los registros que ahora son el mismo informe: queda el último generado
+                self.conexion.execute(
+                    "DELETE FROM informes WHERE EXISTS (SELECT 1 FROM informes AS otro "
+                    "WHERE otro.rut = informes.rut AND otro.fecha = informes.fecha "
+                    "AND otro.clave_establecimiento = informes.clave_establecimiento "
+                    "AND (otro.generado, otro.rowid) > (informes.generado, informes.rowid))")
+                self.conexion.execute("DROP INDEX IF EXISTS informes_rut_fecha_establecimiento")
+            self.conexion.execute("CREATE UNIQUE INDEX IF NOT EXISTS informes_rut_fecha_clave "
+                                  "ON informes (rut, fecha, clave_establecimiento)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.conexion.close()
+
+    def registrar(self, informes):
+        """Registra (en una sola transacción) los pares (Paciente, archivo) generados.
+
+        Los pacientes sin RUT no se registran. Retorna cuántos se registraron.
+        """
+        generado = datetime.now().isoformat(timespec='seconds')
+        filas = [(rut, _fecha_historial(p.fecha), p.institucion, p.comuna, p.nombre, p.resultado,
+                  os.path.abspath(archivo), generado, p.resultado_final, _clave_nombre(p.institucion))
+                 for p, archivo in informes for rut in (normalizar_rut(p.rut),) if rut]
+        with medir_etapa('historial', filas=len(filas)), self.conexion:
+            self.conexion.executemany(
+                "INSERT INTO informes (rut, fecha, establecimiento, comuna, nombre, resultado, archivo, "
+                "generado, resultado_final, clave_establecimiento) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (rut, fecha, clave_establecimiento) DO UPDATE SET "
+                "establecimiento = excluded.establecimiento, comuna = excluded.comuna, "
+                "nombre = excluded.nombre, resultado = excluded.resultado, "
+                "archivo = excluded.archivo, generado = excluded.generado, "
+                "resultado_final = excluded.resultado_final", filas)
+        return len(filas)
+
+    def buscar(self, rut):
+        """Informes de un RUT, del más reciente al más antiguo, como dicts."""
+        cursor = self.conexion.execute(
+            "SELECT * FROM informes WHERE rut = ? ORDER BY fecha DESC", (normalizar_rut(rut),))
+        columnas = [descripcion[0] for descripcion in cursor.description]
+        return [dict(zip(columnas, fila)) for fila in cursor]
+
+    def ya_informados(self, pacientes):
+        """Informes previos del mismo año para los RUT de `pacientes`.
+
+        Solo cuentan los de otra fecha u otro establecimiento (el mismo
+        informe regenerado no es un duplicado). Retorna {rut: [(fecha,
+        establecimiento, resultado), ...]}, con el RESULTADO FINAL de la
+        hoja (o la categoría en los registros que no lo tienen).
+        """
+        claves = {(normalizar_rut(p.rut), _fecha_historial(p.fecha), _clave_nombre(p.institucion))
+                  for p in pacientes}
+        with medir_etapa('historial'), self.conexion:
+            self.conexion.execute("CREATE TEMP TABLE IF NOT EXISTS lote "
+                                  "(rut TEXT, fecha TEXT, clave_establecimiento TEXT)")
+            self.conexion.execute("DELETE FROM temp.lote")
+            self.conexion.executemany("INSERT INTO temp.lote VALUES (?, ?, ?)",
+                                      [clave for clave in claves if clave[0]])
+            filas = self.conexion.execute(
+                "SELECT DISTINCT lote.rut, i.fecha, i.establecimiento, "
+                "COALESCE(NULLIF(i.resultado_final, ''), i.resultado) "
+                "FROM temp.lote AS lote JOIN informes AS i ON i.rut = lote.rut "
+                "WHERE substr(i.fecha, 1, 4) = substr(lote.fecha, 1, 4) "
+                "AND NOT (i.fecha = lote.fecha AND i.clave_establecimiento = lote.clave_establecimiento) "
+                "ORDER BY lote.rut, i.fecha").fetchall()
+        previos = {}
+        for rut, fecha, establecimiento, resultado in filas:
+            previos.setdefault(rut, []).append((fecha, establecimiento, resultado))
+        return previos
+
+
+def abrir_historial(ruta):
+    """HistorialInformes de `ruta`, o un contexto vacío (None) si no se pidió historial."""
+    return HistorialInformes(ruta) if ruta else nullcontext()
+
+
+def avisar_ya_informados(historial, pacientes, maximo=20):
+    """Avisa antes de generar qué RUT ya tienen otro informe ese año en el historial."""
+    if historial is None:
+        return
+    previos = historial.ya_informados(pacientes)
+    if not previos:
+        return
+    print(f"Aviso: {len(previos)} RUT ya tienen otro informe este año en el historial:")
+    for rut, informes in list(previos.items())[:maximo]:
+        print(f"  {rut}: " + "; ".join(f"{fecha} {establecimiento} ({resultado})"
+                                       for fecha, establecimiento, resultado in informes))
+    if len(previos) > maximo:
+        print(f"  ... y {len(previos) - maximo} más")
+
+
+def consultar_historial(ruta, rut):
+    """Imprime los informes registrados de un RUT. Retorna cuántos hay."""
+    with HistorialInformes(ruta) as historial:
+        informes = historial.buscar(rut)
+    if not informes:
+        print(f"Sin informes registrados para {normalizar_rut(rut) or rut}")
+        return 0
+    print(f"Historial de {informes[0]['rut']} ({len(informes)} informes):")
+    for informe in informes:
+        print(f"  {informe['fecha']}  {informe['establecimiento']} ({informe['comuna']})  "
+              f"{informe['resultado_final'] or informe['resultado']}  {informe['nombre']}  "
+              f"-> {informe['archivo']}")
+    return len(informes)
+
+
+def procesar_excel(excel_path, carpeta_salida=None, workers=1, motor='platypus', streaming=False,
+                   regenerar=False, consolidado=None, zip_path=None, compacto=False, historial=None,
+                   reanudar=False, estricto=False, bloques=None):
+    """Procesa el archivo Excel y genera los PDFs.
+
+    Las filas se agrupan por (COMUNA, ESTABLECIMIENTO, FECHA) y cada grupo
+    va a su propia carpeta con su propio resumen Excel.
+    Con workers > 1 los PDFs de todos los grupos se generan en paralelo en
+    un mismo pool de procesos.
+    `motor` elige el renderizador: 'platypus' (generar_pdf), 'canvas'
+    (generar_pdf_canvas) o 'plantilla' (generar_pdf_plantilla).
+    Con streaming=True la hoja se lee fila a fila (leer_pacientes_streaming)
+    y los PDFs se generan mientras se lee.
+
+    En cada carpeta de salida se guarda un manifiesto con la huella de cada
+    informe; al volver a procesar el mismo Excel solo se regeneran las filas
+    cuya huella cambió y se borran los PDFs de filas eliminadas (salvo con
+    regenerar=True o en modo streaming, que generan todo).
+
+    Con consolidado='establecimiento' o 'diagnostico' no se generan PDFs
+    individuales sino uno por carpeta de establecimiento o por carpeta de
+    diagnóstico (ver generar_pdf_consolidado); en ese modo se genera todo.
+
+    Con zip_path no se escribe la carpeta de salida: los PDFs y resúmenes
+    se generan en memoria y van directo a ese ZIP (ver _procesar_zip).
+
+    Con compacto=True los PDFs se generan con salida compacta (ver
+    usar_salida_compacta), pensada para subirlos al portal.
+
+    Con historial (ruta de una base SQLite) cada informe generado queda
+    registrado en ella y antes de generar se avisa qué RUT ya tienen otro
+    informe ese año (ver HistorialInformes).
+
+    Cada PDF se escribe de forma atómica y en cada carpeta se lleva un
+    diario de los informes terminados; con reanudar=True no se repiten los
+    que dejó terminados una ejecución interrumpida (ver DiarioInformes).
+    El resumen Excel de cada carpeta se escribe recién cuando todos sus
+    informes se generaron o quedaron anotados como fallidos.
+
+    Antes de generar se validan todas las filas (ver validar_pacientes) y
+    se imprimen los problemas con su número de fila; con estricto=True, si
+    hay alguno no se genera nada. En modo streaming no se valida.
+
+    Con bloques=N el archivo se lee, valida, normaliza y genera de a N
+    filas, con un pico de memoria que no depende del largo de la hoja (ver
+    _procesar_por_bloques); reemplaza a streaming y no se usa con ZIP ni
+    consolidado.
+    """
+    usar_salida_compacta(compacto)
+
+    print(f"\n{'='*60}")
+    print("GENERADOR DE INFORMES RETINOGRÁFICOS - RETIDIAG")
+    print(f"{'='*60}\n")
+
+    if not os.path.exists(excel_path):
+        print(f"ERROR: No se encontró el archivo: {excel_path}")
+        return False
+
+    print(f"Leyendo archivo: {excel_path}")
+
+    if bloques and (zip_path or consolidado):
+        print("Aviso: --bloques no se usa con --zip ni --consolidado (el archivo se lee completo)")
+        bloques = None
+    if bloques and streaming:
+        print("Aviso: con --bloques no se usa --streaming (el archivo se lee por bloques)")
+        streaming = False
+    if streaming and os.path.splitext(excel_path)[1].lower() in EXTENSIONES_TABLA:
+        print("Aviso: --streaming solo se usa con Excel; el archivo se lee completo")
+        streaming = False
+    if streaming and estricto:
+        print("Aviso: con --streaming las filas no se validan antes de generar (--estricto no se usa)")
+
+    with abrir_historial(historial) as registro:
+        if bloques:
+            return _procesar_por_bloques(excel_path, carpeta_salida, workers, motor, bloques, registro,
+                                         reanudar, estricto)
+        if streaming:
+            return _procesar_excel_streaming(excel_path, carpeta_salida, workers, motor, registro, reanudar)
+
+        df = _leer_pacientes_excel(excel_path)
+        if df is None:
+            return False
+
+        print(f"Pacientes encontrados: {len(df)}")
+
+        avisar_imagenes_faltantes()
+        if validar_entrada(df, os.path.basename(excel_path)) and estricto:
+            print("ERROR: --estricto: corrija las filas indicadas; no se generó ningún informe")
+            return False
+
+        if reanudar and (zip_path or consolidado):
+            print("Aviso: --resume no se usa con --zip ni --consolidado (se genera todo)")
+        if zip_path:
+            return _procesar_zip(df, zip_path, workers, motor, registro)
+        if consolidado:
+            return _procesar_consolidado(df, carpeta_salida, workers, motor, consolidado, registro)
+
+        # Normalizar todas las filas de una vez y separarlas por
+        # comuna / establecimiento / fecha (cada grupo va a su propia carpeta)
+        grupos = _preparar_grupos(df, carpeta_salida, motor, regenerar, reanudar, [excel_path])
+        if not regenerar:
+            eliminar_grupos_huerfanos(carpeta_salida, [excel_path], [grupo['output_dir'] for grupo in grupos])
+        if len(grupos) > 1:
+            print(f"Grupos (comuna, establecimiento, fecha): {len(grupos)}")
+
+        total_exitosos, total_errores = _procesar_grupos(grupos, workers, motor, historial=registro)
+
+        if len(grupos) > 1:
+            print(f"\nTOTAL: {total_exitosos} PDFs generados, {total_errores} errores en {len(grupos)} carpetas "
+                  f"({_tamano_legible(sum(grupo['bytes'] for grupo in grupos))})\n")
+
+        return True
 
-        # Crear subcarpeta por resultado
-        resultado_dir = os.path.join(output_dir, resultado.replace(' ', '_'))
-        os.makedirs(resultado_dir, exist_ok=True)
 
-        # Nombre del archivo PDF
-        pdf_filename = f"{nombre_archivo}.pdf"
-        pdf_path = os.path.join(resultado_dir, pdf_filename)
+def _procesar_zip(df, zip_path, workers, motor, historial=None):
+    """Genera los informes en memoria y los escribe directo en un ZIP.
 
+    Dentro del ZIP se usa la misma estructura que en disco
+    (COMUNA/Establecimiento_Fecha/RESULTADO/Nombre.pdf) y los resúmenes
+    Excel se agregan al final. El ZIP se escribe en un archivo temporal
+    que reemplaza a zip_path solo si todo terminó bien.
+    """
+    pacientes = normalizar_pacientes(df)
+    avisar_ya_informados(historial, pacientes)
+    # Rutas relativas dentro del ZIP: se agrupa con base "." y se normaliza
+    grupos = {os.path.normpath(carpeta): grupo
+              for carpeta, grupo in agrupar_pacientes(df, os.curdir).items()}
+
+    # Si dos filas van al mismo archivo, en disco queda la última: aquí
+    # solo se genera esa, para no repetir nombres dentro del ZIP
+    tareas = {}
+    rutas = RutasInformes(crear_carpetas=False)
+    for carpeta, (_, posiciones) in grupos.items():
+        for idx in posiciones:
+            nombre, ruta = _ruta_informe(idx, pacientes[idx], carpeta)
+            rutas.agregar(ruta, nombre)
+            tareas.pop(ruta, None)
+            tareas[ruta] = (pacientes[idx], ruta, nombre, pacientes[idx].resultado)
+    rutas.avisar_colisiones()
+
+    exitosos = errores = 0
+    tamanos = []
+    generados = []
+    temporal = zip_path + '.tmp'
+    try:
+        with medir_etapa('pdfs', pdfs=len(tareas)), zipfile.ZipFile(temporal, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archivo_zip:
+            for ruta, nombre, resultado, error, contenido in ejecutar_tareas(
+                    list(tareas.values()), workers, motor, _generar_pdf_memoria_tarea):
+                if error is None:
+                    with medir_etapa('zip'):
+                        archivo_zip.writestr(ruta, contenido)
+                    print(f"✓ {nombre} -> {resultado}")
+                    exitosos += 1
+                    tamanos.append(len(contenido))
+                    generados.append((tareas[ruta][0], os.path.join(zip_path, ruta)))
+                else:
+                    print(f"✗ ERROR con {nombre}: {error}")
+                    errores += 1
+
+            # Resúmenes Excel al final, también en memoria
+            for carpeta, ((_, establecimiento, fecha_examen), posiciones) in grupos.items():
+                buffer = io.BytesIO()
+                generar_resumen_pacientes([pacientes[i] for i in posiciones], establecimiento,
+                                          fecha_examen, carpeta, destino=buffer)
+                archivo_zip.writestr(_ruta_resumen(establecimiento, fecha_examen, carpeta),
+                                     buffer.getvalue())
+        os.replace(temporal, zip_path)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+    if historial is not None:
+        historial.registrar(generados)
+    _imprimir_resumen(exitosos, errores, zip_path, tamanos=tamanos)
+    return True
+
+
+def _procesar_consolidado(df, carpeta_salida, workers, motor, modo, historial=None):
+    """Genera los PDFs consolidados (por establecimiento o por diagnóstico) y los resúmenes."""
+    pacientes = normalizar_pacientes(df)
+    avisar_ya_informados(historial, pacientes)
+    grupos = agrupar_pacientes(df, carpeta_salida)
+
+    # Una tarea por PDF consolidado; en cada uno los pacientes van en el
+    # orden del Excel (por establecimiento, además agrupados por diagnóstico)
+    tareas = []
+    for output_dir, ((comuna, establecimiento, fecha_examen), posiciones) in grupos.items():
+        os.makedirs(output_dir, exist_ok=True)
+        descripcion = f"{comuna} / {establecimiento}"
+        base = f"{limpiar_nombre_archivo(establecimiento)}_{fecha_examen}"
+        informes = [(pacientes[i], _ruta_informe(i, pacientes[i], output_dir)[1]) for i in posiciones]
+        if modo == 'establecimiento':
+            orden = {diagnostico: n for n, diagnostico in enumerate(ORDEN_DIAGNOSTICOS)}
+            informes.sort(key=lambda informe: orden.get(informe[0].resultado, len(orden)))
+            entradas = [(paciente, os.path.relpath(ruta, output_dir)) for paciente, ruta in informes]
+            tareas.append((entradas, os.path.join(output_dir, f"{base}.pdf"), descripcion, motor, True))
+            continue
+        por_diagnostico = {}
+        for paciente, ruta in informes:
+            por_diagnostico.setdefault(paciente.resultado, []).append((paciente, os.path.basename(ruta)))
+        for resultado, entradas in por_diagnostico.items():
+            carpeta = os.path.join(output_dir, resultado.replace(' ', '_'))
+            os.makedirs(carpeta, exist_ok=True)
+            tareas.append((entradas, os.path.join(carpeta, f"{base}_{resultado.replace(' ', '_')}.pdf"),
+                           f"{descripcion} / {resultado}", motor, False))
+
+    exitosos = errores = 0
+    tamanos = []
+    generados = []
+    entradas_pdf = {tarea[1]: tarea[0] for tarea in tareas}
+    with medir_etapa('pdfs', pdfs=len(tareas)):
+        for pdf_path, descripcion, paginas, error in ejecutar_tareas(tareas, workers, motor,
+                                                                    _generar_consolidado_tarea):
+            if error is None:
+                print(f"✓ {descripcion} -> {os.path.basename(pdf_path)} ({paginas} páginas)")
+                exitosos += 1
+                tamanos.append(os.path.getsize(pdf_path))
+                generados += [(paciente, pdf_path) for paciente, _ in entradas_pdf[pdf_path]]
+            else:
+                print(f"✗ ERROR con {descripcion}: {error}")
+                errores += 1
+    if historial is not None:
+        historial.registrar(generados)
+
+    print(f"\n{'='*60}")
+    print(f"RESUMEN:")
+    print(f"  - PDFs consolidados: {exitosos} ({len(pacientes)} pacientes)")
+    print(f"  - Errores: {errores}")
+    _imprimir_tamanos(tamanos)
+    print(f"{'='*60}\n")
+
+    # Resumen Excel de cada carpeta de establecimiento
+    for output_dir, ((_, establecimiento, fecha_examen), posiciones) in grupos.items():
+        generar_resumen_pacientes([pacientes[i] for i in posiciones], establecimiento, fecha_examen,
+                                  output_dir)
+
+    return errores == 0
+
+
+# Formatos de entrada: el Excel con la hoja INPUT, o una tabla con sus columnas
+EXTENSIONES_EXCEL = ('.xlsx', '.xlsm')
+EXTENSIONES_TABLA = ('.csv', '.parquet')
+VERSION_CACHE_EXCEL = 1
+
+
+def _columna_input(columna):
+    """Si la columna (con o sin espacios de más) es una de COLUMNAS_INPUT."""
+    return str(columna).strip() in COLUMNAS_INPUT
+
+
+def _importar_parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Para leer y guardar Parquet instale pyarrow: pip3 install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def _formato_csv(ruta):
+    """(codificación, separador) de un CSV: UTF-8 (con o sin BOM) o Latin-1, y ';' o ','.
+
+    El archivo se recorre de a 1 MB para ver si es UTF-8 válido, sin
+    cargarlo completo.
+    """
+    codificacion = 'utf-8-sig'
+    decodificador = codecs.getincrementaldecoder(codificacion)()
+    with open(ruta, 'rb') as f:
+        encabezado = f.readline()
+        f.seek(0)
         try:
-            generar_pdf(paciente.to_dict(), pdf_path, styles)
+            for bloque in iter(lambda: f.read(1 << 20), b''):
+                decodificador.decode(bloque)
+            decodificador.decode(b'', final=True)
+        except UnicodeDecodeError:
+            codificacion = 'latin-1'
+    encabezado = encabezado.decode(codificacion, errors='replace')
+    return codificacion, ';' if encabezado.count(';') > encabezado.count(',') else ','
+
+
+def _fechas_csv(df):
+    """Pasa a datetime las fechas ISO (2026-01-16) de la columna FECHA de un CSV."""
+    if 'FECHA' in df.columns.str.strip():
+        columna = df.columns[df.columns.str.strip() == 'FECHA'][0]
+        df[columna] = df[columna].map(fecha_iso)
+    return df
+
+
+def _leer_csv(ruta, bloque=None):
+    """Lee un CSV con las columnas de INPUT (separado por ',' o ';', en UTF-8 o Latin-1).
+
+    Las celdas se leen como texto y las fechas ISO (2026-01-16) se pasan a
+    datetime, así el informe y la carpeta salen igual que desde el Excel.
+    Con `bloque` retorna un iterador de DataFrames de a `bloque` filas.
+    """
+    codificacion, separador = _formato_csv(ruta)
+    df = pd.read_csv(ruta, sep=separador, encoding=codificacion, dtype=str, usecols=_columna_input,
+                     chunksize=bloque)
+    return _fechas_csv(df) if bloque is None else map(_fechas_csv, df)
+
+
+def _leer_parquet(ruta):
+    """Lee de un Parquet solo las columnas de INPUT."""
+    _, pq = _importar_parquet()
+    columnas = [nombre for nombre in pq.read_schema(ruta).names if _columna_input(nombre)]
+    return pd.read_parquet(ruta, columns=columnas)
+
+
+def _ruta_cache_excel(excel_path):
+    """Caché Parquet de un Excel: un archivo oculto junto al libro (.Libro.xlsm.parquet)."""
+    carpeta, nombre = os.path.split(excel_path)
+    return os.path.join(carpeta, f".{nombre}.parquet")
+
+
+def _huella_libro(ruta):
+    """SHA-1 del contenido del archivo."""
+    h = hashlib.sha1()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def _leer_cache_excel(excel_path):
+    """DataFrame guardado en la caché del Excel, o None si no hay caché o el libro cambió.
+
+    La caché vale si el libro tiene el mismo tamaño y fecha de modificación
+    que al guardarla o, si no, el mismo SHA-1 (p. ej. se copió sin cambios).
+    """
+    ruta = _ruta_cache_excel(excel_path)
+    if not os.path.exists(ruta):
+        return None
+    try:
+        _, pq = _importar_parquet()
+        metadatos = pq.read_schema(ruta).metadata or {}
+        clave = json.loads(metadatos.get(b'retidiag', b'{}'))
+        info = os.stat(excel_path)
+        if clave.get('version') != VERSION_CACHE_EXCEL or clave.get('columnas') != COLUMNAS_INPUT:
+            return None
+        if ((clave.get('tamano'), clave.get('mtime_ns')) != (info.st_size, info.st_mtime_ns)
+                and clave.get('sha1') != _huella_libro(excel_path)):
+            return None
+        df = pq.read_table(ruta).to_pandas()
+    except (RuntimeError, OSError, ValueError):
+        return None
+    # Columnas que mezclaban textos con otros valores (p. ej. FECHA con
+    # fechas y textos): los textos se guardaron en una columna aparte
+    for columna in clave.get('mixtas', []):
+        textos = df.pop(f"{columna}__texto")
+        df[columna] = textos.where(textos.notna(), df[columna].astype(object))
+    return df[clave['orden']]
+
+
+def _guardar_cache_excel(excel_path, df):
+    """Guarda el DataFrame leído del Excel en su caché Parquet (ver _leer_cache_excel).
+
+    Si no se puede (sin pyarrow, carpeta de solo lectura, tipos que Parquet
+    no admite) se avisa y se sigue: la caché solo ahorra tiempo.
+    """
+    try:
+        pa, pq = _importar_parquet()
+    except RuntimeError:
+        return
+    tabla = df.copy()
+    mixtas = []
+    for columna in df.columns:
+        if df[columna].dtype == object:
+            es_texto = df[columna].map(lambda valor: isinstance(valor, str))
+            if es_texto.any() and not es_texto[df[columna].notna()].all():
+                tabla[columna] = df[columna].where(~es_texto)
+                tabla[f"{columna}__texto"] = df[columna].where(es_texto)
+                mixtas.append(columna)
+    try:
+        info = os.stat(excel_path)
+        clave = {'version': VERSION_CACHE_EXCEL, 'columnas': COLUMNAS_INPUT, 'tamano': info.st_size,
+                 'mtime_ns': info.st_mtime_ns, 'sha1': _huella_libro(excel_path),
+                 'orden': list(df.columns), 'mixtas': mixtas}
+        tabla = pa.Table.from_pandas(tabla, preserve_index=False)
+        tabla = tabla.replace_schema_metadata({**(tabla.schema.metadata or {}),
+                                               b'retidiag': json.dumps(clave).encode('utf-8')})
+        with escritura_atomica(_ruta_cache_excel(excel_path)) as f:
+            pq.write_table(tabla, f)
+    except (OSError, ValueError, TypeError, pa.ArrowException) as e:
+        print(f"Aviso: no se pudo guardar la caché de {os.path.basename(excel_path)}: {e}")
+
+
+def _leer_tabla(ruta, cache, datos):
+    """Lee las columnas de INPUT de un Excel, CSV o Parquet según la extensión.
+
+    Con cache=True un Excel se lee de su caché Parquet si el libro no cambió
+    (datos['cache'] queda en True). Guardar la caché queda para quien llama.
+    """
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension == '.csv':
+        return _leer_csv(ruta)
+    if extension == '.parquet':
+        return _leer_parquet(ruta)
+    if cache:
+        df = _leer_cache_excel(ruta)
+        if df is not None:
+            datos['cache'] = True
+            print(f"  (desde la caché {os.path.basename(_ruta_cache_excel(ruta))}: el libro no cambió)")
+            return df
+    return pd.read_excel(ruta, sheet_name='INPUT', engine='openpyxl', usecols=_columna_input)
+
+
+def _leer_pacientes_excel(excel_path, cache=True):
+    """Lee la hoja INPUT y deja solo las filas con nombre de paciente.
+
+    También acepta un CSV o un Parquet con las mismas columnas. Solo se
+    leen las columnas de COLUMNAS_INPUT. Un Excel leído se guarda en una
+    caché Parquet junto al libro, y mientras el libro no cambie las
+    siguientes ejecuciones no vuelven a leer el Excel (con cache=False
+    siempre se lee el libro).
+
+    Retorna el DataFrame, o None si no se pudo leer o falta una columna
+    (el error ya queda impreso).
+    """
+    # Leer el archivo (solo la lectura cae en este error; lo demás se propaga)
+    with medir_etapa('lectura', archivo=excel_path) as datos:
+        try:
+            df = _leer_tabla(excel_path, cache, datos)
+        except Exception as e:
+            print(f"ERROR al leer el archivo: {e}")
+            return None
+        es_excel = os.path.splitext(excel_path)[1].lower() not in ('.csv', '.parquet')
+        if cache and es_excel and not datos.get('cache'):
+            _guardar_cache_excel(excel_path, df)
+    # Limpiar espacios en nombres de columnas
+    df.columns = df.columns.str.strip()
+
+    # Verificar columnas necesarias
+    for col in COLUMNAS_REQUERIDAS:
+        if col not in df.columns:
+            print(f"ERROR: Falta la columna '{col}' en el archivo")
+            return None
+
+    # Filtrar filas válidas (que tengan nombre de paciente)
+    return df[df['NOMBRE PACIENTE'].notna()]
+
+
+def _bloques_excel(excel_path, tamano):
+    """DataFrames de a `tamano` filas de la hoja INPUT, leída con openpyxl en modo solo lectura."""
+    wb = load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        filas = wb['INPUT'].iter_rows(values_only=True)
+        encabezado = [str(c).strip() if c is not None else '' for c in next(filas, ())]
+        indices = {}
+        for i, col in enumerate(encabezado):
+            if col in COLUMNAS_INPUT:
+                indices.setdefault(col, i)
+        inicio = 0
+        for bloque in iter(lambda: list(islice(filas, tamano)), []):
+            yield pd.DataFrame([[fila[i] if i < len(fila) else None for i in indices.values()]
+                                for fila in bloque],
+                               columns=list(indices), index=pd.RangeIndex(inicio, inicio + len(bloque)))
+            inicio += len(bloque)
+    finally:
+        wb.close()
+
+
+def _bloques_parquet(ruta, tamano):
+    """DataFrames de a `tamano` filas de las columnas de INPUT de un Parquet."""
+    _, pq = _importar_parquet()
+    archivo = pq.ParquetFile(ruta)
+    columnas = [nombre for nombre in archivo.schema_arrow.names if _columna_input(nombre)]
+    inicio = 0
+    for lote in archivo.iter_batches(batch_size=tamano, columns=columnas):
+        df = lote.to_pandas()
+        df.index = pd.RangeIndex(inicio, inicio + len(df))
+        inicio += len(df)
+        yield df
+
+
+def leer_bloques(excel_path, tamano):
+    """Lee el Excel (o CSV o Parquet) de a `tamano` filas y entrega las que tienen nombre de paciente.
+
+    Cada bloque es un DataFrame como el de _leer_pacientes_excel, con el
+    índice de cada fila en el archivo (validar_pacientes da los mismos
+    números de fila). Nunca se tiene más de un bloque en memoria; el Excel
+    no pasa por la caché Parquet. Lanza ValueError si falta una columna
+    requerida.
+    """
+    extension = os.path.splitext(excel_path)[1].lower()
+    if extension == '.csv':
+        bloques = _leer_csv(excel_path, tamano)
+    elif extension == '.parquet':
+        bloques = _bloques_parquet(excel_path, tamano)
+    else:
+        bloques = _bloques_excel(excel_path, tamano)
+    for df in bloques:
+        df.columns = df.columns.str.strip()
+        for col in COLUMNAS_REQUERIDAS:
+            if col not in df.columns:
+                raise ValueError(f"Falta la columna '{col}' en el archivo")
+        df = df[df['NOMBRE PACIENTE'].notna()]
+        if len(df):
+            yield df
+
+
+def _preparar_grupos(df, carpeta_salida, motor, regenerar, reanudar=False, libros=()):
+    """Normaliza las filas y prepara un grupo por carpeta de salida (ver agrupar_pacientes).
+
+    `libros` son las rutas de los libros leídos (en el modo lote, en el
+    orden de la columna _libro); cada grupo guarda en su manifiesto los
+    libros de sus filas.
+    """
+    with medir_etapa('normalizacion', filas=len(df)):
+        pacientes = normalizar_pacientes(df)
+    rutas = RutasInformes()
+    libro_fila = df['_libro'].to_numpy() if '_libro' in df else None
+    grupos = []
+    with medir_etapa('preparacion', filas=len(df)):
+        for output_dir, (datos, posiciones) in agrupar_pacientes(df, carpeta_salida).items():
+            grupo = _preparar_grupo(output_dir, datos, [pacientes[i] for i in posiciones], posiciones,
+                                    motor, regenerar, reanudar, rutas)
+            if libro_fila is not None:
+                grupo['libros'] = [libros[i] for i in set(libro_fila[posiciones])]
+            else:
+                grupo['libros'] = libros
+            grupos.append(grupo)
+    rutas.avisar_colisiones()
+    return grupos
+
+
+def _procesar_grupos(grupos, workers, motor, al_cerrar=None, historial=None):
+    """Genera los PDFs pendientes de los grupos y cierra cada grupo.
+
+    Los PDFs pendientes de todos los grupos pasan por el mismo pool; cada
+    grupo se cierra (resumen Excel y manifiesto) apenas termina el último
+    de sus PDFs, mientras el pool sigue con los grupos siguientes.
+    `al_cerrar(grupo, fallidos)` se llama después de cerrar cada grupo.
+    Con `historial` (HistorialInformes) los PDFs de cada grupo se registran
+    al cerrarlo. Retorna (exitosos, errores) del total.
+    """
+    avisar_ya_informados(historial, [paciente for grupo in grupos for paciente in grupo['pacientes']])
+    resultados = escribir_en_segundo_plano(ejecutar_tareas(
+        [tarea for grupo in grupos for tarea in grupo['pendientes']], workers, motor,
+        _generar_pdf_memoria_tarea))
+    total_exitosos = total_errores = 0
+    try:
+        for grupo in grupos:
+            _imprimir_grupo(grupo, len(grupo['pacientes']) if len(grupos) > 1 else None)
+            diarios = {tarea[1]: grupo['diario'] for tarea in grupo['pendientes']}
+            with medir_etapa('pdfs', pdfs=len(grupo['pendientes'])):
+                exitosos, errores, fallidos = _contar_resultados(
+                    islice(resultados, len(grupo['pendientes'])), diarios)
+            _cerrar_grupo(grupo, exitosos, errores, fallidos)
+            _registrar_grupo(historial, grupo, fallidos)
+            if al_cerrar is not None:
+                al_cerrar(grupo, fallidos)
+            total_exitosos += exitosos
+            total_errores += errores
+    finally:
+        resultados.close()
+        for grupo in grupos:
+            grupo['diario'].cerrar()
+
+    return total_exitosos, total_errores
+
+
+def _registrar_grupo(historial, grupo, fallidos):
+    """Registra en el historial los PDFs que se generaron en el grupo."""
+    if historial is not None:
+        historial.registrar((paciente, pdf_path) for paciente, pdf_path, _, _ in grupo['pendientes']
+                            if pdf_path not in fallidos)
+
+
+def _preparar_grupo(output_dir, datos, pacientes, posiciones, motor, regenerar, reanudar=False, rutas=None):
+    """Arma las tareas de un grupo y las compara con el manifiesto de su carpeta.
+
+    Las carpetas se crean y los choques de nombres se registran en `rutas`
+    (RutasInformes); si dos filas van al mismo archivo solo se genera la
+    última.
+    Con reanudar=True tampoco se generan los informes que terminó una
+    ejecución interrumpida (ver DiarioInformes), aunque sea con regenerar.
+    Borra los PDFs de filas que ya no están y retorna un dict con lo necesario
+    para cerrar el grupo (ver _cerrar_grupo).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if rutas is None:
+        rutas = RutasInformes()
+
+    # Preparar tareas (rutas de salida deterministas, en el orden del Excel)
+    tareas = [_tarea_paciente(idx, paciente, output_dir) for idx, paciente in zip(posiciones, pacientes)]
+    for _, pdf_path, nombre, _ in tareas:
+        rutas.agregar(pdf_path, nombre)
+    ultima = {tarea[1]: i for i, tarea in enumerate(tareas)}
+
+    # Comparar con el manifiesto de la ejecución anterior
+    # (si dos filas van al mismo archivo, vale la huella de la última)
+    anterior = {} if regenerar else leer_manifiesto(output_dir)
+    huellas = {}
+    for paciente, pdf_path, _, _ in tareas:
+        huellas[os.path.relpath(pdf_path, output_dir)] = huella_paciente(paciente, motor)
+    diario, terminados = _abrir_diario(output_dir, huellas, reanudar)
+    if terminados:
+        anterior = dict(anterior, informes={**anterior.get('informes', {}), **terminados})
+    sin_cambios = {ruta for ruta, huella in huellas.items()
+                   if anterior.get('informes', {}).get(ruta) == huella
+                   and os.path.exists(os.path.join(output_dir, ruta))}
+    filas = [(idx, tarea) for i, (idx, tarea) in enumerate(zip(posiciones, tareas))
+             if ultima[tarea[1]] == i and os.path.relpath(tarea[1], output_dir) not in sin_cambios]
+
+    return {
+        'output_dir': output_dir,
+        'datos': datos,
+        'pacientes': pacientes,
+        'pendientes': [tarea for _, tarea in filas],
+        'filas': [idx for idx, _ in filas],
+        'posiciones': posiciones,
+        'huellas': huellas,
+        'anterior': anterior,
+        'diario': diario,
+        'omitidos': len(sin_cambios),
+        'eliminados': _eliminar_informes_obsoletos(output_dir, anterior, huellas),
+    }
+
+
+def _imprimir_grupo(grupo, pacientes=None):
+    """Imprime comuna, establecimiento, fecha y carpeta de un grupo (y cuántos pacientes tiene)."""
+    comuna, establecimiento, fecha_examen = grupo['datos']
+    print(f"Comuna: {comuna}")
+    print(f"Establecimiento: {establecimiento}")
+    print(f"Fecha examen: {fecha_examen}")
+    if pacientes is not None:
+        print(f"Pacientes: {pacientes}")
+    print(f"Carpeta de salida: {grupo['output_dir']}\n")
+
+
+def _cerrar_grupo(grupo, exitosos, errores, fallidos):
+    """Imprime el resumen del grupo, genera su resumen Excel y guarda su manifiesto.
+
+    Se llama cuando todos los informes del grupo se generaron o quedaron
+    anotados como fallidos; al final se borra el diario del grupo.
+    """
+    _, establecimiento, fecha_examen = grupo['datos']
+    output_dir = grupo['output_dir']
+    pacientes = grupo['pacientes']
+    tamanos = [os.path.getsize(tarea[1]) for tarea in grupo['pendientes'] if tarea[1] not in fallidos]
+    grupo['bytes'] = sum(tamanos)
+    _imprimir_resumen(exitosos, errores, output_dir, grupo['omitidos'], grupo['eliminados'], tamanos)
+
+    # Generar archivo resumen de pacientes (solo si cambió algo que aparece en él)
+    huella_resumen = huella_resumen_pacientes(pacientes, establecimiento, fecha_examen)
+    if (grupo['anterior'].get('resumen') != huella_resumen
+            or not os.path.exists(_ruta_resumen(establecimiento, fecha_examen, output_dir))):
+        generar_resumen_pacientes(pacientes, establecimiento, fecha_examen, output_dir)
+    else:
+        print("Resumen de pacientes sin cambios.")
+
+    guardar_manifiesto(output_dir, grupo['huellas'], fallidos, huella_resumen, grupo['libros'], grupo['datos'])
+    grupo['diario'].borrar()
+
+
+def _generar_informes(tareas, workers, motor, diarios=None):
+    """Genera los PDFs de las tareas e imprime ✓/✗ por paciente.
+
+    Retorna (exitosos, errores, rutas de los PDFs que fallaron).
+    """
+    # Procesar cada paciente (en serie o repartido en un pool de procesos);
+    # los PDFs se escriben en un hilo aparte mientras se renderizan los siguientes
+    with medir_etapa('pdfs'):
+        return _contar_resultados(escribir_en_segundo_plano(
+            ejecutar_tareas(tareas, workers, motor, _generar_pdf_memoria_tarea)), diarios)
+
+
+def _contar_resultados(resultados, diarios=None):
+    """Imprime ✓/✗ por cada resultado de ejecutar_tareas y los cuenta.
+
+    `diarios` ({ruta PDF: DiarioInformes}) indica en qué diario se anota
+    cada informe terminado. Retorna (exitosos, errores, rutas de los PDFs
+    que fallaron).
+    """
+    # Contadores
+    exitosos = 0
+    errores = 0
+    fallidos = set()
+
+    for pdf_path, nombre, resultado, error in resultados:
+        if diarios:
+            diarios[pdf_path].anotar(pdf_path, error)
+        if error is None:
             print(f"✓ {nombre} -> {resultado}")
             exitosos += 1
-        except Exception as e:
-            print(f"✗ ERROR con {nombre}: {e}")
+        else:
+            print(f"✗ ERROR con {nombre}: {error}")
             errores += 1
+            fallidos.add(pdf_path)
 
+    return exitosos, errores, fallidos
+
+
+def _imprimir_resumen(exitosos, errores, output_dir, omitidos=0, eliminados=0, tamanos=None):
+    """Imprime el resumen final de la generación (`tamanos`: bytes de cada PDF generado)."""
     print(f"\n{'='*60}")
     print(f"RESUMEN:")
     print(f"  - PDFs generados exitosamente: {exitosos}")
     print(f"  - Errores: {errores}")
+    _imprimir_tamanos(tamanos)
+    if omitidos:
+        print(f"  - Sin cambios (no regenerados): {omitidos}")
+    if eliminados:
+        print(f"  - PDFs eliminados (filas quitadas del Excel): {eliminados}")
     print(f"  - Ubicación: {output_dir}")
     print(f"{'='*60}\n")
 
-    # Generar archivo resumen de pacientes
-    generar_resumen_pacientes(df, establecimiento, fecha_examen, output_dir)
+
+def _tamano_legible(n_bytes):
+    """Bytes como texto corto (850 B, 31.2 KB, 4.7 MB)."""
+    if n_bytes < 1024:
+        return f"{n_bytes} B"
+    if n_bytes < 2**20:
+        return f"{n_bytes / 1024:.1f} KB"
+    return f"{n_bytes / 2**20:.1f} MB"
+
+
+def _imprimir_tamanos(tamanos):
+    """Imprime el tamaño total, promedio y máximo de los PDFs generados.
+
+    `tamanos` es la lista de bytes de cada PDF, o ya resumida como
+    (cantidad, total, máximo) (ver FilasProcesadas.tamanos).
+    """
+    if not tamanos:
+        return
+    cantidad, total, maximo = tamanos if isinstance(tamanos, tuple) else (len(tamanos), sum(tamanos),
+                                                                           max(tamanos))
+    if not cantidad:
+        return
+    modo = " (salida compacta)" if _SALIDA_COMPACTA else ""
+    print(f"  - Tamaño{modo}: {_tamano_legible(total)}, "
+          f"{_tamano_legible(total // cantidad)} promedio por PDF, "
+          f"máximo {_tamano_legible(maximo)}")
+
+
+def _procesar_excel_streaming(excel_path, carpeta_salida, workers, motor, historial=None, reanudar=False):
+    """Variante de procesar_excel que genera los PDFs mientras lee la hoja.
+
+    Genera todas las filas, salvo con reanudar=True las que terminó una
+    ejecución interrumpida (ver DiarioInformes). Los avisos de nombres sin
+    logo o firma y de RUT ya informados salen durante la lectura (ver
+    AvisosStreaming).
+    """
+    grupos = {}
+    diarios = {}
+    rutas = RutasInformes()
+    avisar_imagenes_faltantes()
+    avisos = AvisosStreaming(historial)
+    carpetas = CarpetasGrupo(carpeta_salida)
+
+    def tareas():
+        for idx, fila in enumerate(_lectura(leer_pacientes_streaming(excel_path))):
+            paciente = Paciente.desde_dict(fila)
+            avisos.revisar(paciente)
+            output_dir, datos = carpetas.carpeta(fila.get('COMUNA'), fila.get('ESTABLECIMIENTO'),
+                                                 fila.get('FECHA'), f"desde {paciente.nombre}")
+            grupo = grupos.get(output_dir)
+            if grupo is None:
+                grupo = grupos[output_dir] = {'output_dir': output_dir, 'datos': datos, 'pacientes': [],
+                                              'pendientes': [], 'huellas': {}, 'anterior': {},
+                                              'libros': [excel_path], 'omitidos': 0, 'eliminados': 0}
+                grupo['diario'], grupo['terminados'] = _abrir_diario(output_dir, grupo['huellas'], reanudar)
+            tarea = _tarea_paciente(idx, paciente, output_dir)
+            rutas.agregar(tarea[1], tarea[2])
+            ruta = os.path.relpath(tarea[1], output_dir)
+            grupo['huellas'][ruta] = huella_paciente(paciente, motor)
+            grupo['pacientes'].append(paciente)
+            if grupo['terminados'].get(ruta) == grupo['huellas'][ruta] and os.path.exists(tarea[1]):
+                grupo['omitidos'] += 1
+                continue
+            grupo['pendientes'].append(tarea)
+            diarios[tarea[1]] = grupo['diario']
+            yield tarea
+
+    try:
+        _, _, fallidos = _generar_informes(tareas(), workers, motor, diarios)
+    except ErrorLectura as e:
+        leidos = sum(len(grupo['pacientes']) for grupo in grupos.values())
+        _error_lectura(e, f"después de {leidos} pacientes leídos" if leidos else None)
+        return False
+    finally:
+        for grupo in grupos.values():
+            grupo['diario'].cerrar()
+
+    print(f"\nPacientes encontrados: {sum(len(g['pacientes']) for g in grupos.values())}")
+    avisos.resumir()
+    rutas.avisar_colisiones()
+    if len(grupos) > 1:
+        print(f"Grupos (comuna, establecimiento, fecha): {len(grupos)}")
+
+    for grupo in grupos.values():
+        errores = sum(1 for tarea in grupo['pendientes'] if tarea[1] in fallidos)
+        _imprimir_grupo(grupo, len(grupo['pacientes']) if len(grupos) > 1 else None)
+        _cerrar_grupo(grupo, len(grupo['pendientes']) - errores, errores,
+                      fallidos & {tarea[1] for tarea in grupo['pendientes']})
+        _registrar_grupo(historial, grupo, fallidos)
 
     return True
 
 
-def generar_resumen_pacientes(df, establecimiento, fecha_examen, output_dir):
-    """Genera el archivo Excel resumen de pacientes con formato y logo."""
+class FilasProcesadas:
+    """Filas ya procesadas en el modo por bloques, guardadas en una base SQLite temporal.
 
-    print("Generando resumen de pacientes...")
+    Al final, el resumen Excel, el manifiesto y el historial de cada
+    carpeta y el aviso de choques de nombres se arman recorriéndolas desde
+    la base, sin tener en memoria todos los pacientes. El estado de cada
+    fila es 'generado', 'error', 'omitido' (lo terminó una ejecución
+    interrumpida) o 'reemplazado' (una fila siguiente del bloque va al
+    mismo archivo).
+    """
+
+    def __init__(self, ruta):
+        self.conexion = sqlite3.connect(ruta)
+        self.conexion.execute(f"CREATE TABLE filas (grupo INTEGER, fila INTEGER, ruta TEXT, estado TEXT, "
+                              f"huella TEXT, bytes INTEGER, {', '.join(Paciente.__slots__)})")
+        self.conexion.execute("CREATE INDEX filas_grupo ON filas (grupo, fila)")
+
+    def agregar(self, filas):
+        """Guarda (en una sola transacción) filas (grupo, fila, ruta relativa, estado, huella, bytes, Paciente)."""
+        with medir_etapa('filas_procesadas', filas=len(filas)), self.conexion:
+            self.conexion.executemany(
+                f"INSERT INTO filas VALUES ({', '.join('?' * (6 + len(Paciente.__slots__)))})",
+                [(*fila[:6], *(getattr(fila[6], campo) for campo in Paciente.__slots__)) for fila in filas])
+
+    def pacientes(self, grupo):
+        """Paciente de cada fila del grupo, en el orden del archivo."""
+        for campos in self.conexion.execute(f"SELECT {', '.join(Paciente.__slots__)} FROM filas "
+                                            f"WHERE grupo = ? ORDER BY fila", (grupo,)):
+            yield Paciente(*campos)
+
+    def generados(self, grupo):
+        """(Paciente, ruta relativa) de los informes generados en el grupo."""
+        for campos in self.conexion.execute(f"SELECT ruta, {', '.join(Paciente.__slots__)} FROM filas "
+                                            f"WHERE grupo = ? AND estado = 'generado' ORDER BY fila", (grupo,)):
+            yield Paciente(*campos[1:]), campos[0]
+
+    def huellas(self, grupo):
+        """(ruta relativa, huella) de los informes del grupo que están en disco.
+
+        Si varias filas van al mismo archivo vale la última que lo escribió.
+        """
+        return self.conexion.execute(
+            "SELECT ruta, huella FROM (SELECT ruta, huella, MAX(fila) FROM filas WHERE grupo = ? "
+            "AND estado IN ('generado', 'omitido') GROUP BY ruta) ORDER BY ruta", (grupo,))
+
+    def tamanos(self, grupo):
+        """(cantidad, total, máximo) de los bytes de los PDFs generados en el grupo."""
+        return tuple(self.conexion.execute(
+            "SELECT COUNT(bytes), COALESCE(SUM(bytes), 0), MAX(bytes) FROM filas "
+            "WHERE grupo = ? AND estado = 'generado'", (grupo,)).fetchone())
+
+    def colisiones(self):
+        """(grupo, ruta relativa, nombre) de las filas cuyo archivo es también el de otra fila."""
+        return self.conexion.execute(
+            "SELECT grupo, ruta, nombre FROM filas WHERE (grupo, ruta) IN "
+            "(SELECT grupo, ruta FROM filas GROUP BY grupo, ruta HAVING COUNT(*) > 1) ORDER BY fila")
+
+    def cerrar(self):
+        self.conexion.close()
+
+
+def _procesar_por_bloques(excel_path, carpeta_salida, workers, motor, tamano, historial=None,
+                          reanudar=False, estricto=False):
+    """Variante de procesar_excel con memoria acotada: lee, valida, normaliza y genera de a `tamano` filas.
+
+    Del archivo nunca hay más de un bloque en memoria (leer_bloques) y las
+    tareas entran al pool a medida que este las procesa (ejecutar_tareas),
+    así el pico de memoria no depende del largo de la hoja. Cada fila
+    terminada se guarda en una base SQLite temporal (FilasProcesadas) y al
+    final, una carpeta a la vez, se escriben desde ella el resumen Excel,
+    el manifiesto y el historial.
+
+    Como en streaming se generan todas las filas, salvo con reanudar=True
+    las que terminó una ejecución interrumpida. Con estricto=True el
+    archivo se recorre una vez antes solo para validarlo.
+    """
+    nombre_archivo = os.path.basename(excel_path)
+
+    def validar(df):
+        return validar_entrada(df, f"{nombre_archivo} (filas {df.index[0] + 2}-{df.index[-1] + 2})",
+                               avisar_sin_problemas=False)
+
+    avisar_imagenes_faltantes()
+    if estricto:
+        con_problemas = 0
+        ultima_fila = None
+        try:
+            for df in _lectura(leer_bloques(excel_path, tamano)):
+                con_problemas += validar(df)
+                ultima_fila = df.index[-1] + 2
+        except ErrorLectura as e:
+            _error_lectura(e, ultima_fila and f"después de la fila {ultima_fila}")
+            return False
+        if con_problemas:
+            print("ERROR: --estricto: corrija las filas indicadas; no se generó ningún informe")
+            return False
+
+    grupos = {}
+    carpetas = set()
+    carpetas_salida = CarpetasGrupo(carpeta_salida)
+    en_curso = deque()  # (grupo, fila, ruta relativa, huella, Paciente) de cada tarea entregada
+    leidos = 0
+    ultima_fila = None
+
+    def tareas():
+        nonlocal leidos, ultima_fila
+        for df in _lectura(leer_bloques(excel_path, tamano)):
+            ultima_fila = df.index[-1] + 2
+            if not estricto:
+                validar(df)
+            with medir_etapa('normalizacion', filas=len(df)):
+                pacientes = normalizar_pacientes(df)
+            avisar_ya_informados(historial, pacientes)
+            sin_generar = []
+            for output_dir, (datos, posiciones) in agrupar_pacientes(df, carpetas=carpetas_salida).items():
+                grupo = grupos.get(output_dir)
+                if grupo is None:
+                    os.makedirs(output_dir, exist_ok=True)
+                    grupo = grupos[output_dir] = {'id': len(grupos), 'output_dir': output_dir, 'datos': datos,
+                                                  'pacientes': 0, 'exitosos': 0, 'errores': 0, 'omitidos': 0}
+                    grupo['diario'], grupo['terminados'] = _abrir_diario(output_dir, {}, reanudar)
+                grupo['pacientes'] += len(posiciones)
+                # Si dos filas del bloque van al mismo archivo solo se genera la última
+                bloque = [_tarea_paciente(leidos + i, pacientes[i], output_dir) for i in posiciones]
+                ultima = {tarea[1]: j for j, tarea in enumerate(bloque)}
+                for j, (i, tarea) in enumerate(zip(posiciones, bloque)):
+                    paciente, pdf_path = tarea[0], tarea[1]
+                    ruta = os.path.relpath(pdf_path, output_dir)
+                    huella = huella_paciente(paciente, motor)
+                    if ultima[pdf_path] != j:
+                        sin_generar.append((grupo['id'], leidos + i, ruta, 'reemplazado', huella, None, paciente))
+                    elif grupo['terminados'].get(ruta) == huella and os.path.exists(pdf_path):
+                        grupo['omitidos'] += 1
+                        sin_generar.append((grupo['id'], leidos + i, ruta, 'omitido', huella, None, paciente))
+                    else:
+                        carpeta = os.path.dirname(pdf_path)
+                        if carpeta not in carpetas:
+                            os.makedirs(carpeta, exist_ok=True)
+                            carpetas.add(carpeta)
+                        en_curso.append((grupo, leidos + i, ruta, huella, paciente))
+                        yield tarea
+            filas.agregar(sin_generar)
+            leidos += len(df)
+
+    def anotados(resultados):
+        # Cada resultado llega en el orden de las tareas: se anota en el
+        # diario de su carpeta y se guarda en la base de a un bloque
+        terminadas = []
+        for resultado in resultados:
+            grupo, fila, ruta, huella, paciente = en_curso.popleft()
+            pdf_path, _, _, error = resultado
+            grupo['diario'].anotar(pdf_path, error, huella)
+            if error is None:
+                grupo['exitosos'] += 1
+                terminadas.append((grupo['id'], fila, ruta, 'generado', huella, os.path.getsize(pdf_path),
+                                   paciente))
+            else:
+                grupo['errores'] += 1
+                terminadas.append((grupo['id'], fila, ruta, 'error', huella, None, paciente))
+            if len(terminadas) >= tamano:
+                filas.agregar(terminadas)
+                terminadas = []
+            yield resultado
+        filas.agregar(terminadas)
+
+    with tempfile.TemporaryDirectory(prefix='retidiag_bloques_') as temporal:
+        filas = FilasProcesadas(os.path.join(temporal, 'filas.sqlite'))
+        try:
+            try:
+                with medir_etapa('pdfs'):
+                    _contar_resultados(anotados(escribir_en_segundo_plano(
+                        ejecutar_tareas(tareas(), workers, motor, _generar_pdf_memoria_tarea))))
+            except ErrorLectura as e:
+                _error_lectura(e, ultima_fila and f"después de la fila {ultima_fila}")
+                return False
+            finally:
+                for grupo in grupos.values():
+                    grupo['diario'].cerrar()
+
+            print(f"\nPacientes encontrados: {leidos}")
+            carpetas_grupo = {grupo['id']: grupo['output_dir'] for grupo in grupos.values()}
+            rutas = RutasInformes(crear_carpetas=False)
+            for grupo_id, ruta, nombre in filas.colisiones():
+                rutas.agregar(os.path.join(carpetas_grupo[grupo_id], ruta), nombre)
+            rutas.avisar_colisiones()
+            if len(grupos) > 1:
+                print(f"Grupos (comuna, establecimiento, fecha): {len(grupos)}")
+
+            for grupo in grupos.values():
+                _, establecimiento, fecha_examen = grupo['datos']
+                output_dir = grupo['output_dir']
+                _imprimir_grupo(grupo, grupo['pacientes'] if len(grupos) > 1 else None)
+                _imprimir_resumen(grupo['exitosos'], grupo['errores'], output_dir, grupo['omitidos'],
+                                  tamanos=filas.tamanos(grupo['id']))
+                huella_resumen = huella_resumen_pacientes(filas.pacientes(grupo['id']), establecimiento,
+                                                          fecha_examen)
+                generar_resumen_pacientes(filas.pacientes(grupo['id']), establecimiento, fecha_examen,
+                                          output_dir)
+                guardar_manifiesto(output_dir, filas.huellas(grupo['id']), (), huella_resumen, [excel_path],
+                                   grupo['datos'])
+                grupo['diario'].borrar()
+                if historial is not None:
+                    generados = ((paciente, os.path.join(output_dir, ruta))
+                                 for paciente, ruta in filas.generados(grupo['id']))
+                    for lote in iter(lambda: list(islice(generados, tamano)), []):
+                        historial.registrar(lote)
+        finally:
+            filas.cerrar()
+
+    return True
+
+
+def buscar_libros(patron):
+    """Lista los Excel, CSV y Parquet de una carpeta o de un patrón glob, ordenados.
+
+    Omite los archivos de bloqueo de Excel (~$...) y, por ser ocultas, las
+    cachés Parquet de los Excel.
+    """
+    if os.path.isdir(patron):
+        rutas = [ruta for extension in EXTENSIONES_EXCEL + EXTENSIONES_TABLA
+                 for ruta in glob.glob(os.path.join(glob.escape(patron), '*' + extension))]
+    else:
+        rutas = glob.glob(patron)
+    return sorted(ruta for ruta in rutas
+                  if os.path.isfile(ruta) and not os.path.basename(ruta).startswith('~$'))
 
-    # Crear nuevo workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Resumen Pacientes"
 
+def procesar_lote(rutas, carpeta_salida=None, workers=1, motor='platypus', regenerar=False, compacto=False,
+                  historial=None, reanudar=False, estricto=False):
+    """Procesa varios Excel en una sola ejecución con un mismo pool de procesos.
+
+    Se leen todos los libros, sus filas se agrupan juntas por (COMUNA,
+    ESTABLECIMIENTO, FECHA) y todos los PDFs pasan por el mismo pool, que
+    se crea una sola vez. Al final se imprime el rendimiento por libro y
+    total. `historial`, `reanudar` y `estricto` son como en
+    procesar_excel (cada libro se valida por separado, con sus propias
+    filas). Retorna True si se pudieron leer todos los libros.
+    """
+    usar_salida_compacta(compacto)
+    print(f"\n{'='*60}")
+    print("GENERADOR DE INFORMES RETINOGRÁFICOS - RETIDIAG (LOTE)")
+    print(f"{'='*60}\n")
+
+    inicio = time.perf_counter()
+    avisar_imagenes_faltantes()
+    libros = []
+    dfs = []
+    con_problemas = 0
+    for ruta in rutas:
+        print(f"Leyendo archivo: {ruta}")
+        t0 = time.perf_counter()
+        df = _leer_pacientes_excel(ruta)
+        libros.append({'ruta': ruta, 'leido': df is not None, 'pacientes': 0, 'exitosos': 0,
+                       'errores': 0, 'lectura': time.perf_counter() - t0, 'generacion': 0.0})
+        if df is not None:
+            libros[-1]['pacientes'] = len(df)
+            dfs.append(df.assign(_libro=len(libros) - 1, _fila=df.index + 2))
+            con_problemas += validar_entrada(df, os.path.basename(ruta))
+
+    if not dfs:
+        print("ERROR: No se pudo leer ningún archivo Excel")
+        return False
+    if con_problemas and estricto:
+        print("ERROR: --estricto: corrija las filas indicadas; no se generó ningún informe")
+        return False
+
+    df = pd.concat(dfs, ignore_index=True)
+    libro_fila = df['_libro'].to_numpy()
+    print(f"\nLibros: {len(dfs)}  Pacientes encontrados: {len(df)}")
+
+    grupos = _preparar_grupos(df, carpeta_salida, motor, regenerar, reanudar,
+                              [libro['ruta'] for libro in libros])
+    if not regenerar:
+        eliminar_grupos_huerfanos(carpeta_salida, [libro['ruta'] for libro in libros if libro['leido']],
+                                  [grupo['output_dir'] for grupo in grupos])
+    print(f"Grupos (comuna, establecimiento, fecha): {len(grupos)}\n")
+
+    # Como los libros comparten el pool (y a veces carpetas), el tiempo que
+    # pasa entre el cierre de un grupo y el siguiente se reparte entre los
+    # libros según cuántas filas pendientes de ese grupo aporta cada uno.
+    ultimo_cierre = [time.perf_counter()]
+
+    def al_cerrar(grupo, fallidos):
+        ahora = time.perf_counter()
+        for idx, tarea in zip(grupo['filas'], grupo['pendientes']):
+            libro = libros[libro_fila[idx]]
+            libro['errores' if tarea[1] in fallidos else 'exitosos'] += 1
+        filas = grupo['filas'] or grupo['posiciones']
+        for idx in filas:
+            libros[libro_fila[idx]]['generacion'] += (ahora - ultimo_cierre[0]) / len(filas)
+        ultimo_cierre[0] = ahora
+
+    with abrir_historial(historial) as registro:
+        exitosos, errores = _procesar_grupos(grupos, workers, motor, al_cerrar, registro)
+    fin = time.perf_counter()
+
+    _imprimir_rendimiento_lote(libros, fin - inicio, exitosos, errores)
+    return all(libro['leido'] for libro in libros)
+
+
+def _imprimir_rendimiento_lote(libros, total, exitosos, errores):
+    """Imprime PDFs, errores, tiempos y PDFs/s por libro y del lote completo."""
+    print(f"\n{'='*60}")
+    print("RENDIMIENTO DEL LOTE:")
+    for libro in libros:
+        nombre = os.path.basename(libro['ruta'])
+        if not libro['leido']:
+            print(f"  - {nombre}: no se pudo leer")
+            continue
+        tiempo = libro['lectura'] + libro['generacion']
+        ritmo = libro['exitosos'] / tiempo if tiempo > 0 else 0.0
+        print(f"  - {nombre}: {libro['pacientes']} pacientes, {libro['exitosos']} PDFs, "
+              f"{libro['errores']} errores, lectura {libro['lectura']:.1f} s, "
+              f"generación {libro['generacion']:.1f} s ({ritmo:.1f} PDFs/s)")
+    ritmo = exitosos / total if total > 0 else 0.0
+    print(f"  TOTAL: {exitosos} PDFs, {errores} errores en {total:.1f} s ({ritmo:.1f} PDFs/s)")
+    print(f"{'='*60}\n")
+
+
+# Estilos con nombre del resumen Excel: se registran una vez por libro y
+# cada celda solo guarda el nombre (sin copiar fuente, borde y relleno)
+ENCABEZADOS_RESUMEN = ["N°", "Fecha", "Centro", "Rut", "Nombre", "Edad", "Diagnóstico",
+                       "Ojo Derecho", "Ojo Izquierdo", "Observación"]
+ALINEACION_RESUMEN = ['c', 'c', 'i', 'c', 'i', 'c', 'c', 'c', 'c', 'i']  # centro / izquierda
+ANCHOS_RESUMEN = {'A': 5, 'B': 12, 'C': 30, 'D': 12, 'E': 28, 'F': 6, 'G': 12, 'H': 12, 'I': 12, 'J': 25}
+
+
+def _estilos_resumen(wb):
+    """Registra en `wb` los estilos con nombre del resumen Excel."""
     # Colores
     azul_header = PatternFill(start_color="2c5282", end_color="2c5282", fill_type="solid")
     azul_claro = PatternFill(start_color="e8f0fe", end_color="e8f0fe", fill_type="solid")
     blanco = PatternFill(start_color="FFFFFF", end_color="FFFFFF", fill_type="solid")
 
     # Estilos
-    title_font = Font(bold=True, size=16, color="2c5282")
-    header_font = Font(bold=True, size=10, color="FFFFFF")
-    data_font = Font(size=10)
-    thin_border = Border(
-        left=Side(style='thin', color='2c5282'),
-        right=Side(style='thin', color='2c5282'),
-        top=Side(style='thin', color='2c5282'),
-        bottom=Side(style='thin', color='2c5282')
-    )
+    lado = Side(style='thin', color='2c5282')
+    thin_border = Border(left=lado, right=lado, top=lado, bottom=lado)
     center_align = Alignment(horizontal='center', vertical='center')
     left_align = Alignment(horizontal='left', vertical='center')
 
+    wb.add_named_style(NamedStyle(name='resumen_titulo', font=Font(bold=True, size=16, color="2c5282"),
+                                  alignment=center_align))
+    wb.add_named_style(NamedStyle(name='resumen_encabezado', font=Font(bold=True, size=10, color="FFFFFF"),
+                                  fill=azul_header, border=thin_border, alignment=center_align))
+    # Filas de datos: alineación (c/i) × fila par (azul claro) / impar (blanco)
+    for sufijo, alineacion in (('c', center_align), ('i', left_align)):
+        for paridad, relleno in ((0, azul_claro), (1, blanco)):
+            wb.add_named_style(NamedStyle(name=f'resumen_{sufijo}{paridad}', font=Font(size=10),
+                                          fill=relleno, border=thin_border, alignment=alineacion))
+
+
+def _celda(ws, valor, estilo):
+    """Celda de solo escritura con un estilo con nombre."""
+    celda = WriteOnlyCell(ws, value=valor)
+    celda.style = estilo
+    return celda
+
+
+@medir_etapa('resumen')
+def generar_resumen_pacientes(pacientes, establecimiento, fecha_examen, output_dir, destino=None):
+    """Genera el archivo Excel resumen de pacientes (lista o iterador de Paciente) con formato y logo.
+
+    Usa un libro de openpyxl en modo solo escritura: las filas se escriben a
+    medida que se recorren los pacientes, sin guardar las celdas en memoria.
+    Con `destino` (un archivo abierto o BytesIO) el libro se escribe ahí en
+    lugar de en output_dir.
+    """
+
+    print("Generando resumen de pacientes...")
+
+    # Crear nuevo workbook (solo escritura)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Resumen Pacientes")
+    _estilos_resumen(wb)
+
+    # Ajustar ancho de columnas (antes de escribir filas)
+    for col, ancho in ANCHOS_RESUMEN.items():
+        ws.column_dimensions[col].width = ancho
+
     # Agregar logo de Retidiag (filas 1-4)
-    logo_path = os.path.join(LOGOS_DIR, "logo_retidiag.jpg")
-    if os.path.exists(logo_path):
+    logo_path = registro_imagenes().logo_retidiag
+    if logo_path:
         img = XLImage(logo_path)
         img.width = 150
         img.height = 45
         ws.add_image(img, 'A1')
 
-    # Ajustar altura de filas para el logo
+    # Ajustar altura de filas para el logo, título y encabezados
     for row in range(1, 5):
         ws.row_dimensions[row].height = 15
+    ws.row_dimensions[6].height = 25
+    ws.row_dimensions[7].height = 20
+    for _ in range(5):
+        ws.append([])
 
     # Fila 6: Nombre del establecimiento
-    ws.merge_cells('A6:J6')
-    cell_estab = ws.cell(row=6, column=1, value=establecimiento)
-    cell_estab.font = title_font
-    cell_estab.alignment = center_align
-    ws.row_dimensions[6].height = 25
+    ws.merged_cells.add('A6:J6')
+    ws.append([_celda(ws, establecimiento, 'resumen_titulo')])
 
     # Fila 7: Encabezados
-    encabezados = ["N°", "Fecha", "Centro", "Rut", "Nombre", "Edad", "Diagnóstico", "Ojo Derecho", "Ojo Izquierdo", "Observación"]
-    for col, encabezado in enumerate(encabezados, 1):
-        cell = ws.cell(row=7, column=col, value=encabezado)
-        cell.font = header_font
-        cell.fill = azul_header
-        cell.border = thin_border
-        cell.alignment = center_align
-    ws.row_dimensions[7].height = 20
-
-    # Fila 8 en adelante: Datos de pacientes
-    for idx, (_, paciente) in enumerate(df.iterrows(), 1):
-        row = idx + 7  # Empezar en fila 8
-
-        # Alternar colores de fila
-        fill = azul_claro if idx % 2 == 0 else blanco
-
-        # N°
-        cell = ws.cell(row=row, column=1, value=idx)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Fecha
-        fecha = paciente.get('FECHA', '')
-        if not pd.isna(fecha):
-            if hasattr(fecha, 'strftime'):
-                fecha = fecha.strftime("%d/%m/%Y")
-            else:
-                fecha = str(fecha)[:10]
-        else:
-            fecha = ""
-        cell = ws.cell(row=row, column=2, value=fecha)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Centro
-        centro = str(paciente.get('ESTABLECIMIENTO', '')).strip() if not pd.isna(paciente.get('ESTABLECIMIENTO')) else ''
-        cell = ws.cell(row=row, column=3, value=centro)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = left_align
-
-        # Rut
-        rut = str(paciente.get('RUT', '')).strip() if not pd.isna(paciente.get('RUT')) else ''
-        cell = ws.cell(row=row, column=4, value=rut)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Nombre
-        nombre = str(paciente.get('NOMBRE PACIENTE', '')).strip() if not pd.isna(paciente.get('NOMBRE PACIENTE')) else ''
-        cell = ws.cell(row=row, column=5, value=nombre)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = left_align
-
-        # Edad
-        edad = int(paciente.get('EDAD', 0)) if not pd.isna(paciente.get('EDAD')) else ''
-        cell = ws.cell(row=row, column=6, value=edad)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Diagnóstico (de RESULTADO FINAL) - convertir a texto descriptivo
-        diagnostico_raw = str(paciente.get('RESULTADO FINAL', '')).strip().upper() if not pd.isna(paciente.get('RESULTADO FINAL')) else ''
-        diagnostico = TEXTOS_RESUMEN_DIAGNOSTICO.get(diagnostico_raw, diagnostico_raw.title())
-        cell = ws.cell(row=row, column=7, value=diagnostico)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Ojo Derecho
-        ojo_derecho = str(paciente.get('DETALLE OD', '')).strip() if not pd.isna(paciente.get('DETALLE OD')) else ''
-        cell = ws.cell(row=row, column=8, value=ojo_derecho)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Ojo Izquierdo
-        ojo_izquierdo = str(paciente.get('DETALLE OI', '')).strip() if not pd.isna(paciente.get('DETALLE OI')) else ''
-        cell = ws.cell(row=row, column=9, value=ojo_izquierdo)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = center_align
-
-        # Observación (desde campo Derivacion)
-        derivacion = str(paciente.get('Derivacion', '')).strip() if not pd.isna(paciente.get('Derivacion')) else ''
-        cell = ws.cell(row=row, column=10, value=derivacion)
-        cell.border = thin_border
-        cell.fill = fill
-        cell.font = data_font
-        cell.alignment = left_align
-
-    # Ajustar ancho de columnas
-    anchos = {'A': 5, 'B': 12, 'C': 30, 'D': 12, 'E': 28, 'F': 6, 'G': 12, 'H': 12, 'I': 12, 'J': 25}
-    for col, ancho in anchos.items():
-        ws.column_dimensions[col].width = ancho
+    ws.append([_celda(ws, encabezado, 'resumen_encabezado') for encabezado in ENCABEZADOS_RESUMEN])
+
+    # Fila 8 en adelante: Datos de pacientes (colores de fila alternados)
+    estilos_fila = [[f'resumen_{alineacion}{paridad}' for alineacion in ALINEACION_RESUMEN]
+                    for paridad in (0, 1)]
+    for idx, paciente in enumerate(pacientes, 1):
+        valores = [
+            idx,
+            paciente.fecha[:10],
+            paciente.institucion,
+            paciente.rut,
+            paciente.nombre,
+            int(paciente.edad) if paciente.edad else '',
+            # Diagnóstico (de RESULTADO FINAL) - convertir a texto descriptivo
+            TEXTOS_RESUMEN_DIAGNOSTICO.get(paciente.resultado, paciente.resultado.title()),
+            paciente.detalle_od,
+            paciente.detalle_oi,
+            # Observación (desde campo Derivacion)
+            paciente.derivacion,
+        ]
+        ws.append([_celda(ws, valor, estilo) for valor, estilo in zip(valores, estilos_fila[idx % 2])])
 
     # Guardar archivo
-    establecimiento_limpio = limpiar_nombre_archivo(establecimiento)
-    nombre_archivo = f"{establecimiento_limpio}_{fecha_examen}.xlsx"
-    ruta_archivo = os.path.join(output_dir, nombre_archivo)
+    ruta_archivo = _ruta_resumen(establecimiento, fecha_examen, output_dir)
+
+    if destino is not None:
+        wb.save(destino)
+    else:
+        with escritura_atomica(ruta_archivo) as f:
+            wb.save(f)
+    print(f"✓ Resumen guardado: {os.path.basename(ruta_archivo)}")
+
+
+def ejecutar_trabajo(excel_path, carpeta_salida=None, workers=1, motor='platypus', streaming=False,
+                     regenerar=False, consolidado=None, zip_path=None, compacto=False, historial=None,
+                     reanudar=False, estricto=False, bloques=None):
+    """Procesa un Excel, o varios en modo lote si excel_path es una carpeta o un patrón glob.
+
+    Es lo que hace una ejecución por línea de comandos y cada trabajo del
+    daemon. Retorna True si se pudo procesar.
+    """
+    if os.path.isdir(excel_path) or any(c in excel_path for c in '*?['):
+        rutas = buscar_libros(excel_path)
+        if not rutas:
+            print(f"ERROR: No se encontraron archivos Excel en: {excel_path}")
+            return False
+        if streaming or consolidado or zip_path or bloques:
+            print("Aviso: --streaming, --bloques, --consolidado y --zip no se usan en modo lote")
+        return procesar_lote(rutas, carpeta_salida, workers=workers, motor=motor, regenerar=regenerar,
+                             compacto=compacto, historial=historial, reanudar=reanudar, estricto=estricto)
+    return procesar_excel(excel_path, carpeta_salida, workers=workers, motor=motor,
+                          streaming=streaming and not (consolidado or zip_path),
+                          regenerar=regenerar, consolidado=consolidado, zip_path=zip_path,
+                          compacto=compacto, historial=historial, reanudar=reanudar, estricto=estricto,
+                          bloques=bloques)
+
+
+# Socket Unix por defecto del daemon (--daemon / --socket)
+SOCKET_DAEMON = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'retidiag_informes.sock')
+
+
+class _SalidaSocket:
+    """Reenvía al cliente del daemon lo que el trabajo imprime, como líneas JSON."""
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.conectado = True
+
+    def enviar(self, mensaje):
+        if not self.conectado:
+            return
+        try:
+            self.archivo.write(json.dumps(mensaje, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.archivo.flush()
+        except OSError:
+            # El cliente se desconectó: el trabajo sigue hasta terminar
+            self.conectado = False
+
+    def write(self, texto):
+        if texto:
+            self.enviar({'salida': texto})
+        return len(texto)
+
+    def flush(self):
+        pass
+
+
+class _ManejadorDaemon(socketserver.StreamRequestHandler):
+    """Atiende un trabajo: una línea JSON con los argumentos de ejecutar_trabajo."""
+
+    def handle(self):
+        salida = _SalidaSocket(self.wfile)
+        ok = False
+        try:
+            trabajo = json.loads(self.rfile.readline())
+            metricas_trabajo = trabajo.pop('metricas', None)
+            reiniciar_metricas()
+            with redirect_stdout(salida):
+                with medir_etapa('total'):
+                    ok = ejecutar_trabajo(**trabajo)
+                if metricas_trabajo:
+                    guardar_reporte_metricas(metricas_trabajo)
+                    print(f"✓ Métricas guardadas: {metricas_trabajo}")
+        except Exception as e:
+            salida.enviar({'salida': f"ERROR: {e}\n"})
+            # Un pool con un worker caído no sirve para el siguiente trabajo
+            _cerrar_pools_persistentes()
+        salida.enviar({'fin': True, 'ok': bool(ok)})
+
+
+def _cerrar_pools_persistentes():
+    """Cierra los pools que mantiene el daemon entre trabajos."""
+    for pool in _POOLS_PERSISTENTES.values():
+        pool.shutdown(cancel_futures=True)
+    _POOLS_PERSISTENTES.clear()
+
 
-    wb.save(ruta_archivo)
-    print(f"✓ Resumen guardado: {nombre_archivo}")
+def precalentar():
+    """Importa las dependencias y genera en memoria un informe por logo, firma y motor.
+
+    Así los estilos, los logos y firmas ya decodificados y las plantillas
+    compiladas quedan en caché antes del primer trabajo (y los workers que
+    se crean después con fork los heredan).
+    """
+    cargar_dependencias()
+    _inicializar_worker()
+    comunas = list(LOGOS_ESTABLECIMIENTO)
+    oftalmologos = list(FIRMAS_OFTALMOLOGO)
+    resultados = list(TEXTOS_DIAGNOSTICO)
+    for motor, generar in MOTORES.items():
+        for i in range(max(len(comunas), len(oftalmologos), len(resultados))):
+            paciente = Paciente(nombre='PACIENTE DE PRUEBA', comuna=comunas[i % len(comunas)],
+                                resultado=resultados[i % len(resultados)],
+                                oftalmologo=oftalmologos[i % len(oftalmologos)])
+            try:
+                generar(paciente, io.BytesIO(), _ESTILOS_WORKER)
+            except Exception as e:
+                print(f"Aviso: no se pudo precalentar el motor {motor}: {e}")
+                break
+
+
+def servir_daemon(ruta_socket=SOCKET_DAEMON):
+    """Atiende trabajos por un socket Unix local hasta recibir SIGINT o SIGTERM.
+
+    El proceso queda con las dependencias importadas, los estilos, logos,
+    firmas y plantillas en caché y los pools de procesos creados, así que
+    las ejecuciones cortas repetidas no pagan el arranque en frío. Los
+    trabajos se atienden de a uno, en orden de llegada.
+    """
+    global _POOLS_PERSISTENTES
+    if os.path.exists(ruta_socket):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as prueba:
+                prueba.connect(ruta_socket)
+            print(f"ERROR: Ya hay un daemon atendiendo en {ruta_socket}")
+            return False
+        except OSError:
+            os.unlink(ruta_socket)  # socket de un daemon que ya no corre
+
+    inicio = time.perf_counter()
+    precalentar()
+    _POOLS_PERSISTENTES = {}
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    mascara = os.umask(0o177)  # solo el usuario dueño puede conectarse
+    try:
+        servidor = socketserver.UnixStreamServer(ruta_socket, _ManejadorDaemon)
+    finally:
+        os.umask(mascara)
+    print(f"Daemon listo en {ruta_socket} ({time.perf_counter() - inicio:.1f} s de arranque)")
+    try:
+        with servidor:
+            servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _cerrar_pools_persistentes()
+        if os.path.exists(ruta_socket):
+            os.unlink(ruta_socket)
+        print("Daemon detenido")
+    return True
+
+
+def enviar_trabajo(ruta_socket, **trabajo):
+    """Envía un trabajo al daemon, muestra su salida a medida que llega y retorna si terminó bien.
+
+    Las rutas relativas se resuelven aquí, porque el daemon puede estar
+    corriendo en otra carpeta.
+    """
+    for clave in ('excel_path', 'carpeta_salida', 'zip_path', 'metricas', 'historial'):
+        if trabajo.get(clave):
+            trabajo[clave] = os.path.abspath(trabajo[clave])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conexion:
+        conexion.connect(ruta_socket)
+        conexion.sendall(json.dumps(trabajo, ensure_ascii=False).encode('utf-8') + b'\n')
+        for linea in conexion.makefile('rb'):
+            mensaje = json.loads(linea)
+            if mensaje.get('fin'):
+                return mensaje['ok']
+            sys.stdout.write(mensaje['salida'])
+            sys.stdout.flush()
+    print("ERROR: El daemon cerró la conexión antes de terminar el trabajo")
+    return False
+
+
+def guardar_reporte_metricas(ruta, perfil=None, memoria=None):
+    """Guarda en JSON las métricas por etapa de la ejecución.
+
+    `perfil` es un cProfile.Profile (se guardan las funciones con más tiempo
+    acumulado) y `memoria` un par (pico en bytes, tracemalloc.Snapshot).
+    """
+    tiempos = os.times()
+    reporte = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'argumentos': sys.argv[1:],
+        'cpu_procesos_hijos': round(tiempos.children_user + tiempos.children_system, 4),
+        'etapas': {etapa: {'llamadas': valores['llamadas'], 'pared': round(valores['pared'], 4),
+                           'cpu': round(valores['cpu'], 4)}
+                   for etapa, valores in sorted(_METRICAS.items())},
+    }
+    if memoria is not None:
+        pico, instantanea = memoria
+        reporte['memoria'] = {
+            'pico_mb': round(pico / 2**20, 2),
+            'principales': [{'lugar': str(estadistica.traceback), 'mb': round(estadistica.size / 2**20, 3),
+                             'bloques': estadistica.count}
+                            for estadistica in instantanea.statistics('lineno')[:20]],
+        }
+    if perfil is not None:
+        import pstats
+        estadisticas = pstats.Stats(perfil).stats
+        principales = sorted(estadisticas.items(), key=lambda item: item[1][3], reverse=True)[:40]
+        reporte['perfil'] = [{'funcion': f"{archivo}:{linea}({funcion})", 'llamadas': llamadas,
+                              'propio': round(propio, 4), 'acumulado': round(acumulado, 4)}
+                             for (archivo, linea, funcion), (_, llamadas, propio, acumulado, _)
+                             in principales]
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(reporte, f, ensure_ascii=False, indent=1)
+
+
+@contextmanager
+def perfilar(ruta_reporte):
+    """Ejecuta el bloque con cProfile y tracemalloc y guarda el reporte de métricas.
+
+    Además del JSON se guarda el perfil completo (<reporte>.prof) para
+    abrirlo con pstats o snakeviz. Solo se perfila el proceso principal.
+    """
+    import cProfile
+    import tracemalloc
+
+    tracemalloc.start()
+    perfil = cProfile.Profile()
+    perfil.enable()
+    try:
+        yield
+    finally:
+        perfil.disable()
+        pico = tracemalloc.get_traced_memory()[1]
+        instantanea = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        guardar_reporte_metricas(ruta_reporte, perfil, (pico, instantanea))
+        perfil.dump_stats(os.path.splitext(ruta_reporte)[0] + '.prof')
+        print(f"✓ Métricas guardadas: {ruta_reporte}")
 
 
 def main():
     """Función principal."""
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(
+        description="Genera informes retinográficos PDF a partir de un archivo Excel.",
+    )
+    parser.add_argument("excel_path", nargs="?",
+                        help="archivo Excel con la hoja INPUT, o carpeta / patrón glob de varios (modo lote)")
+    parser.add_argument("carpeta_salida", nargs="?", help="carpeta de salida (opcional)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="número de procesos para generar PDFs en paralelo (por defecto 1)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="leer la hoja INPUT fila a fila y generar los PDFs mientras se lee "
+                             "(los nombres sin logo o firma y los RUT ya informados se avisan al aparecer)")
+    parser.add_argument("--bloques", type=int, metavar="N",
+                        help="leer y generar de a N pacientes, con memoria acotada (para hojas muy grandes)")
+    parser.add_argument("--regenerar", action="store_true",
+                        help="regenerar todos los PDFs aunque no hayan cambiado desde la última ejecución")
+    parser.add_argument("--resume", action="store_true",
+                        help="retomar una ejecución interrumpida sin repetir los informes que ya terminó")
+    parser.add_argument("--estricto", action="store_true",
+                        help="no generar ningún informe si la validación del archivo encuentra problemas")
+    parser.add_argument("--motor", choices=sorted(MOTORES), default="platypus",
+                        help="motor de renderizado de los PDFs (por defecto platypus)")
+    parser.add_argument("--consolidado", choices=["diagnostico", "establecimiento"],
+                        help="generar un solo PDF por carpeta de establecimiento o de diagnóstico "
+                             "(un paciente por página, con marcadores e índice)")
+    parser.add_argument("--zip", metavar="ARCHIVO",
+                        help="escribir los informes y resúmenes directo en este ZIP en lugar de carpetas")
+    parser.add_argument("--compacto", action="store_true",
+                        help="PDFs más livianos: imágenes a la resolución de impresión y más comprimidas")
+    parser.add_argument("--historial", metavar="SQLITE",
+                        help="registrar los informes generados en esta base SQLite y avisar de "
+                             "pacientes ya informados el mismo año")
+    parser.add_argument("--consultar-rut", metavar="RUT",
+                        help="mostrar los informes registrados de un RUT en --historial y salir")
+    parser.add_argument("--metricas", metavar="JSON",
+                        help="guardar en este archivo los tiempos de pared y CPU por etapa")
+    parser.add_argument("--profile", action="store_true",
+                        help="perfilar con cProfile y tracemalloc (reporte en --metricas o "
+                             "metricas_<fecha>.json)")
+    parser.add_argument("--dividir", nargs="+", metavar="PDF",
+                        help="separar PDFs consolidados en los informes individuales (requiere pypdf)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="quedar atendiendo trabajos por un socket Unix con todo precargado")
+    parser.add_argument("--socket", nargs="?", const=SOCKET_DAEMON, metavar="RUTA",
+                        help="socket del daemon; sin --daemon, enviar el trabajo a ese daemon "
+                             f"(por defecto {SOCKET_DAEMON})")
+    args = parser.parse_args()
+    if args.zip and args.consolidado:
+        parser.error("--zip y --consolidado no se pueden usar juntos")
+    if args.consultar_rut and not args.historial:
+        parser.error("--consultar-rut requiere --historial")
+    if args.bloques is not None and args.bloques < 1:
+        parser.error("--bloques debe ser al menos 1")
+
+    if args.daemon:
+        if not servir_daemon(args.socket or SOCKET_DAEMON):
+            sys.exit(1)
+        return
+
+    if args.consultar_rut:
+        consultar_historial(args.historial, args.consultar_rut)
+        return
+
+    if args.dividir:
+        for pdf_path in args.dividir:
+            try:
+                print(f"✓ {pdf_path}: {dividir_consolidado(pdf_path)} informes")
+            except Exception as e:
+                print(f"✗ ERROR con {pdf_path}: {e}")
+        return
+
+    if not args.excel_path:
         # Usar archivo por defecto
         excel_path = "/Users/magda/Downloads/Plantilla para crear informes PDF de FO 2026.xlsm"
         if not os.path.exists(excel_path):
-            print("Uso: python generar_informes.py <archivo_excel.xlsx> [carpeta_salida]")
+            print("Uso: python generar_informes.py <archivo_excel.xlsx> [carpeta_salida] [--workers N]")
             print("\nEjemplo:")
             print("  python generar_informes.py datos_pacientes.xlsx")
             print("  python generar_informes.py datos_pacientes.xlsx ./mis_informes")
+            print("  python generar_informes.py datos_pacientes.xlsx ./mis_informes --workers 8")
             sys.exit(1)
     else:
-        excel_path = sys.argv[1]
-
-    carpeta_salida = sys.argv[2] if len(sys.argv) > 2 else None
-
-    procesar_excel(excel_path, carpeta_salida)
+        excel_path = args.excel_path
 
+    if args.socket:
+        if args.profile:
+            print("Aviso: --profile no se usa al enviar el trabajo a un daemon")
+        try:
+            ok = enviar_trabajo(args.socket, excel_path=excel_path, carpeta_salida=args.carpeta_salida,
+                                workers=args.workers, motor=args.motor, streaming=args.streaming,
+                                regenerar=args.regenerar, consolidado=args.consolidado,
+                                zip_path=args.zip, compacto=args.compacto, historial=args.historial,
+                                reanudar=args.resume, estricto=args.estricto, bloques=args.bloques,
+                                metricas=args.metricas)
+        except OSError as e:
+            print(f"ERROR: No se pudo conectar con el daemon en {args.socket}: {e}")
+            ok = False
+        if not ok:
+            sys.exit(1)
+        return
+
+    ruta_metricas = args.metricas
+    if args.profile and not ruta_metricas:
+        ruta_metricas = f"metricas_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+
+    with perfilar(ruta_metricas) if args.profile else nullcontext(), medir_etapa('total'):
+        ok = ejecutar_trabajo(excel_path, args.carpeta_salida, workers=args.workers, motor=args.motor,
+                              streaming=args.streaming, regenerar=args.regenerar,
+                              consolidado=args.consolidado, zip_path=args.zip, compacto=args.compacto,
+                              historial=args.historial, reanudar=args.resume, estricto=args.estricto,
+                              bloques=args.bloques)
+
+    if ruta_metricas and not args.profile:
+        guardar_reporte_metricas(ruta_metricas)
+        print(f"✓ Métricas guardadas: {ruta_metricas}")
+    if not ok:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Servicio HTTP local del Generador de Informes Retinográficos
+Retidiag - 2026
+
+Recibe los datos de un paciente en JSON (las mismas columnas de la hoja
+INPUT) y responde el PDF del informe apenas se genera, sin esperar a una
+ejecución por lotes. Las solicitudes se atienden con asyncio y los PDFs se
+generan en un pool de procesos precalentado; si hay demasiados informes
+pendientes el servicio responde 503 en lugar de encolarlos sin límite.
+
+    POST /informe   un paciente (objeto JSON)      -> application/pdf
+    POST /lote      lista de pacientes (o {"pacientes": [...]}) -> application/zip
+    GET  /salud     estado, workers e informes pendientes -> application/json
+"""
+
+import io
+import os
+import json
+import signal
+import asyncio
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote, urlsplit
+
+import generar_informes as gi
+
+# Límites de cada solicitud
+MAX_CUERPO = 8 * 2**20          # bytes del cuerpo JSON
+TIEMPO_LECTURA = 30             # segundos para recibir encabezados y cuerpo
+
+ESTADOS_HTTP = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    408: 'Request Timeout', 411: 'Length Required', 413: 'Payload Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+
+class ErrorHTTP(Exception):
+    """Error que se responde al cliente con su código de estado y un JSON {"error": ...}."""
+
+    def __init__(self, estado, mensaje, encabezados=None):
+        super().__init__(mensaje)
+        self.estado = estado
+        self.mensaje = mensaje
+        self.encabezados = encabezados or {}
+
+
+def _inicializar_worker(motor, compacta):
+    """Inicializa un proceso del pool con las dependencias y cachés ya cargadas."""
+    gi.usar_salida_compacta(compacta)
+    gi.precalentar()
+    gi._inicializar_worker(motor)
+
+
+def renderizar_informe(idx, fila):
+    """Genera (en un worker) el PDF de una fila de INPUT.
+
+    Retorna (nombre, ruta relativa RESULTADO/Nombre.pdf, error, bytes del PDF o None).
+    """
+    paciente = gi.Paciente.desde_dict(fila)
+    nombre, ruta = gi._ruta_informe(idx, paciente, '')
+    _, nombre, _, error, contenido = gi._generar_pdf_memoria_tarea(
+        (paciente, ruta, nombre, paciente.resultado))
+    return nombre, ruta, error, contenido
+
+
+def fila_desde_json(objeto):
+    """Valida un paciente recibido en JSON y lo deja como una fila de la hoja INPUT.
+
+    Las fechas en formato ISO (2026-01-16) se convierten a datetime, como
+    las entrega pandas al leer el Excel, para que el PDF sea el mismo.
+    """
+    if not isinstance(objeto, dict):
+        raise ErrorHTTP(400, "Cada paciente debe ser un objeto JSON con las columnas de INPUT")
+    desconocidas = sorted(set(objeto) - set(gi.COLUMNAS_INPUT))
+    if desconocidas:
+        raise ErrorHTTP(400, f"Columnas desconocidas: {', '.join(desconocidas)}")
+    faltantes = [col for col in gi.COLUMNAS_REQUERIDAS if col not in objeto]
+    if faltantes:
+        raise ErrorHTTP(400, f"Faltan columnas: {', '.join(faltantes)}")
+
+    fila = dict(objeto)
+    if 'FECHA' in fila:
+        fila['FECHA'] = gi.fecha_iso(fila['FECHA'])
+    return fila
+
+
+def _leer_json(cuerpo):
+    try:
+        return json.loads(cuerpo)
+    except ValueError as e:
+        raise ErrorHTTP(400, f"JSON inválido: {e}")
+
+
+async def _leer_solicitud(lector):
+    """Lee una solicitud HTTP/1.1 y retorna (método, ruta, cuerpo)."""
+    try:
+        linea = await lector.readline()
+        partes = linea.decode('latin-1').split()
+        if len(partes) != 3:
+            raise ErrorHTTP(400, "Solicitud inválida")
+        metodo, destino, _ = partes
+        encabezados = {}
+        while True:
+            linea = await lector.readline()
+            if linea in (b'\r\n', b'\n', b''):
+                break
+            clave, _, valor = linea.decode('latin-1').partition(':')
+            encabezados[clave.strip().lower()] = valor.strip()
+    except ValueError:
+        raise ErrorHTTP(400, "Encabezados demasiado largos")
+
+    if 'chunked' in encabezados.get('transfer-encoding', '').lower():
+        raise ErrorHTTP(411, "Se requiere Content-Length")
+    try:
+        largo = int(encabezados.get('content-length') or 0)
+    except ValueError:
+        raise ErrorHTTP(400, "Content-Length inválido")
+    if largo > MAX_CUERPO:
+        raise ErrorHTTP(413, f"El cuerpo supera {MAX_CUERPO // 2**20} MB")
+    cuerpo = await lector.readexactly(largo) if largo else b''
+    return metodo.upper(), urlsplit(destino).path, cuerpo
+
+
+def _respuesta(estado, tipo, contenido, encabezados=None):
+    """Arma los bytes de una respuesta HTTP (siempre cierra la conexión)."""
+    lineas = [f"HTTP/1.1 {estado} {ESTADOS_HTTP.get(estado, '')}",
+              f"Content-Type: {tipo}",
+              f"Content-Length: {len(contenido)}",
+              "Connection: close"]
+    lineas += [f"{clave}: {valor}" for clave, valor in (encabezados or {}).items()]
+    return ("\r\n".join(lineas) + "\r\n\r\n").encode('latin-1') + contenido
+
+
+def _json(datos):
+    return json.dumps(datos, ensure_ascii=False).encode('utf-8')
+
+
+def _armar_zip(resultados):
+    """ZIP con los PDFs generados (RESULTADO/Nombre.pdf) y errores.json si hubo errores.
+
+    Si dos pacientes van al mismo archivo queda el último, igual que en disco.
+    """
+    archivos = {}
+    errores = []
+    for idx, (nombre, ruta, error, contenido) in enumerate(resultados):
+        if error is None:
+            archivos.pop(ruta, None)
+            archivos[ruta] = contenido
+        else:
+            errores.append({'indice': idx, 'nombre': nombre, 'error': error})
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archivo_zip:
+        for ruta, contenido in archivos.items():
+            archivo_zip.writestr(ruta, contenido)
+        if errores:
+            archivo_zip.writestr('errores.json', _json(errores))
+    return buffer.getvalue(), len(archivos), len(errores)
+
+
+class ServicioInformes:
+    """Atiende las solicitudes HTTP y reparte los informes en el pool de procesos."""
+
+    def __init__(self, pool, workers, motor, compacta, max_pendientes, max_lote):
+        self.pool = pool
+        self.workers = workers
+        self.motor = motor
+        self.compacta = compacta
+        self.max_pendientes = max_pendientes
+        self.max_lote = max_lote
+        self.pendientes = 0
+        self.generados = 0
+        self.rechazados = 0
+
+    @contextmanager
+    def reservar(self, cantidad):
+        """Reserva lugar para `cantidad` informes o responde 503 si la cola está llena."""
+        if self.pendientes + cantidad > self.max_pendientes:
+            self.rechazados += 1
+            raise ErrorHTTP(503, f"Cola llena ({self.pendientes} informes pendientes, "
+                                 f"máximo {self.max_pendientes})", {'Retry-After': '1'})
+        self.pendientes += cantidad
+        try:
+            yield
+        finally:
+            self.pendientes -= cantidad
+
+    async def renderizar(self, filas):
+        loop = asyncio.get_running_loop()
+        with self.reservar(len(filas)):
+            resultados = await asyncio.gather(*(
+                loop.run_in_executor(self.pool, renderizar_informe, idx, fila)
+                for idx, fila in enumerate(filas)))
+        self.generados += sum(1 for _, _, error, _ in resultados if error is None)
+        return resultados
+
+    async def despachar(self, metodo, ruta, cuerpo):
+        """Retorna (estado, tipo, contenido, encabezados) de una solicitud."""
+        if ruta == '/salud':
+            if metodo != 'GET':
+                raise ErrorHTTP(405, "Usar GET")
+            return 200, 'application/json', _json({
+                'estado': 'ok', 'motor': self.motor, 'compacta': self.compacta, 'workers': self.workers,
+                'pendientes': self.pendientes, 'max_pendientes': self.max_pendientes,
+                'generados': self.generados, 'rechazados': self.rechazados,
+            }), None
+
+        if ruta == '/informe':
+            if metodo != 'POST':
+                raise ErrorHTTP(405, "Usar POST")
+            fila = fila_desde_json(_leer_json(cuerpo))
+            (nombre, ruta_pdf, error, contenido), = await self.renderizar([fila])
+            if error is not None:
+                raise ErrorHTTP(500, f"No se pudo generar el informe de {nombre}: {error}")
+            archivo = os.path.basename(ruta_pdf)
+            return 200, 'application/pdf', contenido, {
+                'Content-Disposition': f"inline; filename*=UTF-8''{quote(archivo)}"}
+
+        if ruta == '/lote':
+            if metodo != 'POST':
+                raise ErrorHTTP(405, "Usar POST")
+            datos = _leer_json(cuerpo)
+            pacientes = datos.get('pacientes') if isinstance(datos, dict) else datos
+            if not isinstance(pacientes, list) or not pacientes:
+                raise ErrorHTTP(400, "Se espera una lista de pacientes (o {\"pacientes\": [...]})")
+            if len(pacientes) > self.max_lote:
+                raise ErrorHTTP(413, f"El lote tiene {len(pacientes)} pacientes, máximo {self.max_lote}")
+            filas = [fila_desde_json(paciente) for paciente in pacientes]
+            resultados = await self.renderizar(filas)
+            contenido, exitosos, errores = await asyncio.to_thread(_armar_zip, resultados)
+            return 200, 'application/zip', contenido, {
+                'Content-Disposition': 'attachment; filename="informes.zip"',
+                'X-Informes-Generados': exitosos, 'X-Informes-Con-Error': errores}
+
+        raise ErrorHTTP(404, f"Ruta desconocida: {ruta}")
+
+    async def atender(self, lector, escritor):
+        """Atiende una conexión: una solicitud y su respuesta."""
+        try:
+            try:
+                metodo, ruta, cuerpo = await asyncio.wait_for(_leer_solicitud(lector), TIEMPO_LECTURA)
+                respuesta = _respuesta(*await self.despachar(metodo, ruta, cuerpo))
+            except ErrorHTTP as e:
+                respuesta = _respuesta(e.estado, 'application/json', _json({'error': e.mensaje}),
+                                       e.encabezados)
+            except asyncio.TimeoutError:
+                respuesta = _respuesta(408, 'application/json', _json({'error': "Tiempo de espera agotado"}))
+            except asyncio.IncompleteReadError:
+                return
+            except Exception as e:
+                respuesta = _respuesta(500, 'application/json', _json({'error': str(e)}))
+            escritor.write(respuesta)
+            await escritor.drain()
+        except ConnectionError:
+            pass
+        finally:
+            escritor.close()
+
+
+async def servir(host, puerto, workers=1, motor='platypus', compacta=False, max_pendientes=None,
+                 max_lote=500):
+    """Levanta el pool, lo precalienta y atiende solicitudes hasta SIGINT o SIGTERM."""
+    max_pendientes = max_pendientes or workers * 8
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_inicializar_worker,
+                             initargs=(motor, compacta)) as pool:
+        # Crear y precalentar todos los workers antes de aceptar solicitudes
+        await asyncio.gather(*(loop.run_in_executor(pool, os.getpid) for _ in range(workers)))
+
+        servicio = ServicioInformes(pool, workers, motor, compacta, max_pendientes,
+                                    max(1, min(max_lote, max_pendientes)))
+        servidor = await asyncio.start_server(servicio.atender, host, puerto)
+        detener = asyncio.Event()
+        for senal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(senal, detener.set)
+        print(f"Servicio listo en http://{host}:{puerto} (motor {motor}, {workers} workers, "
+              f"máximo {max_pendientes} informes pendientes)", flush=True)
+        async with servidor:
+            await detener.wait()
+    print("Servicio detenido")
+
+
+def main():
+    """Función principal."""
+    parser = argparse.ArgumentParser(
+        description="Servicio HTTP local que genera informes retinográficos PDF a pedido.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="dirección donde escuchar (por defecto 127.0.0.1)")
+    parser.add_argument("--puerto", type=int, default=8765, help="puerto (por defecto 8765)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="procesos que generan los PDFs (por defecto, uno por CPU)")
+    parser.add_argument("--motor", choices=sorted(gi.MOTORES), default="platypus",
+                        help="motor de renderizado (por defecto platypus)")
+    parser.add_argument("--compacto", action="store_true",
+                        help="PDFs más livianos (ver --compacto en generar_informes.py)")
+    parser.add_argument("--max-pendientes", type=int, default=None,
+                        help="informes en cola o generándose antes de responder 503 (por defecto 8 por worker)")
+    parser.add_argument("--max-lote", type=int, default=500,
+                        help="pacientes por solicitud a /lote (por defecto 500)")
+    args = parser.parse_args()
+
+    asyncio.run(servir(args.host, args.puerto, max(1, args.workers), args.motor, args.compacto,
+                       args.max_pendientes, args.max_lote))
+
+
+if __name__ == "__main__":
+    main()
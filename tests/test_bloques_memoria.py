@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Pico de memoria del modo --bloques con hojas de distinto largo.
+
+Procesa dos hojas INPUT sintéticas (benchmark_informes) con
+generar_informes.py --bloques en un proceso aparte y comprueba que el pico
+de RSS de la más larga no supere al de la más corta en más de
+TOLERANCIA_MEMORIA_MB. Con estos tamaños el modo normal crece unos 20 MB.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark_informes as bench
+
+TAMANOS = [500, 4000]
+BLOQUE = 100
+
+
+def _pdfs(carpeta):
+    return sum(1 for _, _, archivos in os.walk(carpeta) for a in archivos if a.endswith('.pdf'))
+
+
+@pytest.mark.skipif(not hasattr(os, 'wait4'), reason="el pico de memoria se mide con os.wait4 (solo Unix)")
+def test_pico_de_memoria_no_crece_con_el_largo_de_la_hoja(tmp_path):
+    picos = []
+    for filas in TAMANOS:
+        excel_path = bench.generar_excel_sintetico(str(tmp_path / f"input_{filas}.xlsx"), filas)
+        salida = str(tmp_path / f"salida_{filas}")
+        picos.append(bench.pico_memoria_bloques(excel_path, salida, BLOQUE))
+        assert _pdfs(salida) == filas
+
+    crecimiento = picos[1] - picos[0]
+    assert crecimiento <= bench.TOLERANCIA_MEMORIA_MB, (
+        f"el pico creció {crecimiento:.1f} MB de {TAMANOS[0]} a {TAMANOS[1]} filas "
+        f"({picos[0]:.1f} -> {picos[1]:.1f} MB)")